@@ -3,6 +3,8 @@ Run benchmarks
 --------------
 1. Install pandas tabulate dependency `python -m pip install tabulate`
 2. Run benchmark script, eg: `python benchmark.py --model_type vit_h --device cpu`
+3. To compare the embedding runtime with onnxruntime, export the image encoder with
+   `micro_sam.bioimageio.bioengine_export.export_onnx_image_encoder` and pass it via `--onnx_encoder`
 
 Line profiling
 --------------
@@ -51,16 +53,17 @@ def _add_result(benchmark_results, model_type, device, name, runtimes):
     return benchmark_results
 
 
-def benchmark_embeddings(image, predictor, n):
-    print("Running benchmark_embeddings ...")
+def benchmark_embeddings(image, predictor, n, name="embeddings"):
+    print(f"Running benchmark_{name} ...")
     n = 3 if n is None else n
     times = []
     for _ in range(n):
         t0 = time.time()
-        util.precompute_image_embeddings(predictor, image)
+        # Don't use the embedding cache, so that the embeddings are recomputed in each repetition.
+        util.precompute_image_embeddings(predictor, image, use_cache=False)
         times.append(time.time() - t0)
     runtime = np.mean(times)
-    return ["embeddings"], [runtime]
+    return [name], [runtime]
 
 
 def benchmark_prompts(image, predictor, n):
@@ -176,6 +179,9 @@ def main():
                         help="Skip automatic mask generation (amg) benchmark test, do not run")
     parser.add_argument("-n", "--n", type=int, default=None,
                         help="Number of times to repeat benchmark tests")
+    parser.add_argument("--onnx_encoder", default=None,
+                        help="Path to an exported onnx image encoder, to compare the embedding runtime "
+                        "of onnxruntime with pytorch")
 
     args = parser.parse_args()
 
@@ -191,6 +197,12 @@ def main():
         name, rt = benchmark_embeddings(image, predictor, args.n)
         benchmark_results = _add_result(benchmark_results, model_type, device, name, rt)
 
+    if args.benchmark_embeddings and args.onnx_encoder is not None:
+        util.set_image_encoder_backend(predictor, "onnxruntime", model_path=args.onnx_encoder)
+        name, rt = benchmark_embeddings(image, predictor, args.n, name="embeddings-onnxruntime")
+        benchmark_results = _add_result(benchmark_results, model_type, device, name, rt)
+        util.set_image_encoder_backend(predictor, "torch")
+
     if args.benchmark_prompts:
         name, rt = benchmark_prompts(image, predictor, args.n)
         benchmark_results = _add_result(benchmark_results, model_type, device, name, rt)
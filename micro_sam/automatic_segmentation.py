@@ -49,7 +49,7 @@ def get_predictor_and_segmenter(
 
     # Get the predictor and state for Segment Anything models.
     predictor, state = util.get_sam_model(
-        model_type=model_type, device=device, checkpoint_path=checkpoint, return_state=True,
+        model_type=model_type, device=device, checkpoint_path=checkpoint, return_state=True, shared=True,
     )
 
     if amg is None:
@@ -125,6 +125,9 @@ def automatic_tracking(
     # Otherwise, we ignore additional post-processing for AIS.
     if isinstance(segmenter, InstanceSegmentationWithDecoder):
         generate_kwargs["output_mode"] = None
+    # For AMG we keep the masks as run-length encoding, which is faster to convert to the segmentation.
+    else:
+        generate_kwargs.setdefault("output_mode", "uncompressed_rle")
 
     if (image_data.ndim != 3) and (image_data.ndim != 4 and image_data.shape[-1] != 3):
         raise ValueError(f"The inputs does not match the shape expectation of 3d inputs: {image_data.shape}")
@@ -218,6 +221,10 @@ def automatic_instance_segmentation(
     # Otherwise, we ignore additional post-processing for AIS.
     if isinstance(segmenter, InstanceSegmentationWithDecoder):
         generate_kwargs["output_mode"] = None
+    # For AMG we keep the masks as run-length encoding, which is faster to convert to the segmentation
+    # and avoids holding all masks in memory as dense arrays.
+    else:
+        generate_kwargs.setdefault("output_mode", "uncompressed_rle")
 
     if ndim == 2:
         if (image_data.ndim != 2) and (image_data.ndim != 3 and image_data.shape[-1] != 3):
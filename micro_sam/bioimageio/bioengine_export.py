@@ -103,6 +103,65 @@ def export_image_encoder(
         f.write(ENCODER_CONFIG % name)
 
 
+def export_onnx_image_encoder(
+    model_type: str,
+    output_path: Union[str, os.PathLike],
+    opset: int = 17,
+    checkpoint_path: Optional[Union[str, os.PathLike]] = None,
+) -> None:
+    """Export SAM image encoder to onnx.
+
+    The onnx image encoder can be used for computing the image embeddings with onnxruntime,
+    see `micro_sam.util.set_image_encoder_backend`. The hash of the model is stored in the metadata
+    of the exported model, so that it is only used together with the same model.
+
+    Args:
+        model_type: The SAM model type.
+        output_path: The filepath for saving the exported model.
+        opset: The ONNX opset version. The recommended opset version is 17.
+        checkpoint_path: Optional checkpoint for loading the exported model.
+    """
+    output_folder = os.path.split(output_path)[0]
+    if output_folder:
+        os.makedirs(output_folder, exist_ok=True)
+
+    predictor = get_sam_model(model_type=model_type, checkpoint_path=checkpoint_path, device="cpu")
+    encoder = predictor.model.image_encoder
+    encoder.eval()
+
+    input_ = torch.rand(1, 3, encoder.img_size, encoder.img_size)
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=torch.jit.TracerWarning)
+        warnings.filterwarnings("ignore", category=UserWarning)
+        print(f"Exporting onnx image encoder to {output_path}...")
+        torch.onnx.export(
+            encoder,
+            input_,
+            output_path,
+            export_params=True,
+            verbose=False,
+            opset_version=opset,
+            do_constant_folding=True,
+            input_names=["image"],
+            output_names=["image_embeddings"],
+            dynamic_axes={"image": {0: "batch_size"}, "image_embeddings": {0: "batch_size"}},
+        )
+
+    # Store the hash of the model in the metadata. We don't load the weights, which may be stored in external data.
+    import onnx
+
+    onnx_model = onnx.load(output_path, load_external_data=False)
+    onnx.helper.set_model_props(
+        onnx_model, {"micro_sam_model_type": model_type, "micro_sam_model_hash": predictor._hash}
+    )
+    onnx.save(onnx_model, output_path)
+
+    if onnxruntime_exists:
+        ort_session = onnxruntime.InferenceSession(output_path, providers=["CPUExecutionProvider"])
+        _ = ort_session.run(None, {"image": _to_numpy(input_)})
+        print("Model has successfully been run with ONNXRuntime.")
+
+
 def export_onnx_model(
     model_type: str,
     output_root: Union[str, os.PathLike],
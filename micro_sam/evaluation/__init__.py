@@ -5,6 +5,8 @@ from .instance_segmentation import (
     run_instance_segmentation_inference,
     run_instance_segmentation_grid_search,
     run_instance_segmentation_grid_search_and_inference,
+    run_instance_segmentation_tuning,
+    run_instance_segmentation_tuning_and_inference,
 )
 from .evaluation import (
     run_evaluation,
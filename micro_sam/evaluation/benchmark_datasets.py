@@ -534,7 +534,7 @@ def _run_automatic_segmentation_per_dataset(
     # Depending on that, we can set 'run_amg' to the default best automatic segmentation (i.e. AIS > AMG).
     if run_amg is None or (not run_amg):  # The 2nd condition checks if you want AIS and if decoder state exists or not.
         _, state = util.get_sam_model(
-            model_type=model_type, checkpoint_path=checkpoint_path, device=device, return_state=True
+            model_type=model_type, checkpoint_path=checkpoint_path, device=device, return_state=True, shared=True,
         )
         run_amg = ("decoder_state" not in state)
 
@@ -2,10 +2,13 @@
 """
 
 import os
+import numbers
+from concurrent import futures
 from glob import glob
 from tqdm import tqdm
 from pathlib import Path
 from itertools import product
+from collections import OrderedDict
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 import numpy as np
@@ -100,6 +103,31 @@ def default_grid_search_values_instance_segmentation_with_decoder(
     }
 
 
+# The ground-truth for evaluating the grid search results in a worker process.
+_GRID_SEARCH_GT = None
+
+
+def _set_grid_search_gt(gt):
+    global _GRID_SEARCH_GT
+    _GRID_SEARCH_GT = gt
+
+
+def _evaluate_grid_search_segmentation(instance_labels, gt=None):
+    gt = _GRID_SEARCH_GT if gt is None else gt
+    m_sas, sas = mean_segmentation_accuracy(instance_labels, gt, return_accuracies=True)  # type: ignore
+    return m_sas, sas[0], sas[5]
+
+
+# Check if a parameter value read from a csv file matches the value of a parameter combination.
+# 'None' is read as NaN and floats may not round-trip exactly.
+def _is_same_value(saved_value, value):
+    if value is None:
+        return bool(pd.isna(saved_value))
+    if isinstance(value, numbers.Number) and isinstance(saved_value, numbers.Number):
+        return bool(np.isclose(saved_value, value))
+    return saved_value == value
+
+
 def _grid_search_iteration(
     segmenter: Union[AMGBase, InstanceSegmentationWithDecoder],
     gs_combinations: List[Dict],
@@ -108,9 +136,38 @@ def _grid_search_iteration(
     fixed_generate_kwargs: Dict[str, Any],
     result_path: Optional[Union[str, os.PathLike]],
     verbose: bool = False,
+    n_workers: int = 1,
 ) -> pd.DataFrame:
-    net_list = []
-    for gs_kwargs in tqdm(gs_combinations, disable=not verbose):
+    # The segmenters cache the intermediate results that are shared between parameter combinations
+    # (the smoothed decoder outputs for AIS and the filtered and post-processed masks for AMG),
+    # so we only run the segmentation in this process and evaluate the segmentations in a process pool.
+
+    # The result for each combination is written to a partial result file as soon as it is available,
+    # so that an interrupted grid search can be resumed without recomputing these combinations.
+    # The rows of the partial result file are identified by the index of their combination. We also check that
+    # the parameters of the row match the combination, in case the grid search values have changed in between.
+    partial_path = None if result_path is None else f"{result_path}.partial"
+    results = {}
+    if partial_path is not None and os.path.exists(partial_path):
+        for result in pd.read_csv(partial_path).to_dict("records"):
+            idx = result.pop("combination_id")
+            if idx < len(gs_combinations) and all(
+                _is_same_value(result.get(k), v) for k, v in gs_combinations[idx].items()
+            ):
+                result.update(gs_combinations[idx])
+                results[idx] = result
+
+    def _write_result(idx, scores):
+        m_sas, sa50, sa75 = scores
+        result = {"image_name": image_name, "mSA": m_sas, "SA50": sa50, "SA75": sa75}
+        result.update(gs_combinations[idx])
+        results[idx] = result
+        if partial_path is not None:
+            pd.DataFrame([{"combination_id": idx, **result}]).to_csv(
+                partial_path, mode="a", header=not os.path.exists(partial_path), index=False
+            )
+
+    def _segment(gs_kwargs):
         generate_kwargs = gs_kwargs | fixed_generate_kwargs
         masks = segmenter.generate(**generate_kwargs)
 
@@ -119,15 +176,34 @@ def _grid_search_iteration(
             instance_labels = np.zeros(gt.shape, dtype="uint32")
         else:
             instance_labels = mask_data_to_segmentation(masks, with_background=True, min_object_size=min_object_size)
-        m_sas, sas = mean_segmentation_accuracy(instance_labels, gt, return_accuracies=True)  # type: ignore
-
-        result_dict = {"image_name": image_name, "mSA": m_sas, "SA50": sas[0], "SA75": sas[5]}
-        result_dict.update(gs_kwargs)
-        tmp_df = pd.DataFrame([result_dict])
-        net_list.append(tmp_df)
+        return instance_labels
+
+    todo = [idx for idx in range(len(gs_combinations)) if idx not in results]
+    if n_workers > 1:
+        with futures.ProcessPoolExecutor(n_workers, initializer=_set_grid_search_gt, initargs=(gt,)) as pool:
+            pending = {}
+            for idx in tqdm(todo, disable=not verbose):
+                instance_labels = _segment(gs_combinations[idx])
+                pending[pool.submit(_evaluate_grid_search_segmentation, instance_labels)] = idx
+
+                # Limit the number of pending evaluations to bound the memory used by the segmentations.
+                if len(pending) >= 2 * n_workers:
+                    finished, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                    for future in finished:
+                        _write_result(pending.pop(future), future.result())
+
+            for future in futures.as_completed(pending):
+                _write_result(pending[future], future.result())
+    else:
+        for idx in tqdm(todo, disable=not verbose):
+            instance_labels = _segment(gs_combinations[idx])
+            _write_result(idx, _evaluate_grid_search_segmentation(instance_labels, gt))
 
-    img_gs_df = pd.concat(net_list)
-    img_gs_df.to_csv(result_path, index=False)
+    img_gs_df = pd.DataFrame([results[idx] for idx in range(len(gs_combinations))])
+    if result_path is not None:
+        img_gs_df.to_csv(result_path, index=False)
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
 
     return img_gs_df
 
@@ -157,6 +233,7 @@ def run_instance_segmentation_grid_search(
     gt_key: Optional[str] = None,
     rois: Optional[Tuple[slice, ...]] = None,
     tiling_window_params: Optional[Dict[str, Tuple[int, int]]] = None,
+    n_workers: int = 1,
 ) -> None:
     """Run grid search for automatic mask generation.
 
@@ -190,6 +267,9 @@ def run_instance_segmentation_grid_search(
             If not given a simple image format like tif is assumed.
         rois: Region of interests to resetrict the evaluation to.
         tiling_window_params: The parameters to decide whether to use tiling window operation for AIS.
+        n_workers: The number of processes for evaluating the segmentations of the parameter combinations.
+            The results for each image are written incrementally, so that an interrupted grid search
+            can be resumed. By default, set to '1'.
     """
     verbose_embeddings = False
 
@@ -247,6 +327,7 @@ def run_instance_segmentation_grid_search(
         _grid_search_iteration(
             segmenter, gs_combinations, gt, image_name,
             fixed_generate_kwargs=fixed_generate_kwargs, result_path=result_path, verbose=verbose_gs,
+            n_workers=n_workers,
         )
 
 
@@ -384,6 +465,7 @@ def run_instance_segmentation_grid_search_and_inference(
     fixed_generate_kwargs: Optional[Dict[str, Any]] = None,
     verbose_gs: bool = True,
     tiling_window_params: Optional[Dict[str, Tuple[int, int]]] = None,
+    n_workers: int = 1,
 ) -> None:
     """Run grid search and inference for automatic mask generation.
 
@@ -404,6 +486,7 @@ def run_instance_segmentation_grid_search_and_inference(
         verbose_gs: Whether to run the gridsearch for individual images in a verbose mode.
         tiling_window_params: The parameters to decide whether to use tiling window operation
             for automatic segmentation.
+        n_workers: The number of processes for evaluating the grid search results. By default, set to '1'.
     """
     run_instance_segmentation_grid_search(
         segmenter=segmenter,
@@ -415,6 +498,7 @@ def run_instance_segmentation_grid_search_and_inference(
         fixed_generate_kwargs=fixed_generate_kwargs,
         verbose_gs=verbose_gs,
         tiling_window_params=tiling_window_params,
+        n_workers=n_workers,
     )
 
     best_kwargs, best_msa = evaluate_instance_segmentation_grid_search(result_dir, list(grid_search_values.keys()))
@@ -435,3 +519,317 @@ def run_instance_segmentation_grid_search_and_inference(
         generate_kwargs=generate_kwargs,
         tiling_window_params=tiling_window_params,
     )
+
+
+def _get_grid_neighbors(combination, grid_search_values):
+    # The neighbors of a parameter combination are the combinations with one parameter changed
+    # to the adjacent value in its list of grid search values.
+    neighbors = []
+    for param_id, (name, values) in enumerate(grid_search_values.items()):
+        value_id = values.index(combination[param_id])
+        for neighbor_value_id in (value_id - 1, value_id + 1):
+            if 0 <= neighbor_value_id < len(values):
+                neighbor = list(combination)
+                neighbor[param_id] = values[neighbor_value_id]
+                neighbors.append(tuple(neighbor))
+    return neighbors
+
+
+def run_instance_segmentation_tuning(
+    segmenter: Union[AMGBase, InstanceSegmentationWithDecoder],
+    grid_search_values: Dict[str, List],
+    image_paths: List[Union[str, os.PathLike]],
+    gt_paths: List[Union[str, os.PathLike]],
+    result_dir: Union[str, os.PathLike],
+    embedding_dir: Optional[Union[str, os.PathLike]],
+    fixed_generate_kwargs: Optional[Dict[str, Any]] = None,
+    verbose_gs: bool = False,
+    image_key: Optional[str] = None,
+    gt_key: Optional[str] = None,
+    rois: Optional[Tuple[slice, ...]] = None,
+    tiling_window_params: Optional[Dict[str, Tuple[int, int]]] = None,
+    n_workers: int = 1,
+    n_candidates: Optional[int] = None,
+    reduction_factor: int = 3,
+    criterion: str = "mSA",
+    seed: int = 0,
+    max_cached_states: int = 2,
+) -> Tuple[Dict[str, Any], float]:
+    """Run an adaptive search for the parameters of automatic mask generation.
+
+    Instead of evaluating all combinations of the grid search values on all images, like
+    `run_instance_segmentation_grid_search`, this function uses successive halving:
+    A random subset of the parameter combinations is evaluated on a subset of the images.
+    Only the best combinations are kept and evaluated on more images, until the remaining
+    combinations are evaluated on all images. In each round new candidates are added by
+    changing the values of the best combinations to their neighboring grid search values.
+    Finally, the best combination is refined on all images until no neighboring combination improves it.
+
+    The parameters are specified via 'grid_search_values', in the same way as for
+    `run_instance_segmentation_grid_search`. The segmenter states of the most recently used images are kept
+    in memory, see 'max_cached_states'. The evaluation results are saved in 'tuning_results.csv' in 'result_dir',
+    so that an interrupted search can be resumed.
+
+    Args:
+        segmenter: The class implementing the instance segmentation functionality.
+        grid_search_values: The grid search values for parameters of the `generate` function.
+        image_paths: The input images for the parameter search.
+        gt_paths: The ground-truth segmentation for the parameter search.
+        result_dir: Folder to cache the evaluation results.
+        embedding_dir: Folder to cache the image embeddings.
+        fixed_generate_kwargs: Fixed keyword arguments for the `generate` method of the segmenter.
+        verbose_gs: Whether to run the evaluation for individual images in a verbose mode.
+        image_key: Key for loading the image data from a more complex file format like HDF5.
+            If not given a simple image format like tif is assumed.
+        gt_key: Key for loading the ground-truth data from a more complex file format like HDF5.
+            If not given a simple image format like tif is assumed.
+        rois: Region of interests to resetrict the evaluation to.
+        tiling_window_params: The parameters to decide whether to use tiling window operation for AIS.
+        n_workers: The number of processes for evaluating the segmentations. By default, set to '1'.
+        n_candidates: The number of randomly chosen parameter combinations to start the search with.
+            By default, a tenth of all parameter combinations is used.
+        reduction_factor: The factor by which the number of candidates is reduced and the number of images
+            is increased in each round. By default, set to '3'.
+        criterion: The metric to use for determining the best parameters. By default, set to 'mSA'.
+        seed: The seed for choosing the initial candidates and the order of the images. By default, set to '0'.
+        max_cached_states: The number of images for which the segmenter state and ground-truth are kept in memory.
+            Images that are evaluated again in a later round are initialized again otherwise, which reads the
+            embeddings from 'embedding_dir' (or recomputes them if it is not given) and re-runs the initialization
+            of the segmenter. The state of an image is large, e.g. the masks of all prompts for AMG,
+            so it should only be increased if the memory allows it. By default, set to '2'.
+
+    Returns:
+        The best parameter setting.
+        The evaluation score for the best setting.
+    """
+    assert len(image_paths) == len(gt_paths)
+    assert reduction_factor > 1
+    fixed_generate_kwargs = {} if fixed_generate_kwargs is None else fixed_generate_kwargs
+
+    duplicate_params = [gs_param for gs_param in grid_search_values.keys() if gs_param in fixed_generate_kwargs]
+    if duplicate_params:
+        raise ValueError(
+            "You may not pass duplicate parameters in 'grid_search_values' and 'fixed_generate_kwargs'."
+            f"The parameters {duplicate_params} are duplicated."
+        )
+
+    grid_search_values = {k: list(v) for k, v in grid_search_values.items()}
+    param_names = list(grid_search_values.keys())
+    all_combinations = list(product(*grid_search_values.values()))
+    n_images = len(image_paths)
+
+    os.makedirs(result_dir, exist_ok=True)
+    result_path = os.path.join(result_dir, "tuning_results.csv")
+    predictor = getattr(segmenter, "_predictor", None)
+    if tiling_window_params is None:
+        tiling_window_params = {}
+
+    # The scores of the evaluated combinations per image, loaded from a previous run if it exists.
+    scores = {}
+    results = []
+    if os.path.exists(result_path):
+        results = pd.read_csv(result_path).to_dict("records")
+        for result in results:
+            combination = []
+            for name, values in grid_search_values.items():
+                matching_values = [value for value in values if _is_same_value(result.get(name), value)]
+                if matching_values:
+                    combination.append(matching_values[0])
+            if len(combination) == len(param_names):
+                scores[(result["image_name"], tuple(combination))] = result[criterion]
+
+    # The segmenter states and ground-truth of the most recently initialized images.
+    image_states = OrderedDict()
+
+    def _initialize(i):
+        image_path, gt_path = image_paths[i], gt_paths[i]
+        if i in image_states:
+            image_states.move_to_end(i)
+            state, gt = image_states[i]
+            segmenter.set_state(state)
+            return gt
+
+        assert os.path.exists(image_path), image_path
+        assert os.path.exists(gt_path), gt_path
+        image = _load_image(image_path, image_key, roi=None if rois is None else rois[i])
+        gt = _load_image(gt_path, gt_key, roi=None if rois is None else rois[i])
+
+        if embedding_dir is None:
+            embedding_path = None
+        else:
+            assert predictor is not None
+            embedding_path = os.path.join(embedding_dir, f"{Path(image_path).stem}.zarr")
+
+        image_embeddings = util.precompute_image_embeddings(
+            predictor, image, embedding_path, ndim=2, verbose=False, **tiling_window_params
+        )
+        segmenter.initialize(image, image_embeddings, **tiling_window_params)
+        if max_cached_states > 0:
+            image_states[i] = (segmenter.get_state(), gt)
+            while len(image_states) > max_cached_states:
+                image_states.popitem(last=False)
+        return gt
+
+    # The images are evaluated in a random order, so that the first rounds use a random subset of the images,
+    # and the parameter combinations are chosen randomly at the start.
+    rng = np.random.default_rng(seed)
+    image_order = rng.permutation(n_images).tolist()
+
+    def _evaluate(candidates, n_eval_images):
+        # Evaluate the candidates on the first images in the random order, processing one image after the other
+        # so that the segmenter is only initialized once per image.
+        for i in tqdm(image_order[:n_eval_images], desc="Evaluate parameter candidates", disable=not verbose_gs):
+            image_name = Path(image_paths[i]).stem
+            missing = [combination for combination in candidates if (image_name, combination) not in scores]
+            if not missing:
+                continue
+
+            gt = _initialize(i)
+            img_df = _grid_search_iteration(
+                segmenter, [dict(zip(param_names, combination)) for combination in missing], gt, image_name,
+                fixed_generate_kwargs=fixed_generate_kwargs, result_path=None, n_workers=n_workers,
+            )
+            for combination, result in zip(missing, img_df.to_dict("records")):
+                scores[(image_name, combination)] = result[criterion]
+                results.append(result)
+            pd.DataFrame(results).to_csv(result_path, index=False)
+
+        image_names = [Path(image_paths[i]).stem for i in image_order[:n_eval_images]]
+        return {
+            combination: np.mean([scores[(image_name, combination)] for image_name in image_names])
+            for combination in candidates
+        }
+
+    # The number of images per round grows by the reduction factor, until all images are used.
+    n_rounds = 1
+    while reduction_factor ** n_rounds <= n_images:
+        n_rounds += 1
+    n_images_per_round = [
+        int(np.ceil(n_images / reduction_factor ** (n_rounds - 1 - round_id))) for round_id in range(n_rounds)
+    ]
+
+    if n_candidates is None:
+        n_candidates = int(np.ceil(len(all_combinations) / 10))
+    n_candidates = min(max(n_candidates, 1), len(all_combinations))
+    candidate_ids = rng.choice(len(all_combinations), size=n_candidates, replace=False)
+    candidates = [all_combinations[idx] for idx in sorted(candidate_ids)]
+    seen = set(candidates)
+
+    for round_id, n_eval_images in enumerate(n_images_per_round):
+        mean_scores = _evaluate(candidates, n_eval_images)
+        ranked = sorted(candidates, key=lambda combination: mean_scores[combination], reverse=True)
+        if round_id == n_rounds - 1:
+            break
+
+        # Keep the best candidates and add as many new candidates from the neighborhood of the best ones.
+        n_keep = int(np.ceil(len(ranked) / reduction_factor))
+        candidates = ranked[:n_keep]
+        new_candidates = []
+        for combination in candidates:
+            for neighbor in _get_grid_neighbors(combination, grid_search_values):
+                if neighbor not in seen and len(new_candidates) < n_keep:
+                    new_candidates.append(neighbor)
+                    seen.add(neighbor)
+        candidates = candidates + new_candidates
+
+    # Refine the best combination on all images until none of its neighbors is better.
+    best_combination = ranked[0]
+    best_score = mean_scores[best_combination]
+    while True:
+        neighbors = [
+            neighbor for neighbor in _get_grid_neighbors(best_combination, grid_search_values) if neighbor not in seen
+        ]
+        if not neighbors:
+            break
+        seen.update(neighbors)
+        neighbor_scores = _evaluate(neighbors, n_images)
+        best_neighbor = max(neighbors, key=lambda combination: neighbor_scores[combination])
+        if neighbor_scores[best_neighbor] <= best_score:
+            break
+        best_combination, best_score = best_neighbor, neighbor_scores[best_neighbor]
+
+    best_kwargs = dict(zip(param_names, best_combination))
+    return best_kwargs, best_score
+
+
+def run_instance_segmentation_tuning_and_inference(
+    segmenter: Union[AMGBase, InstanceSegmentationWithDecoder],
+    grid_search_values: Dict[str, List],
+    val_image_paths: List[Union[str, os.PathLike]],
+    val_gt_paths: List[Union[str, os.PathLike]],
+    test_image_paths: List[Union[str, os.PathLike]],
+    embedding_dir: Optional[Union[str, os.PathLike]],
+    prediction_dir: Union[str, os.PathLike],
+    experiment_folder: Union[str, os.PathLike],
+    result_dir: Union[str, os.PathLike],
+    fixed_generate_kwargs: Optional[Dict[str, Any]] = None,
+    verbose_gs: bool = True,
+    tiling_window_params: Optional[Dict[str, Tuple[int, int]]] = None,
+    n_workers: int = 1,
+    n_candidates: Optional[int] = None,
+    reduction_factor: int = 3,
+    seed: int = 0,
+    max_cached_states: int = 2,
+) -> None:
+    """Run the adaptive parameter search and inference for automatic mask generation.
+
+    This is a drop-in replacement for `run_instance_segmentation_grid_search_and_inference`
+    that evaluates only a fraction of the parameter combinations.
+    Please refer to the documentation of `run_instance_segmentation_tuning` for details.
+
+    Args:
+        segmenter: The class implementing the instance segmentation functionality.
+        grid_search_values: The grid search values for parameters of the `generate` function.
+        val_image_paths: The input images for the parameter search.
+        val_gt_paths: The ground-truth segmentation for the parameter search.
+        test_image_paths: The input images for inference.
+        embedding_dir: Folder to cache the image embeddings.
+        prediction_dir: Folder to save the predictions.
+        experiment_folder: Folder for caching best parameters in 'results'.
+        result_dir: Folder to cache the evaluation results.
+        fixed_generate_kwargs: Fixed keyword arguments for the `generate` method of the segmenter.
+        verbose_gs: Whether to run the parameter search in a verbose mode.
+        tiling_window_params: The parameters to decide whether to use tiling window operation
+            for automatic segmentation.
+        n_workers: The number of processes for evaluating the segmentations. By default, set to '1'.
+        n_candidates: The number of randomly chosen parameter combinations to start the search with.
+            By default, a tenth of all parameter combinations is used.
+        reduction_factor: The factor by which the number of candidates is reduced in each round.
+            By default, set to '3'.
+        seed: The seed for choosing the initial candidates and the order of the images. By default, set to '0'.
+        max_cached_states: The number of images for which the segmenter state is kept in memory.
+            By default, set to '2'.
+    """
+    best_kwargs, best_msa = run_instance_segmentation_tuning(
+        segmenter=segmenter,
+        grid_search_values=grid_search_values,
+        image_paths=val_image_paths,
+        gt_paths=val_gt_paths,
+        result_dir=result_dir,
+        embedding_dir=embedding_dir,
+        fixed_generate_kwargs=fixed_generate_kwargs,
+        verbose_gs=verbose_gs,
+        tiling_window_params=tiling_window_params,
+        n_workers=n_workers,
+        n_candidates=n_candidates,
+        reduction_factor=reduction_factor,
+        seed=seed,
+        max_cached_states=max_cached_states,
+    )
+    best_param_str = ", ".join(f"{k} = {v}" for k, v in best_kwargs.items())
+    print("Best parameter search result:", best_msa, "with parmeters:\n", best_param_str)
+    print()
+
+    save_grid_search_best_params(best_kwargs, best_msa, experiment_folder)
+
+    # We create a new dict, so that the fixed generate kwargs passed by the caller are not changed.
+    generate_kwargs = {**(fixed_generate_kwargs or {}), **best_kwargs}
+
+    run_instance_segmentation_inference(
+        segmenter=segmenter,
+        image_paths=test_image_paths,
+        embedding_dir=embedding_dir,
+        prediction_dir=prediction_dir,
+        generate_kwargs=generate_kwargs,
+        tiling_window_params=tiling_window_params,
+    )
@@ -157,6 +157,15 @@ def batched_inference(
         batch_data["boxes"] = batched_mask_to_box(batch_data["masks"])
         batch_data["logits"] = batch_logits
 
+        # For the instance segmentation we only keep the masks cropped to their bounding boxes,
+        # and paste them into the affected region of the segmentation. This avoids keeping
+        # full size masks for all prompts in memory.
+        if return_instance_segmentation:
+            batch_data["masks"] = [
+                mask[y0:(y1 + 1), x0:(x1 + 1)].cpu()
+                for mask, (x0, y0, x1, y1) in zip(batch_data["masks"], batch_data["boxes"].int().tolist())
+            ]
+
         masks.cat(batch_data)
 
     # Mask data to records.
@@ -173,6 +182,9 @@ def batched_inference(
     ]
 
     if return_instance_segmentation:
-        masks = mask_data_to_segmentation(masks, with_background=False, min_object_size=0)
+        for mask in masks:
+            x0, y0, w, h = mask["bbox"]
+            mask["segmentation_bb"] = (slice(y0, y0 + h + 1), slice(x0, x0 + w + 1))
+        masks = mask_data_to_segmentation(masks, with_background=False, min_object_size=0, shape=image_shape)
 
     return masks
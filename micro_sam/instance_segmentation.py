@@ -6,14 +6,12 @@ https://computational-cell-analytics.github.io/micro-sam/micro_sam.html
 import os
 import warnings
 from abc import ABC
-from copy import deepcopy
 from collections import OrderedDict
 from typing import Any, Dict, List, Optional, Tuple, Union
 
 import vigra
 import numpy as np
 from skimage.measure import label, regionprops
-from skimage.segmentation import relabel_sequential
 
 import torch
 from torchvision.ops.boxes import batched_nms, box_area
@@ -46,24 +44,40 @@ class _FakeInput:
         return np.zeros(block_shape, dtype="float32")
 
 
+def _paint_rle(flat_segmentation, rle, seg_id):
+    # The RLE counts alternate between background and foreground runs, starting with background,
+    # and refer to the mask flattened in column-major (Fortran) order.
+    counts = np.asarray(rle["counts"], dtype="int64")
+    ends = np.cumsum(counts)
+    starts, lengths = (ends - counts)[1::2], counts[1::2]
+    # Expand the foreground runs to the flat indices of the mask pixels.
+    offsets = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths)
+    flat_segmentation[offsets + np.arange(offsets.size)] = seg_id
+
+
 def mask_data_to_segmentation(
     masks: List[Dict[str, Any]],
     with_background: bool,
     min_object_size: int = 0,
     max_object_size: Optional[int] = None,
     label_masks: bool = True,
+    shape: Optional[Tuple[int, int]] = None,
 ) -> np.ndarray:
     """Convert the output of the automatic mask generation to an instance segmentation.
 
     Args:
         masks: The outputs generated by AutomaticMaskGenerator or EmbeddingMaskGenerator.
-            Only supports output_mode=binary_mask.
+            Supports output_mode=binary_mask and output_mode=uncompressed_rle. The latter is faster and
+            uses less memory, because the masks are painted from the run-length encoding directly.
+            Binary masks may also be given only for a bounding box of the image, which is then passed
+            as a tuple of slices under the key 'segmentation_bb'. In this case 'shape' must be passed.
         with_background: Whether the segmentation has background. If yes this function assures that the largest
             object in the output will be mapped to zero (the background value).
         min_object_size: The minimal size of an object in pixels. By default, set to '0'.
         max_object_size: The maximal size of an object in pixels.
         label_masks: Whether to apply connected components to the result before removing small objects.
             By default, set to 'True'.
+        shape: The shape of the segmentation. By default, derived from the first mask.
 
     Returns:
         The instance segmentation.
@@ -71,8 +85,15 @@ def mask_data_to_segmentation(
 
     masks = sorted(masks, key=(lambda x: x["area"]), reverse=True)
     # we could also get the shape from the crop box
-    shape = next(iter(masks))["segmentation"].shape
-    segmentation = np.zeros(shape, dtype="uint32")
+    first_mask = next(iter(masks))["segmentation"]
+    is_rle = isinstance(first_mask, dict)
+    if is_rle:
+        # The run-length encoding is in column-major order, so we paint into a Fortran-ordered array.
+        # Its flattened view in Fortran order shares the memory of the segmentation.
+        segmentation = np.zeros(tuple(first_mask["size"]), dtype="uint32", order="F")
+        flat_segmentation = segmentation.reshape(-1, order="F")
+    else:
+        segmentation = np.zeros(first_mask.shape if shape is None else shape, dtype="uint32")
 
     def require_numpy(mask):
         return mask.cpu().numpy() if torch.is_tensor(mask) else mask
@@ -85,32 +106,76 @@ def mask_data_to_segmentation(
             continue
 
         this_seg_id = mask.get("seg_id", seg_id)
-        segmentation[require_numpy(mask["segmentation"])] = this_seg_id
+        if is_rle:
+            _paint_rle(flat_segmentation, mask["segmentation"], this_seg_id)
+        elif "segmentation_bb" in mask:
+            segmentation[mask["segmentation_bb"]][require_numpy(mask["segmentation"])] = this_seg_id
+        else:
+            segmentation[require_numpy(mask["segmentation"])] = this_seg_id
         seg_id = this_seg_id + 1
 
     if label_masks:
         segmentation = label(segmentation).astype(segmentation.dtype)
 
-    seg_ids, sizes = np.unique(segmentation, return_counts=True)
+    # We filter the objects and relabel them sequentially in a single pass via a lookup table.
+    # If the ids are dense we index the lookup table with the ids directly, otherwise via the unique ids.
+    if segmentation.max() < segmentation.size:
+        sizes = np.bincount(segmentation.ravel(order="K"))
+        seg_ids, index = np.arange(len(sizes)), segmentation
+    else:
+        seg_ids, index, sizes = np.unique(segmentation, return_inverse=True, return_counts=True)
+        index = index.reshape(segmentation.shape)
 
     # In some cases objects may be smaller than peviously calculated,
     # since they are covered by other objects. We ensure these also get
-    # filtered out here.
-    filter_ids = seg_ids[sizes < min_object_size]
+    # filtered out here. Ids with a size of zero are not present in the segmentation.
+    keep = (sizes >= min_object_size) & (sizes > 0) & (seg_ids != 0)
 
     # If we run segmentation with background we also map the largest segment
     # (the most likely background object) to zero. This is often zero already,
     # but it does not hurt to reset that to zero either.
     if with_background:
-        bg_id = seg_ids[np.argmax(sizes)]
-        filter_ids = np.concatenate([filter_ids, [bg_id]])
+        keep[np.argmax(sizes)] = False
 
-    segmentation[np.isin(segmentation, filter_ids)] = 0
-    segmentation = relabel_sequential(segmentation)[0]
+    relabeling = np.zeros(len(sizes), dtype="uint32")
+    relabeling[keep] = np.arange(1, np.count_nonzero(keep) + 1, dtype="uint32")
+    segmentation = np.ascontiguousarray(relabeling[index])
 
     return segmentation
 
 
+def _mask_data_to_compact(mask_data):
+    # Convert the mask data to a compact representation that only consists of numpy arrays on the CPU.
+    # The run-length encodings are stored as the concatenated counts and the offsets of each mask's counts.
+    compact = {}
+    for key, val in mask_data.items():
+        if key == "rles":
+            counts = [np.asarray(rle["counts"], dtype="uint32") for rle in val]
+            compact["rle_counts"] = np.concatenate(counts) if counts else np.zeros(0, dtype="uint32")
+            compact["rle_offsets"] = np.cumsum([0] + [len(count) for count in counts]).astype("int64")
+            # All masks are uncropped to the full image, so they have the same size.
+            compact["rle_size"] = np.array(val[0]["size"] if val else [0, 0], dtype="int64")
+        else:
+            compact[key] = val.detach().cpu().numpy() if torch.is_tensor(val) else np.asarray(val)
+    return compact
+
+
+def _compact_to_mask_data(compact, keep=None):
+    # Convert the compact representation back to mask data, to apply the filtering and post-processing.
+    # We copy the arrays so that the compact state is not changed by in-place operations on the mask data.
+    # If 'keep' is given, only the masks selected by it are converted.
+    mask_data = amg_utils.MaskData()
+    index = slice(None) if keep is None else keep
+    for key, val in compact.items():
+        if key not in ("rle_counts", "rle_offsets", "rle_size"):
+            mask_data[key] = torch.from_numpy(np.array(val[index]))
+    if "rle_counts" in compact:
+        counts, offsets, size = compact["rle_counts"], compact["rle_offsets"], compact["rle_size"].tolist()
+        mask_ids = range(len(offsets) - 1) if keep is None else np.nonzero(keep)[0]
+        mask_data["rles"] = [{"size": size, "counts": counts[offsets[idx]:offsets[idx + 1]]} for idx in mask_ids]
+    return mask_data
+
+
 #
 # Classes for automatic instance segmentation
 #
@@ -125,6 +190,8 @@ class AMGBase(ABC):
         self._crop_list = None
         self._crop_boxes = None
         self._original_size = None
+        # The results of removing small regions for each mask, indexed by the minimal region area.
+        self._small_region_cache = {}
 
     @property
     def is_initialized(self):
@@ -135,6 +202,9 @@ class AMGBase(ABC):
     @property
     def crop_list(self):
         """The list of mask data after initialization.
+
+        The mask data of each crop is stored in a compact representation: a dictionary of numpy arrays,
+        with the run-length encoded masks stored as concatenated counts ('rle_counts') and offsets ('rle_offsets').
         """
         return self._crop_list
 
@@ -202,25 +272,46 @@ class AMGBase(ABC):
         if len(mask_data["rles"]) == 0:
             return mask_data
 
-        # filter small disconnected regions and holes
-        new_masks = []
-        scores = []
-        for rle in mask_data["rles"]:
-            mask = amg_utils.rle_to_mask(rle)
-
-            mask, changed = amg_utils.remove_small_regions(mask, min_area, mode="holes")
-            unchanged = not changed
-            mask, changed = amg_utils.remove_small_regions(mask, min_area, mode="islands")
-            unchanged = unchanged and not changed
+        # The result of removing small regions only depends on the mask and the minimal area.
+        # So we cache it for each mask (identified by its id in the crop list), which avoids decoding
+        # and processing the masks again when only the filter or nms thresholds change.
+        try:
+            mask_ids = mask_data["mask_ids"]
+        except KeyError:
+            mask_ids = None
+        cache = self._small_region_cache.setdefault(min_area, {})
 
-            new_masks.append(torch.as_tensor(mask, dtype=torch.int).unsqueeze(0))
+        # filter small disconnected regions and holes
+        new_rles, new_boxes, scores = [], [], []
+        for idx, rle in enumerate(mask_data["rles"]):
+            mask_id = None if mask_ids is None else int(mask_ids[idx])
+            if mask_id is not None and mask_id in cache:
+                new_rle, new_box, unchanged = cache[mask_id]
+            else:
+                mask = amg_utils.rle_to_mask(rle)
+
+                mask, changed = amg_utils.remove_small_regions(mask, min_area, mode="holes")
+                unchanged = not changed
+                mask, changed = amg_utils.remove_small_regions(mask, min_area, mode="islands")
+                unchanged = unchanged and not changed
+
+                # recalculate the box and the RLE for masks that have changed
+                mask_torch = torch.as_tensor(mask, dtype=torch.int).unsqueeze(0)
+                # Casting this to boolean as we work with one-hot labels.
+                new_box = batched_mask_to_box(mask_torch.to(torch.bool))[0]
+                # new_rle = amg_utils.mask_to_rle_pytorch(mask_torch)[0]
+                new_rle = None if unchanged else mask_to_rle_pytorch(mask_torch)[0]
+                if mask_id is not None:
+                    cache[mask_id] = (new_rle, new_box, unchanged)
+
+            new_rles.append(new_rle)
+            new_boxes.append(new_box)
             # give score=0 to changed masks and score=1 to unchanged masks
             # so NMS will prefer ones that didn't need postprocessing
             scores.append(float(unchanged))
 
-        # recalculate boxes and remove any new duplicates
-        masks = torch.cat(new_masks, dim=0)
-        boxes = batched_mask_to_box(masks.to(torch.bool))  # Casting this to boolean as we work with one-hot labels.
+        # remove any new duplicates
+        boxes = torch.stack(new_boxes)
         keep_by_nms = batched_nms(
             boxes.float(),
             torch.as_tensor(scores, dtype=torch.float),
@@ -228,12 +319,10 @@ class AMGBase(ABC):
             iou_threshold=nms_thresh,
         )
 
-        # only recalculate RLEs for masks that have changed
+        # only update the RLEs for masks that have changed
         for i_mask in keep_by_nms:
             if scores[i_mask] == 0.0:
-                mask_torch = masks[i_mask].unsqueeze(0)
-                # mask_data["rles"][i_mask] = amg_utils.mask_to_rle_pytorch(mask_torch)[0]
-                mask_data["rles"][i_mask] = mask_to_rle_pytorch(mask_torch)[0]
+                mask_data["rles"][i_mask] = new_rles[i_mask]
                 mask_data["boxes"][i_mask] = boxes[i_mask]  # update res directly
         mask_data.filter(keep_by_nms)
 
@@ -254,7 +343,11 @@ class AMGBase(ABC):
         elif output_mode == "binary_mask":
             mask_data["segmentations"] = [amg_utils.rle_to_mask(rle) for rle in mask_data["rles"]]
         else:
-            mask_data["segmentations"] = mask_data["rles"]
+            # The counts may be views into the compact state or shared with the small region cache.
+            # We return them as new lists, so that the output can be serialized and changed by the caller.
+            mask_data["segmentations"] = [
+                {"size": list(rle["size"]), "counts": np.asarray(rle["counts"]).tolist()} for rle in mask_data["rles"]
+            ]
 
         # write mask records
         curr_anns = []
@@ -322,9 +415,14 @@ class AMGBase(ABC):
         Args:
             state: The state of the mask generator, e.g. from serialized state.
         """
-        self._crop_list = state["crop_list"]
+        # States that were serialized with older versions store the mask data instead of the compact representation.
+        self._crop_list = [
+            crop_data if isinstance(crop_data, dict) else _mask_data_to_compact(crop_data)
+            for crop_data in state["crop_list"]
+        ]
         self._crop_boxes = state["crop_boxes"]
         self._original_size = state["original_size"]
+        self._small_region_cache = {}
         self._is_initialized = True
 
     def clear_state(self):
@@ -333,6 +431,7 @@ class AMGBase(ABC):
         self._crop_list = None
         self._crop_boxes = None
         self._original_size = None
+        self._small_region_cache = {}
         self._is_initialized = False
 
 
@@ -504,12 +603,13 @@ class AutomaticMaskGenerator(AMGBase):
                 precomputed_embeddings=precomputed_embeddings,
                 pbar_init=pbar_init, pbar_update=pbar_update,
             )
-            crop_list.append(crop_data)
+            crop_list.append(_mask_data_to_compact(crop_data))
         pbar_close()
 
         self._is_initialized = True
         self._crop_list = crop_list
         self._crop_boxes = crop_boxes
+        self._small_region_cache = {}
 
     @torch.no_grad()
     def generate(
@@ -542,9 +642,23 @@ class AutomaticMaskGenerator(AMGBase):
             raise RuntimeError("AutomaticMaskGenerator has not been initialized. Call initialize first.")
 
         data = amg_utils.MaskData()
+        mask_id_offset = 0
         for data_, crop_box in zip(self.crop_list, self.crop_boxes):
+            # Apply the threshold filters on the compact data first, so that we only convert the masks that pass.
+            keep = torch.ones(len(data_["iou_preds"]), dtype=torch.bool)
+            if pred_iou_thresh > 0.0:
+                keep &= torch.from_numpy(data_["iou_preds"]) > pred_iou_thresh
+            if stability_score_thresh > 0.0:
+                keep &= torch.from_numpy(data_["stability_score"]) >= stability_score_thresh
+            keep = keep.numpy()
+
+            crop_data = _compact_to_mask_data(data_, keep=keep)
+            # The ids of the masks in the crop list, to cache the post-processing results per mask.
+            crop_data["mask_ids"] = torch.from_numpy(mask_id_offset + np.nonzero(keep)[0])
+            mask_id_offset += len(keep)
+
             crop_data = self._postprocess_batch(
-                data=deepcopy(data_),
+                data=crop_data,
                 crop_box=crop_box, original_size=self.original_size,
                 pred_iou_thresh=pred_iou_thresh,
                 stability_score_thresh=stability_score_thresh,
@@ -632,6 +746,69 @@ class TiledAutomaticMaskGenerator(AutomaticMaskGenerator):
             stability_score_offset=stability_score_offset,
         )
 
+    def _process_tile_batch(self, image_embeddings, tile_ids, crop_boxes, i):
+        # Predict the masks for the point grid prompts of several tiles together.
+        # The mask decoder only supports a single image embedding, which it repeats for all prompts
+        # and adds to the dense prompt embeddings. Instead, we add the embedding of the tile of each prompt
+        # to its dense prompt embedding and pass an image embedding of zeros, which gives the same result.
+        model, device = self._predictor.model, self._predictor.device
+
+        tile_embeddings, input_sizes, original_sizes = [], [], []
+        points, transformed_points, tile_idxs = [], [], []
+        for idx, tile_id in enumerate(tile_ids):
+            util.set_precomputed(self._predictor, image_embeddings, i=i, tile_id=tile_id)
+            tile_embeddings.append(self._predictor.features)
+            input_sizes.append(self._predictor.input_size)
+            original_sizes.append(self._predictor.original_size)
+
+            x0, y0, x1, y1 = crop_boxes[idx]
+            cropped_im_size = (y1 - y0, x1 - x0)
+            points_for_tile = self.point_grids[0] * np.array(cropped_im_size)[None, ::-1]
+            points.append(points_for_tile)
+            transformed_points.append(self._predictor.transform.apply_coords(points_for_tile, cropped_im_size))
+            tile_idxs.append(np.full(len(points_for_tile), idx))
+        self._predictor.reset_image()
+
+        tile_embeddings = torch.cat(tile_embeddings)
+        points, transformed_points = np.concatenate(points), np.concatenate(transformed_points)
+        tile_idxs = np.concatenate(tile_idxs)
+
+        image_pe = model.prompt_encoder.get_dense_pe()
+        zero_embedding = torch.zeros_like(tile_embeddings[:1])
+
+        data = [amg_utils.MaskData() for _ in tile_ids]
+        batch_size = self._points_per_batch * len(tile_ids)
+        for start in range(0, len(points), batch_size):
+            stop = start + batch_size
+            batch_tile_idxs = tile_idxs[start:stop]
+
+            in_points = torch.as_tensor(transformed_points[start:stop], device=device, dtype=torch.float)
+            in_labels = torch.ones(in_points.shape[0], dtype=torch.int, device=device)
+            sparse_embeddings, dense_embeddings = model.prompt_encoder(
+                points=(in_points[:, None, :], in_labels[:, None]), boxes=None, masks=None,
+            )
+            dense_embeddings = dense_embeddings + tile_embeddings[torch.from_numpy(batch_tile_idxs).to(device)]
+            low_res_masks, iou_preds = model.mask_decoder(
+                image_embeddings=zero_embedding,
+                image_pe=image_pe,
+                sparse_prompt_embeddings=sparse_embeddings,
+                dense_prompt_embeddings=dense_embeddings,
+                multimask_output=True,
+            )
+
+            # The masks have to be resized and uncropped for each tile separately.
+            for idx in np.unique(batch_tile_idxs):
+                in_tile = torch.from_numpy(batch_tile_idxs == idx).to(device)
+                masks = model.postprocess_masks(low_res_masks[in_tile], input_sizes[idx], original_sizes[idx])
+                batch_data = self._to_mask_data(
+                    masks, iou_preds[in_tile], crop_boxes[idx], self.original_size,
+                    points=points[start:stop][batch_tile_idxs == idx],
+                )
+                data[idx].cat(batch_data)
+                del masks, batch_data
+
+        return data
+
     @torch.no_grad()
     def initialize(
         self,
@@ -644,6 +821,7 @@ class TiledAutomaticMaskGenerator(AutomaticMaskGenerator):
         pbar_init: Optional[callable] = None,
         pbar_update: Optional[callable] = None,
         batch_size: int = 1,
+        tile_batch_size: int = 1,
     ) -> None:
         """Initialize image embeddings and masks for an image.
 
@@ -661,6 +839,9 @@ class TiledAutomaticMaskGenerator(AutomaticMaskGenerator):
                 To enables using this function within a threadworker.
             pbar_update: Callback to update an external progress bar.
             batch_size: The batch size for image embedding prediction. By default, set to '1'.
+            tile_batch_size: The number of tiles for which the point grid prompts are decoded together.
+                Decoding several tiles together makes better use of the GPU, especially for small tiles.
+                The number of prompts per forward pass is `points_per_batch * tile_batch_size`. By default, set to '1'.
         """
         original_size = image.shape[:2]
         self._original_size = original_size
@@ -683,8 +864,20 @@ class TiledAutomaticMaskGenerator(AutomaticMaskGenerator):
         image = util._to_image(image)
 
         mask_data = []
-        for tile_id in range(n_tiles):
+        for tile_start in range(0, n_tiles, tile_batch_size):
+            tile_ids = list(range(tile_start, min(tile_start + tile_batch_size, n_tiles)))
+
+            if len(tile_ids) > 1:
+                # compute the mask data for several tiles together
+                batch_mask_data = self._process_tile_batch(
+                    image_embeddings, tile_ids, [crop_boxes[tile_id] for tile_id in tile_ids], i
+                )
+                mask_data.extend([_mask_data_to_compact(this_mask_data) for this_mask_data in batch_mask_data])
+                pbar_update(len(tile_ids))
+                continue
+
             # set the pre-computed embeddings for this tile
+            tile_id = tile_ids[0]
             features = image_embeddings["features"][str(tile_id)]
             tile_embeddings = {
                 "features": features,
@@ -697,7 +890,7 @@ class TiledAutomaticMaskGenerator(AutomaticMaskGenerator):
             this_mask_data = self._process_crop(
                 image, crop_box=crop_boxes[tile_id], crop_layer_idx=0, precomputed_embeddings=True
             )
-            mask_data.append(this_mask_data)
+            mask_data.append(_mask_data_to_compact(this_mask_data))
             pbar_update(1)
         pbar_close()
 
@@ -705,6 +898,7 @@ class TiledAutomaticMaskGenerator(AutomaticMaskGenerator):
         self._is_initialized = True
         self._crop_list = mask_data
         self._crop_boxes = crop_boxes
+        self._small_region_cache = {}
 
 
 #
@@ -845,8 +1039,10 @@ def get_decoder(
     Returns:
         The decoder for instance segmentation.
     """
-    unetr = get_unetr(image_encoder, decoder_state, device)
-    return DecoderAdapter(unetr)
+    # The decoder for the image encoder of a shared model, see `util.get_sam_model`, is also shared.
+    return util._MODEL_REGISTRY.get_decoder(
+        image_encoder, decoder_state, device, lambda: DecoderAdapter(get_unetr(image_encoder, decoder_state, device))
+    )
 
 
 def get_predictor_and_decoder(
@@ -877,6 +1073,7 @@ def get_predictor_and_decoder(
         device=device,
         return_state=True,
         peft_kwargs=peft_kwargs,
+        shared=True,
     )
 
     if "decoder_state" not in state:
@@ -963,6 +1160,10 @@ class InstanceSegmentationWithDecoder:
         self._center_distances = None
         self._boundary_distances = None
 
+        # The smoothed decoder outputs, indexed by name and sigma, and the outputs they were computed for.
+        self._smoothing_cache = {}
+        self._smoothing_cache_source = None
+
         self._is_initialized = False
 
     @property
@@ -1019,6 +1220,38 @@ class InstanceSegmentationWithDecoder:
         self._boundary_distances = output[2]
         self._is_initialized = True
 
+    @torch.no_grad()
+    def _initialize_batched(self, image_embeddings, indices):
+        # Run the decoder for several slices / frames of the image embeddings together
+        # and return the corresponding states. The embeddings of all slices / frames have the same shapes.
+        batched_embeddings = []
+        for i in indices:
+            self._predictor = util.set_precomputed(self._predictor, image_embeddings, i=i)
+            batched_embeddings.append(self._predictor.features)
+        input_shape = tuple(self._predictor.input_size)
+        original_shape = tuple(self._predictor.original_size)
+        self._predictor.reset_image()
+
+        output = self._decoder(torch.cat(batched_embeddings), input_shape, original_shape).cpu().numpy()
+        assert output.shape[1] == 3, f"{output.shape}"
+        return [
+            {"foreground": out[0], "center_distances": out[1], "boundary_distances": out[2]} for out in output
+        ]
+
+    def _get_smoothed(self, name, sigma):
+        # The smoothing of the decoder outputs only depends on the sigma value, so we cache the results.
+        # This avoids recomputing them for calls to generate that use the same smoothing, e.g. in grid search.
+        source = (self._foreground, self._center_distances, self._boundary_distances)
+        if self._smoothing_cache_source is None or any(
+            cached is not current for cached, current in zip(self._smoothing_cache_source, source)
+        ):
+            self._smoothing_cache, self._smoothing_cache_source = {}, source
+
+        key = (name, sigma)
+        if key not in self._smoothing_cache:
+            self._smoothing_cache[key] = vigra.filters.gaussianSmoothing(getattr(self, f"_{name}"), sigma)
+        return self._smoothing_cache[key]
+
     def _to_masks(self, segmentation, output_mode):
         if output_mode != "binary_mask":
             raise NotImplementedError
@@ -1102,19 +1335,25 @@ class InstanceSegmentationWithDecoder:
             raise RuntimeError("InstanceSegmentationWithDecoder has not been initialized. Call initialize first.")
 
         if foreground_smoothing > 0:
-            foreground = vigra.filters.gaussianSmoothing(self._foreground, foreground_smoothing)
+            foreground = self._get_smoothed("foreground", foreground_smoothing)
         else:
             foreground = self._foreground
 
         if tile_shape is None:
+            if distance_smoothing > 0:
+                center_distances = self._get_smoothed("center_distances", distance_smoothing)
+                boundary_distances = self._get_smoothed("boundary_distances", distance_smoothing)
+            else:
+                center_distances, boundary_distances = self._center_distances, self._boundary_distances
+            # The distances are already smoothed, so we don't smooth them again in the watershed.
             segmentation = watershed_from_center_and_boundary_distances(
-                center_distances=self._center_distances,
-                boundary_distances=self._boundary_distances,
+                center_distances=center_distances,
+                boundary_distances=boundary_distances,
                 foreground_map=foreground,
                 center_distance_threshold=center_distance_threshold,
                 boundary_distance_threshold=boundary_distance_threshold,
                 foreground_threshold=foreground_threshold,
-                distance_smoothing=distance_smoothing,
+                distance_smoothing=0,
                 min_size=min_size,
             )
         else:
@@ -1171,6 +1410,7 @@ class InstanceSegmentationWithDecoder:
         self._foreground = None
         self._center_distances = None
         self._boundary_distances = None
+        self._smoothing_cache, self._smoothing_cache_source = {}, None
         self._is_initialized = False
 
 
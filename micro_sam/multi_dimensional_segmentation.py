@@ -3,6 +3,8 @@
 
 import os
 import multiprocessing as mp
+from copy import copy
+from collections import deque
 from concurrent import futures
 from typing import Dict, List, Optional, Union, Tuple
 
@@ -10,7 +12,6 @@ import networkx as nx
 import nifty
 import numpy as np
 import torch
-from scipy.ndimage import binary_closing
 from skimage.measure import label, regionprops
 from skimage.segmentation import relabel_sequential
 
@@ -33,8 +34,11 @@ except ImportError:
 
 
 from . import util
-from .prompt_based_segmentation import segment_from_mask
-from .instance_segmentation import AMGBase, mask_data_to_segmentation
+from .prompt_based_segmentation import segment_from_mask, _segment_from_masks_batched
+from .instance_segmentation import (
+    AMGBase, InstanceSegmentationWithDecoder, TiledAutomaticMaskGenerator, TiledInstanceSegmentationWithDecoder,
+    mask_data_to_segmentation,
+)
 
 
 PROJECTION_MODES = ("box", "mask", "points", "points_and_mask", "single_point")
@@ -97,6 +101,100 @@ def _advanced_stopping_criteria(
     return criterion
 
 
+def _segment_mask_in_volume_batched(
+    segmentation, predictor, image_embeddings, segmented_slices, stop_lower, stop_upper, iou_threshold,
+    prompt_kwargs, use_single_point, update_progress, verbose,
+):
+    # The propagation fronts, which follow the same logic as 'segment_range' in 'segment_mask_in_volume'.
+    # Each front propagates the mask from slice 'z - increment' to slice 'z' until the stopping criterion is met.
+    fronts = []
+
+    def add_front(z_start, z_stop, increment, stopping_criterion, threshold=None):
+        fronts.append({
+            "z": z_start + increment, "z_stop": z_stop, "increment": increment,
+            "stopping_criterion": stopping_criterion, "threshold": threshold, "done": False,
+        })
+        return len(fronts) - 1
+
+    # The slices in the middle of ranges, which are segmented from the combined mask of the adjacent slices
+    # once the fronts that segment these slices are done.
+    middle_slices = []
+
+    z0, z1 = int(segmented_slices.min()), int(segmented_slices.max())
+    lower_front = add_front(z0, 0, -1, np.less, iou_threshold) if (z0 > 0 and not stop_lower) else None
+    upper_front = add_front(z1, segmentation.shape[0] - 1, 1, np.greater, iou_threshold) if (
+        z1 < segmentation.shape[0] - 1 and not stop_upper
+    ) else None
+
+    if z0 != z1:
+        for z_start, z_stop in zip(segmented_slices[:-1], segmented_slices[1:]):
+            z_start, z_stop = int(z_start), int(z_stop)
+            slice_diff = z_stop - z_start
+            z_mid = (z_start + z_stop) // 2
+
+            if slice_diff == 1:  # the slices are adjacent -> we don't need to do anything
+                pass
+            elif z_start == z0 and stop_lower:  # the lower slice is stop: we just segment from upper
+                add_front(z_stop, z_start, -1, np.less_equal)
+            elif z_stop == z1 and stop_upper:  # the upper slice is stop: we just segment from lower
+                add_front(z_start, z_stop, 1, np.greater_equal)
+            elif slice_diff == 2:  # there is only one slice in between -> use combined mask
+                middle_slices.append({"z": z_start + 1, "fronts": [], "done": False})
+            else:  # there is a range of more than 2 slices in between -> segment ranges from bottom and top
+                lower = add_front(z_start, z_mid, 1, np.greater_equal if slice_diff % 2 == 0 else np.greater)
+                upper = add_front(z_stop, z_mid, -1, np.less_equal)
+                if slice_diff % 2 == 0:
+                    middle_slices.append({"z": z_mid, "fronts": [lower, upper], "done": False})
+
+    while True:
+        active_fronts = [front for front in fronts if not front["done"]]
+        ready_slices = [
+            middle for middle in middle_slices
+            if not middle["done"] and all(fronts[front_id]["done"] for front_id in middle["fronts"])
+        ]
+        if len(active_fronts) == 0 and len(ready_slices) == 0:
+            break
+
+        masks = [segmentation[front["z"] - front["increment"]] for front in active_fronts]
+        masks += [
+            np.logical_or(segmentation[middle["z"] - 1] == 1, segmentation[middle["z"] + 1] == 1)
+            for middle in ready_slices
+        ]
+        slice_ids = [front["z"] for front in active_fronts] + [middle["z"] for middle in ready_slices]
+        if verbose:
+            print(f"Segmenting slices {slice_ids}")
+        results = _segment_from_masks_batched(
+            predictor, image_embeddings, masks, slice_ids,
+            use_single_point=[use_single_point] * len(active_fronts) + [False] * len(ready_slices), **prompt_kwargs,
+        )
+
+        for front, seg_prev, (seg_z, _) in zip(active_fronts, masks, results):
+            z = front["z"]
+            if front["threshold"] is not None:
+                iou = util.compute_iou(seg_prev, seg_z)
+                if iou < front["threshold"]:
+                    if verbose:
+                        print(f"Segmentation stopped at slice {z} due to IOU {iou} < {front['threshold']}.")
+                    front["done"] = True
+                    continue
+
+            segmentation[z] = seg_z
+            front["z"] = z + front["increment"]
+            if front["stopping_criterion"](front["z"], front["z_stop"]):
+                front["done"] = True
+                continue
+            update_progress(1)
+
+        for middle, (seg_z, _) in zip(ready_slices, results[len(active_fronts):]):
+            segmentation[middle["z"]] = seg_z
+            middle["done"] = True
+            update_progress(1)
+
+    z_min = z0 if lower_front is None else fronts[lower_front]["z"] + 1
+    z_max = z1 if upper_front is None else fronts[upper_front]["z"] - 1
+    return segmentation, (z_min, z_max)
+
+
 def segment_mask_in_volume(
     segmentation: np.ndarray,
     predictor: SamPredictor,
@@ -109,6 +207,7 @@ def segment_mask_in_volume(
     update_progress: Optional[callable] = None,
     box_extension: float = 0.0,
     verbose: bool = False,
+    batched_propagation: bool = False,
 ) -> Tuple[np.ndarray, Tuple[int, int]]:
     """Segment an object mask in in volumetric data.
 
@@ -126,6 +225,11 @@ def segment_mask_in_volume(
         box_extension: Extension factor for increasing the box size after projection.
             By default, does not increase the projected box size.
         verbose: Whether to print details about the segmentation steps. By default, set to 'True'.
+        batched_propagation: Whether to propagate the mask to the next slice for all propagation fronts at once,
+            i.e. upward and downward and within the ranges between segmented slices, in a single batched call
+            to the mask decoder. This gives the same result as the slice-by-slice propagation, but is much faster
+            if there are several fronts. Only supported for embeddings without tiling, otherwise the
+            slice-by-slice propagation is used. By default, set to 'False'.
 
     Returns:
         Array with the volumetric segmentation.
@@ -137,6 +241,13 @@ def segment_mask_in_volume(
         def update_progress(*args):
             pass
 
+    if batched_propagation and image_embeddings["input_size"] is not None:
+        return _segment_mask_in_volume_batched(
+            segmentation, predictor, image_embeddings, segmented_slices, stop_lower, stop_upper, iou_threshold,
+            dict(use_box=use_box, use_mask=use_mask, use_points=use_points, box_extension=box_extension),
+            use_single_point, update_progress, verbose,
+        )
+
     def segment_range(z_start, z_stop, increment, stopping_criterion, threshold=None, verbose=False):
         z = z_start + increment
         while True:
@@ -228,24 +339,47 @@ def segment_mask_in_volume(
     return segmentation, (z_min, z_max)
 
 
-def _preprocess_closing(slice_segmentation, gap_closing, pbar_update):
-    binarized = slice_segmentation > 0
-    # Use a structuring element that only closes elements in z, to avoid merging objects in-plane.
-    structuring_element = np.zeros((3, 1, 1))
-    structuring_element[:, 0, 0] = 1
-    closed_segmentation = binary_closing(binarized, iterations=gap_closing, structure=structuring_element)
+def _binary_closing_z(binarized, gap_closing):
+    # Binary closing that only operates in z, i.e. along the first axis. This is equivalent to
+    # scipy.ndimage.binary_closing with a (3, 1, 1) structuring element and 'gap_closing' iterations,
+    # but much faster, since dilation and erosion reduce to logical operations on shifted slices.
+    dilated = binarized.copy()
+    for shift in range(1, gap_closing + 1):
+        dilated[shift:] |= binarized[:-shift]
+        dilated[:-shift] |= binarized[shift:]
 
-    new_segmentation = np.zeros_like(slice_segmentation)
-    n_slices = new_segmentation.shape[0]
+    closed = dilated.copy()
+    for shift in range(1, gap_closing + 1):
+        closed[shift:] &= dilated[:-shift]
+        closed[:-shift] &= dilated[shift:]
+
+    # The erosion treats the border as background, so the first and last slices are not closed.
+    closed[:gap_closing] = False
+    closed[max(closed.shape[0] - gap_closing, 0):] = False
+    return closed
+
+
+def _preprocess_closing(slice_segmentation, gap_closing, pbar_update, n_threads=None, block_size=64):
+    n_threads = mp.cpu_count() if n_threads is None else n_threads
+    n_slices = slice_segmentation.shape[0]
+
+    # Apply the closing in z blockwise (over y) in parallel.
+    closed_segmentation = np.zeros(slice_segmentation.shape, dtype="bool")
+
+    def close_block(y_start):
+        bb = np.s_[:, y_start:y_start + block_size]
+        closed_segmentation[bb] = _binary_closing_z(slice_segmentation[bb] > 0, gap_closing)
+
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        list(tp.map(close_block, range(0, slice_segmentation.shape[1], block_size)))
 
-    def process_slice(z, offset):
+    # Process the slices independently, with consecutive local labels starting at 1.
+    def process_slice(z):
         seg_z = slice_segmentation[z]
 
         # Closing does not work for the first and last gap slices
         if z < gap_closing or z >= (n_slices - gap_closing):
-            seg_z, _, _ = relabel_sequential(seg_z, offset=offset)
-            offset = int(seg_z.max()) + 1
-            return seg_z, offset
+            return relabel_sequential(seg_z)[0]
 
         # Apply connected components to the closed segmentation.
         closed_z = label(closed_segmentation[z])
@@ -275,18 +409,25 @@ def _preprocess_closing(slice_segmentation, gap_closing, pbar_update):
             initial_mask = np.isin(seg_z, ids_initial)
             seg_new[initial_mask] = relabel_sequential(seg_z[initial_mask], offset=seg_new.max() + 1)[0]
 
-        seg_new, _, _ = relabel_sequential(seg_new, offset=offset)
-        max_z = seg_new.max()
-        if max_z > 0:
-            offset = int(max_z) + 1
+        return relabel_sequential(seg_new)[0]
 
-        return seg_new, offset
+    new_segmentation = np.zeros_like(slice_segmentation)
+    max_ids = np.zeros(n_slices, dtype="uint64")
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        for z, seg_z in enumerate(tp.map(process_slice, range(n_slices))):
+            new_segmentation[z] = seg_z
+            max_ids[z] = seg_z.max()
+            pbar_update(1)
 
-    # Further optimization: parallelize
-    offset = 1
-    for z in range(n_slices):
-        new_segmentation[z], offset = process_slice(z, offset)
-        pbar_update(1)
+    # Offset the local labels so that they are unique across slices.
+    offsets = np.concatenate([[0], np.cumsum(max_ids)[:-1]])
+
+    def apply_offset(z):
+        seg_z = new_segmentation[z]
+        seg_z[seg_z != 0] += offsets[z].astype(seg_z.dtype)
+
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        list(tp.map(apply_offset, range(1, n_slices)))
 
     return new_segmentation
 
@@ -304,6 +445,109 @@ def _filter_z_extent(segmentation, min_z_extent):
     return segmentation
 
 
+def _solve_merge_multicut(uv_ids, overlaps, n_nodes, beta, with_background):
+    graph = nifty.graph.undirectedGraph(n_nodes)
+    graph.insertEdges(uv_ids)
+
+    costs = seg_utils.multicut.compute_edge_costs(overlaps)
+    # Set background weights to be maximally repulsive.
+    if with_background:
+        bg_edges = (uv_ids == 0).any(axis=1)
+        costs[bg_edges] = -8.0
+
+    return seg_utils.multicut.multicut_decomposition(graph, 1.0 - costs, beta=beta)
+
+
+def _count_block_overlaps(slice_segmentation, block, n_slices):
+    # Read the block together with the next slice, to compute the overlaps with it.
+    z_stop = min(block.end[0] + 1, n_slices)
+    bb = (slice(block.begin[0], z_stop),) + tuple(slice(beg, end) for beg, end in zip(block.begin[1:], block.end[1:]))
+    seg = slice_segmentation[bb]
+    if seg.max() >= 2**32:
+        raise ValueError("The blockwise merge only supports segmentations with ids smaller than 2**32.")
+    seg = seg.astype("uint64")
+
+    # Compute the size and slice for all ids in the slices of this block (excluding the next slice).
+    ids, sizes, zs = [], [], []
+    for z in range(block.end[0] - block.begin[0]):
+        slice_ids, slice_sizes = np.unique(seg[z], return_counts=True)
+        ids.append(slice_ids)
+        sizes.append(slice_sizes)
+        zs.append(np.full(len(slice_ids), block.begin[0] + z))
+
+    # Compute the overlaps of objects in adjacent slices. We encode each pair of ids as a single integer.
+    pairs = []
+    for z in range(seg.shape[0] - 1):
+        seg_a, seg_b = seg[z], seg[z + 1]
+        mask = (seg_a != 0) & (seg_b != 0)
+        pairs.append((seg_a[mask] << np.uint64(32)) | seg_b[mask])
+    pairs, pair_counts = np.unique(np.concatenate(pairs) if pairs else np.zeros(0, "uint64"), return_counts=True)
+
+    return np.concatenate(ids), np.concatenate(sizes), np.concatenate(zs), pairs, pair_counts
+
+
+def _merge_instance_segmentation_3d_blockwise(
+    slice_segmentation, out, block_shape, n_threads, beta, with_background, min_z_extent, pbar_init, pbar_update,
+):
+    shape = slice_segmentation.shape
+    n_slices = shape[0]
+    blocking = nifty.tools.blocking([0, 0, 0], list(shape), list(block_shape))
+    n_blocks = blocking.numberOfBlocks
+    n_threads = mp.cpu_count() if n_threads is None else n_threads
+    pbar_init(2 * n_blocks + 1, "Merge segmentation")
+
+    # Compute the object sizes, slices and overlaps between adjacent slices blockwise.
+    def count_overlaps(block_id):
+        result = _count_block_overlaps(slice_segmentation, blocking.getBlock(block_id), n_slices)
+        pbar_update(1)
+        return result
+
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        results = list(tp.map(count_overlaps, range(n_blocks)))
+
+    # Accumulate the results of the blocks.
+    ids, sizes, zs, pairs, pair_counts = (np.concatenate(result) for result in zip(*results))
+    node_ids, node_index = np.unique(ids, return_inverse=True)
+    node_sizes = np.bincount(node_index, weights=sizes)
+
+    pairs, pair_index = np.unique(pairs, return_inverse=True)
+    pair_counts = np.bincount(pair_index, weights=pair_counts)
+    uv_ids = np.stack([pairs >> np.uint64(32), pairs & np.uint64(2**32 - 1)], axis=1).astype("uint64")
+
+    # The overlap is normalized by the size of the object in the lower slice.
+    overlaps = pair_counts / node_sizes[np.searchsorted(node_ids, uv_ids[:, 0])]
+
+    n_nodes = int(node_ids[-1]) + 1
+    node_labels = _solve_merge_multicut(uv_ids, overlaps, n_nodes, beta, with_background)
+
+    # Filter out merged objects with a small extent in z, based on the slices of the ids mapped to them.
+    if min_z_extent is not None and min_z_extent > 0:
+        merged_ids = node_labels[node_ids]
+        n_merged = int(merged_ids.max()) + 1
+        z_min, z_max = np.full(n_merged, n_slices), np.full(n_merged, -1)
+        np.minimum.at(z_min, merged_ids[node_index], zs)
+        np.maximum.at(z_max, merged_ids[node_index], zs)
+        filter_ids = np.where((z_max - z_min + 1 < min_z_extent) & (z_max >= 0))[0]
+        filter_ids = filter_ids[filter_ids != 0]
+        node_labels[np.isin(node_labels, filter_ids)] = 0
+    pbar_update(1)
+
+    # Write the merged segmentation blockwise.
+    if out is None:
+        out = np.zeros(shape, dtype=node_labels.dtype)
+
+    def write_block(block_id):
+        block = blocking.getBlock(block_id)
+        bb = tuple(slice(beg, end) for beg, end in zip(block.begin, block.end))
+        out[bb] = nifty.tools.take(node_labels, slice_segmentation[bb])
+        pbar_update(1)
+
+    with futures.ThreadPoolExecutor(n_threads) as tp:
+        list(tp.map(write_block, range(n_blocks)))
+
+    return out
+
+
 def merge_instance_segmentation_3d(
     slice_segmentation: np.ndarray,
     beta: float = 0.5,
@@ -313,6 +557,9 @@ def merge_instance_segmentation_3d(
     verbose: bool = True,
     pbar_init: Optional[callable] = None,
     pbar_update: Optional[callable] = None,
+    block_shape: Optional[Tuple[int, int, int]] = None,
+    n_threads: Optional[int] = None,
+    out: Optional[np.ndarray] = None,
 ) -> np.ndarray:
     """Merge stacked 2d instance segmentations into a consistent 3d segmentation.
 
@@ -335,15 +582,33 @@ def merge_instance_segmentation_3d(
             Can be used together with pbar_update to handle napari progress bar in other thread.
             To enables using this function within a threadworker.
         pbar_update: Callback to update an external progress bar.
+        block_shape: If given, the merge is computed blockwise with this block shape, without loading
+            the full segmentation into memory. This is intended for large chunked (zarr / n5) segmentations;
+            the block shape should be a multiple of their chunks. Gap closing is not supported in this case.
+        n_threads: The number of threads for the gap closing and the blockwise merge.
+            By default, all available cores are used.
+        out: The array for writing the merged segmentation. This can be a chunked array for the blockwise merge.
+            If not given, the merged segmentation is returned as a numpy array.
 
     Returns:
         The merged segmentation.
     """
+    if block_shape is not None and gap_closing is not None and gap_closing > 0:
+        raise ValueError("Gap closing is not supported for the blockwise merge.")
+
     _, pbar_init, pbar_update, pbar_close = util.handle_pbar(verbose, pbar_init, pbar_update)
 
+    if block_shape is not None:
+        segmentation = _merge_instance_segmentation_3d_blockwise(
+            slice_segmentation, out, block_shape, n_threads, beta, with_background, min_z_extent,
+            pbar_init, pbar_update,
+        )
+        pbar_close()
+        return segmentation
+
     if gap_closing is not None and gap_closing > 0:
         pbar_init(slice_segmentation.shape[0] + 1, "Merge segmentation")
-        slice_segmentation = _preprocess_closing(slice_segmentation, gap_closing, pbar_update)
+        slice_segmentation = _preprocess_closing(slice_segmentation, gap_closing, pbar_update, n_threads=n_threads)
     else:
         pbar_init(1, "Merge segmentation")
 
@@ -354,29 +619,58 @@ def merge_instance_segmentation_3d(
     overlaps = np.array([edge["score"] for edge in edges])
 
     n_nodes = int(slice_segmentation.max() + 1)
-    graph = nifty.graph.undirectedGraph(n_nodes)
-    graph.insertEdges(uv_ids)
-
-    costs = seg_utils.multicut.compute_edge_costs(overlaps)
-    # Set background weights to be maximally repulsive.
-    if with_background:
-        bg_edges = (uv_ids == 0).any(axis=1)
-        costs[bg_edges] = -8.0
-
-    node_labels = seg_utils.multicut.multicut_decomposition(graph, 1.0 - costs, beta=beta)
+    node_labels = _solve_merge_multicut(uv_ids, overlaps, n_nodes, beta, with_background)
 
     segmentation = nifty.tools.take(node_labels, slice_segmentation)
     if min_z_extent is not None and min_z_extent > 0:
         segmentation = _filter_z_extent(segmentation, min_z_extent)
 
+    if out is not None:
+        out[:] = segmentation
+        segmentation = out
+
     pbar_update(1)
     pbar_close()
 
     return segmentation
 
 
+def _initialize_slices(segmentor, data, image_embeddings, slice_ids, decoder_batch_size):
+    # Run the decoder (or prompt-based mask prediction) for a batch of slices and return their states.
+    # The instance segmentation decoder is batched over the slices, the tiled segmentors are batched over the tiles.
+    if type(segmentor) is InstanceSegmentationWithDecoder and decoder_batch_size > 1:
+        return segmentor._initialize_batched(image_embeddings, slice_ids)
+
+    if isinstance(segmentor, TiledInstanceSegmentationWithDecoder):
+        init_kwargs = {"batch_size": decoder_batch_size}
+    elif isinstance(segmentor, TiledAutomaticMaskGenerator):
+        init_kwargs = {"tile_batch_size": decoder_batch_size}
+    else:
+        init_kwargs = {}
+
+    states = []
+    for i in slice_ids:
+        segmentor.initialize(data[i], image_embeddings=image_embeddings, verbose=False, i=i, **init_kwargs)
+        states.append(segmentor.get_state())
+    return states
+
+
+def _generate_slice(segmentor, state, with_background, min_object_size, **kwargs):
+    # Work on a shallow copy of the segmentor, so that the state can be set independently for each slice.
+    segmentor = copy(segmentor)
+    segmentor.set_state(state)
+    seg = segmentor.generate(**kwargs)
+
+    if isinstance(seg, list) and len(seg) == 0:
+        return None
+    if isinstance(seg, list):
+        seg = mask_data_to_segmentation(seg, with_background=with_background, min_object_size=min_object_size)
+    return seg
+
+
 def _segment_slices(
-    data, predictor, segmentor, embedding_path, verbose, tile_shape, halo, with_background=True, batch_size=1, **kwargs
+    data, predictor, segmentor, embedding_path, verbose, tile_shape, halo, with_background=True, batch_size=1,
+    n_workers=1, decoder_batch_size=1, **kwargs
 ):
     assert data.ndim == 3
 
@@ -392,29 +686,50 @@ def _segment_slices(
         batch_size=batch_size,
     )
 
-    offset = 0
+    n_slices = data.shape[0]
     segmentation = np.zeros(data.shape, dtype="uint32")
+    max_ids = np.zeros(n_slices, dtype="uint64")
 
-    for i in tqdm(range(segmentation.shape[0]), desc="Segment slices", disable=not verbose):
-        segmentor.initialize(data[i], image_embeddings=image_embeddings, verbose=False, i=i)
-        seg = segmentor.generate(**kwargs)
-
-        if isinstance(seg, list) and len(seg) == 0:
-            continue
-        else:
-            if isinstance(seg, list):
-                seg = mask_data_to_segmentation(
-                    seg, with_background=with_background, min_object_size=min_object_size
-                )
-
-            # Set offset for instance per slice.
-            max_z = int(seg.max())
-            if max_z == 0:
-                continue
-            seg[seg != 0] += offset
-            offset = max_z + offset
-
+    def write_slice(i, seg):
+        if seg is None:
+            return
         segmentation[i] = seg
+        max_ids[i] = int(seg.max())
+
+    # The decoder predictions are computed in the main thread, the post-processing is run for n_workers slices
+    # in parallel. We limit the number of pending slices so that the decoder states don't accumulate in memory.
+    max_pending = 2 * n_workers
+    with futures.ThreadPoolExecutor(n_workers) as tp, tqdm(
+        total=n_slices, desc="Segment slices", disable=not verbose
+    ) as pbar:
+        pending = deque()
+        for batch_start in range(0, n_slices, decoder_batch_size):
+            slice_ids = list(range(batch_start, min(batch_start + decoder_batch_size, n_slices)))
+            states = _initialize_slices(segmentor, data, image_embeddings, slice_ids, decoder_batch_size)
+
+            for i, state in zip(slice_ids, states):
+                if n_workers == 1:
+                    write_slice(i, _generate_slice(segmentor, state, with_background, min_object_size, **kwargs))
+                    pbar.update(1)
+                    continue
+
+                pending.append((i, tp.submit(
+                    _generate_slice, segmentor, state, with_background, min_object_size, **kwargs
+                )))
+                while len(pending) > max_pending:
+                    i_done, future = pending.popleft()
+                    write_slice(i_done, future.result())
+                    pbar.update(1)
+
+        for i_done, future in pending:
+            write_slice(i_done, future.result())
+            pbar.update(1)
+
+    # Offset the instance ids per slice, so that they are unique across slices.
+    offsets = np.concatenate([[0], np.cumsum(max_ids)[:-1]])
+    for i in np.where((max_ids > 0) & (offsets > 0))[0]:
+        seg = segmentation[i]
+        seg[seg != 0] += np.uint32(offsets[i])
 
     return segmentation, image_embeddings
 
@@ -432,6 +747,8 @@ def automatic_3d_segmentation(
     verbose: bool = True,
     return_embeddings: bool = False,
     batch_size: int = 1,
+    n_workers: int = 1,
+    decoder_batch_size: int = 1,
     **kwargs,
 ) -> np.ndarray:
     """Automatically segment objects in a volume.
@@ -454,6 +771,10 @@ def automatic_3d_segmentation(
         verbose: Verbosity flag. By default, set to 'True'.
         return_embeddings: Whether to return the precomputed image embeddings. By default, set to 'False'.
         batch_size: The batch size to compute image embeddings over planes. By default, set to '1'.
+        n_workers: The number of threads for running the per-slice post-processing in parallel.
+            By default, set to '1'.
+        decoder_batch_size: The number of slices for which the decoder is run together.
+            For tiled segmentation the tiles of each slice are batched instead. By default, set to '1'.
         kwargs: Keyword arguments for the 'generate' method of the 'segmentor'.
 
     Returns:
@@ -469,6 +790,8 @@ def automatic_3d_segmentation(
         halo=halo,
         with_background=with_background,
         batch_size=batch_size,
+        n_workers=n_workers,
+        decoder_batch_size=decoder_batch_size,
         **kwargs
     )
     segmentation = merge_instance_segmentation_3d(
@@ -658,6 +981,8 @@ def automatic_tracking_implementation(
     return_embeddings: bool = False,
     batch_size: int = 1,
     output_folder: Optional[Union[os.PathLike, str]] = None,
+    n_workers: int = 1,
+    decoder_batch_size: int = 1,
     **kwargs,
 ) -> Tuple[np.ndarray, List[Dict]]:
     """Automatically track objects in a timesries based on per-frame automatic segmentation.
@@ -679,6 +1004,10 @@ def automatic_tracking_implementation(
         return_embeddings: Whether to return the precomputed image embeddings. By default, set to 'False'.
         batch_size: The batch size to compute image embeddings over planes. By default, set to '1'.
         output_folder: The folder where the tracking results are stored in CTC format.
+        n_workers: The number of threads for running the per-frame post-processing in parallel.
+            By default, set to '1'.
+        decoder_batch_size: The number of frames for which the decoder is run together.
+            For tiled segmentation the tiles of each frame are batched instead. By default, set to '1'.
         kwargs: Keyword arguments for the 'generate' method of the 'segmentor'.
 
     Returns:
@@ -695,6 +1024,7 @@ def automatic_tracking_implementation(
     segmentation, image_embeddings = _segment_slices(
         timeseries, predictor, segmentor, embedding_path, verbose,
         tile_shape=tile_shape, halo=halo, batch_size=batch_size,
+        n_workers=n_workers, decoder_batch_size=decoder_batch_size,
         **kwargs,
     )
 
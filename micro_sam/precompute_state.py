@@ -3,6 +3,7 @@
 
 import os
 import pickle
+from concurrent import futures
 from glob import glob
 from pathlib import Path
 from functools import partial
@@ -24,6 +25,37 @@ except ImportError:
 from . import instance_segmentation, util
 
 
+def _write_amg_state(save_path, amg_state):
+    # Store the (compact) AMG state as flat numpy arrays, which is much faster to (de)serialize than pickle.
+    arrays = {
+        "crop_boxes": np.array(amg_state["crop_boxes"], dtype="int64"),
+        "original_size": np.array(amg_state["original_size"], dtype="int64"),
+    }
+    for crop_id, crop_data in enumerate(amg_state["crop_list"]):
+        for key, val in crop_data.items():
+            arrays[f"crop-{crop_id}-{key}"] = val
+    with open(save_path, "wb") as f:
+        np.savez(f, **arrays)
+
+
+def _read_amg_state(save_path):
+    # AMG states that were cached with older versions are stored as pickle.
+    if not save_path.endswith(".npz"):
+        with open(save_path, "rb") as f:
+            amg_state = pickle.load(f)
+        return amg_state
+
+    with np.load(save_path) as f:
+        crop_boxes = f["crop_boxes"].tolist()
+        original_size = tuple(f["original_size"].tolist())
+        crop_list = [{} for _ in crop_boxes]
+        for name in f.files:
+            if name.startswith("crop-"):
+                _, crop_id, key = name.split("-", 2)
+                crop_list[int(crop_id)][key] = f[name]
+    return {"crop_list": crop_list, "crop_boxes": crop_boxes, "original_size": original_size}
+
+
 def cache_amg_state(
     predictor: SamPredictor,
     raw: np.ndarray,
@@ -39,7 +71,7 @@ def cache_amg_state(
         predictor: The Segment Anything predictor.
         raw: The image data.
         image_embeddings: The image embeddings.
-        save_path: The embedding save path. The AMG state will be stored in 'save_path/amg_state.pickle'.
+        save_path: The embedding save path. The AMG state will be stored in 'save_path/amg_state.npz'.
         verbose: Whether to run the computation verbose. By default, set to 'True'.
         i: The index for which to cache the state.
         kwargs: The keyword arguments for the amg class.
@@ -53,36 +85,26 @@ def cache_amg_state(
     # If i is given we compute the state for a given slice/frame.
     # And we have to save the state for slices/frames separately.
     if i is None:
-        save_path_amg = os.path.join(save_path, "amg_state.pickle")
+        save_path_amg = os.path.join(save_path, "amg_state.npz")
+        legacy_save_path_amg = os.path.join(save_path, "amg_state.pickle")
     else:
         os.makedirs(os.path.join(save_path, "amg_state"), exist_ok=True)
-        save_path_amg = os.path.join(save_path, "amg_state", f"state-{i}.pkl")
+        save_path_amg = os.path.join(save_path, "amg_state", f"state-{i}.npz")
+        legacy_save_path_amg = os.path.join(save_path, "amg_state", f"state-{i}.pkl")
 
-    if os.path.exists(save_path_amg):
-        if verbose:
-            print("Load the AMG state from", save_path_amg)
-        with open(save_path_amg, "rb") as f:
-            amg_state = pickle.load(f)
-        amg.set_state(amg_state)
-        return amg
+    for load_path in (save_path_amg, legacy_save_path_amg):
+        if os.path.exists(load_path):
+            if verbose:
+                print("Load the AMG state from", load_path)
+            amg.set_state(_read_amg_state(load_path))
+            return amg
 
     if verbose:
         print("Precomputing the state for instance segmentation.")
 
     amg.initialize(raw if i is None else raw[i], image_embeddings=image_embeddings, verbose=verbose, i=i)
-    amg_state = amg.get_state()
-
-    # put all state onto the cpu so that the state can be deserialized without a gpu
-    new_crop_list = []
-    for mask_data in amg_state["crop_list"]:
-        for k, v in mask_data.items():
-            if torch.is_tensor(v):
-                mask_data[k] = v.cpu()
-        new_crop_list.append(mask_data)
-    amg_state["crop_list"] = new_crop_list
-
-    with open(save_path_amg, "wb") as f:
-        pickle.dump(amg_state, f)
+    # The state only consists of numpy arrays, so it can be deserialized without a gpu.
+    _write_amg_state(save_path_amg, amg.get_state())
 
     return amg
 
@@ -105,7 +127,8 @@ def cache_is_state(
         decoder: The instance segmentation decoder.
         raw: The image data.
         image_embeddings: The image embeddings.
-        save_path: The embedding save path. The AMG state will be stored in 'save_path/amg_state.pickle'.
+        save_path: The embedding save path. The instance segmentation state will be stored in
+            'save_path/is_state.h5'.
         verbose: Whether to run the computation verbose. By default, set to 'True'.
         i: The index for which to cache the state.
         skip_load: Skip loading the state if it is precomputed. By default, set to 'False'.
@@ -154,7 +177,8 @@ def cache_is_state(
 
 
 def _precompute_state_for_file(
-    predictor, input_path, output_path, key, ndim, tile_shape, halo, precompute_amg_state, decoder, verbose
+    predictor, input_path, output_path, key, ndim, tile_shape, halo, precompute_amg_state, decoder, verbose,
+    storage_dtype="float32", compression="gzip", devices=None,
 ):
     if isinstance(input_path, np.ndarray):
         image_data = input_path
@@ -164,7 +188,8 @@ def _precompute_state_for_file(
     # Precompute the image embeddings.
     output_path = Path(output_path).with_suffix(".zarr")
     embeddings = util.precompute_image_embeddings(
-        predictor, image_data, output_path, ndim=ndim, tile_shape=tile_shape, halo=halo, verbose=verbose
+        predictor, image_data, output_path, ndim=ndim, tile_shape=tile_shape, halo=halo, verbose=verbose,
+        storage_dtype=storage_dtype, compression=compression, devices=devices,
     )
 
     # Precompute the state for automatic instance segmnetaiton (AMG or AIS).
@@ -190,6 +215,11 @@ def _precompute_state_for_file(
                 cache_function(raw=image_data, i=i, verbose=False)
 
 
+def _precompute_state_for_file_in_worker(input_path, output_path, **kwargs):
+    predictor, decoder = util._WORKER["predictor"], util._WORKER["decoder"]
+    _precompute_state_for_file(predictor, input_path, output_path, decoder=decoder, verbose=False, **kwargs)
+
+
 def _precompute_state_for_files(
     predictor: SamPredictor,
     input_files: Union[List[Union[os.PathLike, str]], List[np.ndarray]],
@@ -200,23 +230,38 @@ def _precompute_state_for_files(
     halo: Optional[Tuple[int, int]] = None,
     precompute_amg_state: bool = False,
     decoder: Optional["nn.Module"] = None,
+    storage_dtype: str = "float32",
+    compression: str = "gzip",
+    devices: Optional[List[Union[str, torch.device]]] = None,
 ):
     os.makedirs(output_path, exist_ok=True)
-    idx = 0
-    for file_path in tqdm(input_files, total=len(input_files), desc="Precompute state for files"):
+    out_paths = [
+        os.path.join(output_path, f"embedding_{idx:05}.tif") if isinstance(file_path, np.ndarray)
+        else os.path.join(output_path, os.path.basename(file_path))
+        for idx, file_path in enumerate(input_files)
+    ]
+    state_kwargs = dict(
+        key=key, ndim=ndim, tile_shape=tile_shape, halo=halo, precompute_amg_state=precompute_amg_state,
+        storage_dtype=storage_dtype, compression=compression,
+    )
 
-        if isinstance(file_path, np.ndarray):
-            out_path = os.path.join(output_path, f"embedding_{idx:05}.tif")
-        else:
-            out_path = os.path.join(output_path, os.path.basename(file_path))
+    if devices is None:
+        for file_path, out_path in tqdm(
+            zip(input_files, out_paths), total=len(input_files), desc="Precompute state for files"
+        ):
+            _precompute_state_for_file(
+                predictor, file_path, out_path, decoder=decoder, verbose=False, **state_kwargs
+            )
+        return
 
-        _precompute_state_for_file(
-            predictor, file_path, out_path,
-            key=key, ndim=ndim, tile_shape=tile_shape, halo=halo,
-            precompute_amg_state=precompute_amg_state, decoder=decoder,
-            verbose=False,
-        )
-        idx += 1
+    # Split the files across one worker process per device.
+    with util._get_embedding_workers(predictor, devices, decoder=decoder) as workers:
+        tasks = [
+            workers.submit(_precompute_state_for_file_in_worker, file_path, out_path, **state_kwargs)
+            for file_path, out_path in zip(input_files, out_paths)
+        ]
+        for task in tqdm(futures.as_completed(tasks), total=len(tasks), desc="Precompute state for files"):
+            task.result()
 
 
 def precompute_state(
@@ -230,6 +275,9 @@ def precompute_state(
     tile_shape: Optional[Tuple[int, int]] = None,
     halo: Optional[Tuple[int, int]] = None,
     precompute_amg_state: bool = False,
+    storage_dtype: str = "float32",
+    compression: str = "gzip",
+    devices: Optional[List[Union[str, torch.device]]] = None,
 ) -> None:
     """Precompute the image embeddings and other optional state for the input image(s).
 
@@ -250,6 +298,14 @@ def precompute_state(
         halo: Overlap of the tiles for tiled prediction. By default prediction is run without tiling.
         precompute_amg_state: Whether to precompute the state for automatic instance segmentation
             in addition to the image embeddings.
+        storage_dtype: The data type for storing the embeddings. One of 'float32', 'float16', 'bfloat16' or 'int8'.
+            By default, set to 'float32'.
+        compression: The compression for storing the embeddings. One of 'gzip', 'lz4' or 'zstd'.
+            By default, set to 'gzip'.
+        devices: The devices for computing the embeddings in parallel, with one worker process per device.
+            For a folder the files are split across the workers, otherwise the slices or tiles of the input.
+            The same device can be given several times, e.g. ['cpu', 'cpu'] for two worker processes on the CPU.
+            By default, set to 'None', i.e. the embeddings are computed in this process.
     """
     predictor, state = util.get_sam_model(model_type=model_type, checkpoint_path=checkpoint_path, return_state=True)
 
@@ -265,6 +321,7 @@ def precompute_state(
             ndim=ndim, tile_shape=tile_shape, halo=halo,
             precompute_amg_state=precompute_amg_state,
             decoder=decoder, verbose=True,
+            storage_dtype=storage_dtype, compression=compression, devices=devices,
         )
     else:
         input_files = glob(os.path.join(input_path, pattern))
@@ -272,7 +329,7 @@ def precompute_state(
             predictor, input_files, output_path, key=key,
             ndim=ndim, tile_shape=tile_shape, halo=halo,
             precompute_amg_state=precompute_amg_state,
-            decoder=decoder,
+            decoder=decoder, storage_dtype=storage_dtype, compression=compression, devices=devices,
         )
 
 
@@ -323,6 +380,20 @@ def main():
         "-p", "--precompute_amg_state", action="store_true",
         help="Whether to precompute the state for automatic instance segmentation."
     )
+    parser.add_argument(
+        "--storage_dtype", default="float32", choices=util._STORAGE_DTYPES,
+        help="The data type for storing the embeddings. Reduced precision (e.g. 'float16' or 'int8') "
+        "decreases the size of the embedding files at a small loss of accuracy."
+    )
+    parser.add_argument(
+        "--compression", default="gzip", choices=util._COMPRESSIONS,
+        help="The compression for storing the embeddings. 'lz4' and 'zstd' are faster than 'gzip'."
+    )
+    parser.add_argument(
+        "--devices", nargs="+", default=None,
+        help="The devices for computing the embeddings in parallel, with one worker process per device, "
+        "e.g. 'cuda:0 cuda:1'. The same device can be given several times, e.g. 'cpu cpu'."
+    )
 
     args = parser.parse_args()
     precompute_state(
@@ -331,6 +402,7 @@ def main():
         pattern=args.pattern, key=args.key,
         tile_shape=args.tile_shape, halo=args.halo, ndim=args.ndim,
         precompute_amg_state=args.precompute_amg_state,
+        storage_dtype=args.storage_dtype, compression=args.compression, devices=args.devices,
     )
 
 
@@ -2,6 +2,7 @@
 """
 
 import warnings
+from collections import namedtuple
 from typing import Optional, Tuple
 
 import numpy as np
@@ -246,6 +247,378 @@ def _tile_to_full_mask(mask, shape, tile):
     return full_mask
 
 
+def _process_outputs(mask, scores, logits, shape, tile, return_all, return_local_mask):
+    # Return the mask for the tile (or for the full image without tiling) together with its bounding box.
+    # This avoids allocating a mask of the full image size for each prediction with tiled embeddings.
+    if return_local_mask:
+        if tile is None:
+            bb = tuple(slice(0, sh) for sh in mask.shape[1:])
+        else:
+            bb = tuple(slice(beg, end) for beg, end in zip(tile.begin, tile.end))
+        outputs = (mask, bb)
+    else:
+        outputs = (mask if tile is None else _tile_to_full_mask(mask, shape, tile),)
+
+    if return_all:
+        outputs = outputs + (scores, logits)
+    return outputs[0] if len(outputs) == 1 else outputs
+
+
+# The bounding box of the tiles used for segmentation across tiles, which is used like a tile in '_process_outputs'.
+_Block = namedtuple("_Block", ["begin", "end"])
+
+
+def _is_tiled(image_embeddings):
+    return image_embeddings is not None and image_embeddings["input_size"] is None
+
+
+# Weights for blending the predictions of overlapping tiles: the weight is one inside of the tile
+# and decreases linearly towards the border of the tile in the halo.
+def _get_blending_weights(inner_block, outer_block):
+    weights = []
+    for inner_begin, inner_end, outer_begin, outer_end in zip(
+        inner_block.begin, inner_block.end, outer_block.begin, outer_block.end
+    ):
+        axis_weights = np.ones(outer_end - outer_begin, dtype="float32")
+        halo_begin, halo_end = inner_begin - outer_begin, outer_end - inner_end
+        if halo_begin > 0:
+            axis_weights[:halo_begin] = np.arange(1, halo_begin + 1) / (halo_begin + 1)
+        if halo_end > 0:
+            axis_weights[-halo_end:] = np.arange(halo_end, 0, -1) / (halo_end + 1)
+        weights.append(axis_weights)
+    return weights[0][:, None] * weights[1][None, :]
+
+
+# Bring the prompts to a tile and compute the precomputed features for it.
+# Returns 'None' if none of the prompts are contained in the tile.
+def _get_tile_prompts(predictor, image_embeddings, i, tiling, halo, tile_id, points, labels, box, mask):
+    inner_block = tiling.getBlock(tile_id)
+    outer_block = tiling.getBlockWithHalo(tile_id, list(halo)).outerBlock
+    offset, this_tile_shape = np.array(outer_block.begin), np.array(outer_block.shape)
+
+    tile_points, tile_labels = None, None
+    if points is not None:
+        tile_points = points - offset[::-1]
+        valid_points = np.logical_and(
+            (tile_points >= 0).all(axis=1), (tile_points < this_tile_shape[::-1]).all(axis=1)
+        )
+        if valid_points.any():
+            tile_points, tile_labels = tile_points[valid_points], labels[valid_points]
+        else:
+            tile_points = None
+
+    tile_box = None
+    if box is not None:
+        tile_box = np.clip(box - np.tile(offset[::-1], 2), 0, np.tile(this_tile_shape[::-1], 2))
+        if tile_box[2] <= tile_box[0] or tile_box[3] <= tile_box[1]:
+            tile_box = None
+
+    tile_logits = None
+    if mask is not None:
+        tile_mask = mask[tuple(slice(beg, end) for beg, end in zip(outer_block.begin, outer_block.end))]
+        if tile_mask.sum() != 0:
+            tile_logits = _compute_logits_from_mask(tile_mask)
+
+    if tile_points is None and tile_box is None and tile_logits is None:
+        return None
+
+    util.set_precomputed(predictor, image_embeddings, i, tile_id=tile_id)
+    original_size, input_size = predictor.original_size, predictor.input_size
+    if tile_points is not None:
+        tile_points = predictor.transform.apply_coords(tile_points, original_size)
+    if tile_box is not None:
+        tile_box = predictor.transform.apply_boxes(tile_box, original_size)
+
+    return (predictor.features, tile_points, tile_labels, tile_box, tile_logits, inner_block, outer_block, input_size)
+
+
+# Decode the prompts of several tiles, grouped by prompt types, in batched calls to the mask decoder.
+# This uses the same approach as '_segment_from_masks_batched'.
+def _decode_tile_prompts(model, device, prompts, multimask_output):
+    groups = {}
+    for idx, (_, tile_points, _, tile_box, tile_logits, *_) in enumerate(prompts):
+        group_key = (None if tile_points is None else len(tile_points), tile_box is None, tile_logits is None)
+        groups.setdefault(group_key, []).append(idx)
+
+    image_pe = model.prompt_encoder.get_dense_pe()
+    low_res_masks, scores = [None] * len(prompts), [None] * len(prompts)
+    for group in groups.values():
+        group_features, group_points, group_labels, group_boxes, group_logits = zip(
+            *[prompts[idx][:5] for idx in group]
+        )
+
+        def _to_tensor(values, dtype):
+            return None if values[0] is None else torch.as_tensor(np.stack(values), dtype=dtype, device=device)
+
+        group_points, group_labels = _to_tensor(group_points, torch.float), _to_tensor(group_labels, torch.int)
+        group_boxes, group_logits = _to_tensor(group_boxes, torch.float), _to_tensor(group_logits, torch.float)
+        group_features = torch.cat(group_features)
+
+        sparse_embeddings, dense_embeddings = model.prompt_encoder(
+            points=None if group_points is None else (group_points, group_labels),
+            boxes=group_boxes, masks=group_logits,
+        )
+        group_masks, group_scores = model.mask_decoder(
+            image_embeddings=torch.zeros_like(group_features[:1]),
+            image_pe=image_pe,
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings + group_features,
+            multimask_output=multimask_output,
+        )
+        for k, idx in enumerate(group):
+            low_res_masks[idx], scores[idx] = group_masks[k:k+1], group_scores[k].cpu().numpy()
+    return low_res_masks, scores
+
+
+# Stitch the logits of the tiles with a weighted average in the overlapping regions.
+def _stitch_tile_logits(model, prompts, low_res_masks):
+    bb_begin = [min(prompt[6].begin[axis] for prompt in prompts) for axis in range(2)]
+    bb_end = [max(prompt[6].end[axis] for prompt in prompts) for axis in range(2)]
+    n_masks = low_res_masks[0].shape[1]
+    stitched_logits = np.zeros((n_masks,) + tuple(end - beg for beg, end in zip(bb_begin, bb_end)), dtype="float32")
+    stitched_weights = np.zeros(stitched_logits.shape[1:], dtype="float32")
+    for (*_, inner_block, outer_block, input_size), tile_masks in zip(prompts, low_res_masks):
+        tile_logits = model.postprocess_masks(tile_masks, input_size, tuple(outer_block.shape))[0].cpu().numpy()
+        weights = _get_blending_weights(inner_block, outer_block)
+        bb = tuple(slice(beg - offset, end - offset) for beg, end, offset in zip(
+            outer_block.begin, outer_block.end, bb_begin
+        ))
+        stitched_logits[(slice(None),) + bb] += weights * tile_logits
+        stitched_weights[bb] += weights
+    covered = stitched_weights > 0
+    stitched_logits[:, covered] /= stitched_weights[covered]
+    return stitched_logits, covered, bb_begin, bb_end
+
+
+# Find the tiles that are not used yet, but that the stitched object extends into via the halo of the used tiles.
+# Returns the new tile ids together with a positive point for each, at the maximal logit of the object in the tile.
+def _find_extended_tiles(tiling, used_tiles, logits, covered, bb_begin, bb_end, threshold):
+    extended_tiles = []
+    for tile_id in range(tiling.numberOfBlocks):
+        if tile_id in used_tiles:
+            continue
+        inner_block = tiling.getBlock(tile_id)
+        # The part of the inner block of this tile that is covered by the halo of the used tiles.
+        overlap_begin = [max(beg, offset) for beg, offset in zip(inner_block.begin, bb_begin)]
+        overlap_end = [min(end, stop) for end, stop in zip(inner_block.end, bb_end)]
+        if any(beg >= end for beg, end in zip(overlap_begin, overlap_end)):
+            continue
+        bb = tuple(slice(beg - offset, end - offset) for beg, end, offset in zip(overlap_begin, overlap_end, bb_begin))
+        tile_logits = np.where(covered[bb], logits[bb], -np.inf)
+        if tile_logits.max() <= threshold:
+            continue
+        point = np.unravel_index(np.argmax(tile_logits), tile_logits.shape)
+        # The point is returned in XY convention, as expected by SAM.
+        extended_tiles.append((tile_id, np.array([point[1] + overlap_begin[1], point[0] + overlap_begin[0]])))
+    return extended_tiles
+
+
+# Segment an object from prompts in all tiles that overlap with the prompts.
+# The prompts are decoded for all tiles in a single batch and the logits of the tiles are stitched,
+# using a weighted average in the overlapping halo regions.
+# For point prompts (without a box or mask) the extent of the object is not known in advance. In this case
+# the object is also segmented in the neighboring tiles it extends into, until it is contained in the used tiles.
+# The prompts are given in the full image: points in XY convention, the box in XYXY format and the mask
+# as a binary mask of the image shape. Returns the mask (or logits), the scores and the block of the used tiles.
+@torch.no_grad()
+def _segment_across_tiles(
+    predictor, image_embeddings, i, points=None, labels=None, box=None, mask=None,
+    multimask_output=False, use_best_multimask=False, return_logits=False,
+):
+    model, device = predictor.model, predictor.device
+    features = image_embeddings["features"]
+    shape, tile_shape, halo = features.attrs["shape"], features.attrs["tile_shape"], features.attrs["halo"]
+    tiling = blocking([0, 0], shape, tile_shape)
+
+    # Determine the region covered by the prompts, given by positive points, the box and the mask.
+    # The region is given by its begin and (exclusive) end for each prompt.
+    region_begins, region_ends = [], []
+    if points is not None:
+        positive_points = points[labels == 1] if (labels == 1).any() else points
+        positive_points = np.floor(positive_points[:, ::-1]).astype("int")
+        region_begins.append(positive_points.min(axis=0))
+        region_ends.append(positive_points.max(axis=0) + 1)
+    if box is not None:
+        region_begins.append(np.floor([box[1], box[0]]).astype("int"))
+        region_ends.append(np.ceil([box[3], box[2]]).astype("int"))
+    if mask is not None and mask.sum() != 0:
+        mask_coords = np.where(mask)
+        region_begins.append(np.array([mask_coords[0].min(), mask_coords[1].min()]))
+        region_ends.append(np.array([mask_coords[0].max(), mask_coords[1].max()]) + 1)
+    if len(region_begins) == 0:
+        raise ValueError("Segmentation across tiles requires a point, box or non-empty mask prompt.")
+    region_begin = np.clip(np.min(region_begins, axis=0), 0, np.array(shape) - 1)
+    region_end = np.clip(np.max(region_ends, axis=0), 1, np.array(shape))
+
+    # Bring the prompts to all tiles that overlap with this region.
+    prompts, tile_ids = [], []
+    for tile_id in range(tiling.numberOfBlocks):
+        inner_block = tiling.getBlock(tile_id)
+        if any(beg >= region_stop or end <= region_start for beg, end, region_start, region_stop in zip(
+            inner_block.begin, inner_block.end, region_begin, region_end
+        )):
+            continue
+        tile_prompts = _get_tile_prompts(
+            predictor, image_embeddings, i, tiling, halo, tile_id, points, labels, box, mask
+        )
+        if tile_prompts is not None:
+            prompts.append(tile_prompts)
+            tile_ids.append(tile_id)
+
+    if len(prompts) == 0:
+        predictor.reset_image()
+        raise ValueError("The prompts for segmentation across tiles are not contained in any tile.")
+
+    # Decode the prompts and stitch the logits. For point prompts we repeat this with the tiles
+    # that the object extends into, until the object does not extend into further tiles.
+    multimask_output_ = multimask_output or use_best_multimask
+    extend_tiles = box is None and mask is None
+    low_res_masks, scores = _decode_tile_prompts(model, device, prompts, multimask_output_)
+    while True:
+        stitched_logits, covered, bb_begin, bb_end = _stitch_tile_logits(model, prompts, low_res_masks)
+        if not extend_tiles:
+            break
+
+        mask_id = int(np.argmax(np.mean(scores, axis=0))) if use_best_multimask else 0
+        extended_tiles = _find_extended_tiles(
+            tiling, tile_ids, stitched_logits[mask_id], covered, bb_begin, bb_end, model.mask_threshold,
+        )
+        if len(extended_tiles) == 0:
+            break
+
+        new_prompts = []
+        for tile_id, point in extended_tiles:
+            tile_prompts = _get_tile_prompts(
+                predictor, image_embeddings, i, tiling, halo, tile_id,
+                np.concatenate([points, point[None]]), np.concatenate([labels, [1]]), None, None,
+            )
+            new_prompts.append(tile_prompts)
+            tile_ids.append(tile_id)
+        new_masks, new_scores = _decode_tile_prompts(model, device, new_prompts, multimask_output_)
+        prompts, low_res_masks, scores = prompts + new_prompts, low_res_masks + new_masks, scores + new_scores
+    predictor.reset_image()
+
+    scores = np.mean(scores, axis=0)
+    if use_best_multimask:
+        best_mask_id = np.argmax(scores)
+        stitched_logits, scores = stitched_logits[best_mask_id][None], scores[best_mask_id][None]
+
+    mask = stitched_logits if return_logits else np.logical_and(stitched_logits > model.mask_threshold, covered)
+    return mask, scores, _Block([int(beg) for beg in bb_begin], [int(end) for end in bb_end]), shape
+
+
+# Predict the masks for several prompts with batched calls to the mask decoder.
+# The predictor must already be initialized, e.g. via util.set_precomputed.
+# The boxes are given in XYXY format and the points in XY convention, i.e. as expected by SAM.
+# Each prompt must have the same number of points. For 'use_best_multimask' the mask with the best score is chosen.
+@torch.no_grad()
+def _predict_batched(
+    predictor, boxes=None, points=None, labels=None, mask_inputs=None, use_best_multimask=False, batch_size=64,
+):
+    device, original_size = predictor.device, predictor.original_size
+    n_prompts = len(boxes) if boxes is not None else len(points)
+
+    if boxes is not None:
+        boxes = predictor.transform.apply_boxes(np.asarray(boxes), original_size)
+        boxes = torch.as_tensor(boxes, dtype=torch.float, device=device)
+    if points is not None:
+        points = predictor.transform.apply_coords(np.asarray(points, dtype="float64"), original_size)
+        points = torch.as_tensor(points, dtype=torch.float, device=device)
+        labels = torch.as_tensor(np.asarray(labels), dtype=torch.int, device=device)
+    if mask_inputs is not None:
+        mask_inputs = torch.as_tensor(np.stack(mask_inputs), dtype=torch.float, device=device)
+
+    masks = []
+    for start in range(0, n_prompts, batch_size):
+        batch = slice(start, start + batch_size)
+        batch_masks, batch_scores, _ = predictor.predict_torch(
+            point_coords=None if points is None else points[batch],
+            point_labels=None if labels is None else labels[batch],
+            boxes=None if boxes is None else boxes[batch],
+            mask_input=None if mask_inputs is None else mask_inputs[batch],
+            multimask_output=use_best_multimask,
+        )
+        if use_best_multimask:
+            best_mask_ids = batch_scores.argmax(dim=1)
+            batch_masks = batch_masks[torch.arange(len(batch_masks), device=batch_masks.device), best_mask_ids]
+        else:
+            batch_masks = batch_masks[:, 0]
+        masks.append(batch_masks.cpu().numpy())
+
+    return np.concatenate(masks)
+
+
+# Segment from mask prompts in different slices of a volume with batched calls to the mask decoder.
+# This matches calling 'segment_from_mask' for each mask and slice, but only supports embeddings without tiling.
+# The mask decoder only supports a single image embedding, which it repeats for all prompts and adds
+# to the dense prompt embeddings. Instead, we add the embedding of the slice of each prompt to its
+# dense prompt embedding and pass an image embedding of zeros, which gives the same result.
+# Prompts can only be batched if they have the same prompt types and number of points, so we group them accordingly.
+@torch.no_grad()
+def _segment_from_masks_batched(
+    predictor, image_embeddings, masks, slice_ids, use_box=True, use_mask=True, use_points=False,
+    box_extension=0.0, use_single_point=False,
+):
+    model, device = predictor.model, predictor.device
+    use_single_point = [use_single_point] * len(masks) if isinstance(use_single_point, bool) else use_single_point
+
+    prompts, groups = [], {}
+    for idx, (mask, z, single_point) in enumerate(zip(masks, slice_ids, use_single_point)):
+        util.set_precomputed(predictor, image_embeddings, i=z)
+        original_size, input_size = predictor.original_size, predictor.input_size
+
+        have_mask = mask.sum() != 0
+        if use_points and have_mask:
+            points, labels = _compute_points_from_mask(
+                mask, original_size=None, box_extension=box_extension, use_single_point=single_point,
+            )
+            points = predictor.transform.apply_coords(points, original_size)
+        else:
+            points, labels = None, None
+        box = _compute_box_from_mask(mask, box_extension=box_extension) if use_box and have_mask else None
+        if box is not None:
+            box = predictor.transform.apply_boxes(box, original_size)
+        logits = _compute_logits_from_mask(mask) if use_mask else None
+
+        prompts.append((predictor.features, points, labels, box, logits))
+        group_key = (None if points is None else len(points), box is None, logits is None)
+        # Prompts without any point, box or mask can't be batched, because the prompt encoder
+        # would then treat them as a single prompt.
+        if group_key == (None, True, True):
+            group_key = idx
+        groups.setdefault(group_key, []).append(idx)
+    predictor.reset_image()
+
+    image_pe = model.prompt_encoder.get_dense_pe()
+    results = [None] * len(masks)
+    for group in groups.values():
+        features, points, labels, boxes, logits = zip(*[prompts[idx] for idx in group])
+
+        def _to_tensor(values, dtype):
+            return None if values[0] is None else torch.as_tensor(np.stack(values), dtype=dtype, device=device)
+
+        points, labels = _to_tensor(points, torch.float), _to_tensor(labels, torch.int)
+        boxes, logits = _to_tensor(boxes, torch.float), _to_tensor(logits, torch.float)
+        features = torch.cat(features)
+
+        sparse_embeddings, dense_embeddings = model.prompt_encoder(
+            points=None if points is None else (points, labels), boxes=boxes, masks=logits,
+        )
+        low_res_masks, iou_predictions = model.mask_decoder(
+            image_embeddings=torch.zeros_like(features[:1]),
+            image_pe=image_pe,
+            sparse_prompt_embeddings=sparse_embeddings,
+            dense_prompt_embeddings=dense_embeddings + features,
+            multimask_output=False,
+        )
+        group_masks = model.postprocess_masks(low_res_masks, input_size, original_size) > model.mask_threshold
+        group_masks, iou_predictions = group_masks.cpu().numpy(), iou_predictions.cpu().numpy()
+        for k, idx in enumerate(group):
+            results[idx] = (group_masks[k], iou_predictions[k])
+
+    return results
+
+
 #
 # functions for prompted segmentation:
 # - segment_from_points: use point prompts as input
@@ -264,6 +637,8 @@ def segment_from_points(
     multimask_output: bool = False,
     return_all: bool = False,
     use_best_multimask: Optional[bool] = None,
+    return_local_mask: bool = False,
+    cross_tile: bool = False,
 ):
     """Segmentation from point prompts.
 
@@ -279,10 +654,28 @@ def segment_from_points(
         return_all: Whether to return the score and logits in addition to the mask. By default, set to 'False'.
         use_best_multimask: Whether to use multimask output and then choose the best mask.
             By default this is used for a single positive point and not otherwise.
+        return_local_mask: Whether to return the mask only for the tile used for the prediction, together with
+            the bounding box of the tile in the image, instead of the mask for the full image.
+            Without tiling the mask for the full image is returned together with its bounding box.
+            By default, set to 'False'.
+        cross_tile: Whether to segment the object in all tiles that overlap with the prompts and to stitch
+            the predictions, so that objects that span several tiles can be segmented. The object is also
+            segmented in the neighboring tiles it extends into. Only has an effect for tiled embeddings.
+            The logits are not returned in this case. By default, set to 'False'.
 
     Returns:
         The binary segmentation mask.
+        The bounding box of the mask in the image, if 'return_local_mask' is set.
     """
+    if cross_tile and _is_tiled(image_embeddings):
+        if use_best_multimask is None:
+            use_best_multimask = len(points) == 1 and labels[0] == 1
+        mask, scores, tile, shape = _segment_across_tiles(
+            predictor, image_embeddings, i, points=points[:, ::-1], labels=labels,  # SAM has reversed XY conventions
+            multimask_output=multimask_output, use_best_multimask=use_best_multimask,
+        )
+        return _process_outputs(mask, scores, None, shape, tile, return_all, return_local_mask)
+
     predictor, tile, prompts, shape = _initialize_predictor(
         predictor, image_embeddings, i, (points, labels), _points_to_tile
     )
@@ -303,13 +696,7 @@ def segment_from_points(
         best_mask_id = np.argmax(scores)
         mask = mask[best_mask_id][None]
 
-    if tile is not None:
-        mask = _tile_to_full_mask(mask, shape, tile)
-
-    if return_all:
-        return mask, scores, logits
-    else:
-        return mask
+    return _process_outputs(mask, scores, logits, shape, tile, return_all, return_local_mask)
 
 
 def segment_from_mask(
@@ -329,6 +716,8 @@ def segment_from_mask(
     points: Optional[np.ndarray] = None,
     labels: Optional[np.ndarray] = None,
     use_single_point: bool = False,
+    return_local_mask: bool = False,
+    cross_tile: bool = False,
 ):
     """Segmentation from a mask prompt.
 
@@ -353,10 +742,38 @@ def segment_from_mask(
         labels: Positive/negative labels corresponding to the point prompts.
         use_single_point: Whether to derive just a single point from the mask.
             In case use_points is true.
+        return_local_mask: Whether to return the mask only for the tile used for the prediction, together with
+            the bounding box of the tile in the image, instead of the mask for the full image.
+            Without tiling the mask for the full image is returned together with its bounding box.
+            By default, set to 'False'.
+        cross_tile: Whether to segment the object in all tiles that overlap with the prompts and to stitch
+            the predictions, so that objects that span several tiles can be segmented. Only has an effect for
+            tiled embeddings. The logits are not returned in this case. By default, set to 'False'.
 
     Returns:
         The binary segmentation mask.
+        The bounding box of the mask in the image, if 'return_local_mask' is set.
     """
+    if cross_tile and _is_tiled(image_embeddings):
+        if original_size is not None:
+            raise ValueError("Segmentation across tiles requires the mask in the shape of the image.")
+        if points is None and use_points and mask.sum() != 0:
+            points, labels = _compute_points_from_mask(
+                mask, original_size=None, box_extension=box_extension, use_single_point=use_single_point,
+            )
+        elif points is not None and labels is None:
+            raise ValueError("If points are passed you also need to pass labels.")
+        if box is None:
+            box = _compute_box_from_mask(mask, box_extension=box_extension) if use_box and mask.sum() != 0 else None
+        else:
+            box = _process_box(box, mask.shape, box_extension=box_extension)
+
+        mask, scores, tile, shape = _segment_across_tiles(
+            predictor, image_embeddings, i, points=points, labels=labels, box=box, mask=mask if use_mask else None,
+            multimask_output=multimask_output, return_logits=return_logits,
+        )
+        return _process_outputs(mask, scores, None, shape, tile, return_all, return_local_mask)
+
     prompts = (mask, box, points, labels)
 
     def _to_tile(prompts, shape, tile_shape, halo):
@@ -405,13 +822,7 @@ def segment_from_mask(
         multimask_output=multimask_output, return_logits=return_logits
     )
 
-    if tile is not None:
-        mask = _tile_to_full_mask(mask, shape, tile)
-
-    if return_all:
-        return mask, scores, logits
-    else:
-        return mask
+    return _process_outputs(mask, scores, logits, shape, tile, return_all, return_local_mask)
 
 
 def segment_from_box(
@@ -422,6 +833,8 @@ def segment_from_box(
     multimask_output: bool = False,
     return_all: bool = False,
     box_extension: float = 0.0,
+    return_local_mask: bool = False,
+    cross_tile: bool = False,
 ):
     """Segmentation from a box prompt.
 
@@ -436,10 +849,26 @@ def segment_from_box(
         return_all: Whether to return the score and logits in addition to the mask. By default, set to 'False'.
         box_extension: Relative factor used to enlarge the bounding box prompt.
             By default, does not enlarge the bounding box.
+        return_local_mask: Whether to return the mask only for the tile used for the prediction, together with
+            the bounding box of the tile in the image, instead of the mask for the full image.
+            Without tiling the mask for the full image is returned together with its bounding box.
+            By default, set to 'False'.
+        cross_tile: Whether to segment the object in all tiles that overlap with the prompts and to stitch
+            the predictions, so that objects that span several tiles can be segmented. Only has an effect for
+            tiled embeddings. The logits are not returned in this case. By default, set to 'False'.
 
     Returns:
         The binary segmentation mask.
+        The bounding box of the mask in the image, if 'return_local_mask' is set.
     """
+    if cross_tile and _is_tiled(image_embeddings):
+        shape = image_embeddings["features"].attrs["shape"]
+        mask, scores, tile, shape = _segment_across_tiles(
+            predictor, image_embeddings, i, box=_process_box(box, shape, box_extension=box_extension),
+            multimask_output=multimask_output,
+        )
+        return _process_outputs(mask, scores, None, shape, tile, return_all, return_local_mask)
+
     predictor, tile, box, shape = _initialize_predictor(
         predictor, image_embeddings, i, box, _box_to_tile
     )
@@ -447,13 +876,7 @@ def segment_from_box(
         box=_process_box(box, shape, box_extension=box_extension), multimask_output=multimask_output
     )
 
-    if tile is not None:
-        mask = _tile_to_full_mask(mask, shape, tile)
-
-    if return_all:
-        return mask, scores, logits
-    else:
-        return mask
+    return _process_outputs(mask, scores, logits, shape, tile, return_all, return_local_mask)
 
 
 def segment_from_box_and_points(
@@ -465,6 +888,8 @@ def segment_from_box_and_points(
     i: Optional[int] = None,
     multimask_output: bool = False,
     return_all: bool = False,
+    return_local_mask: bool = False,
+    cross_tile: bool = False,
 ):
     """Segmentation from a box prompt and point prompts.
 
@@ -479,10 +904,26 @@ def segment_from_box_and_points(
             or a time dimension and two spatial dimensions.
         multimask_output: Whether to return multiple or just a single mask. By default, set to 'False'.
         return_all: Whether to return the score and logits in addition to the mask. By default, set to 'False'.
+        return_local_mask: Whether to return the mask only for the tile used for the prediction, together with
+            the bounding box of the tile in the image, instead of the mask for the full image.
+            Without tiling the mask for the full image is returned together with its bounding box.
+            By default, set to 'False'.
+        cross_tile: Whether to segment the object in all tiles that overlap with the prompts and to stitch
+            the predictions, so that objects that span several tiles can be segmented. Only has an effect for
+            tiled embeddings. The logits are not returned in this case. By default, set to 'False'.
 
     Returns:
         The binary segmentation mask.
+        The bounding box of the mask in the image, if 'return_local_mask' is set.
     """
+    if cross_tile and _is_tiled(image_embeddings):
+        shape = image_embeddings["features"].attrs["shape"]
+        mask, scores, tile, shape = _segment_across_tiles(
+            predictor, image_embeddings, i, points=points[:, ::-1], labels=labels,  # SAM has reversed XY conventions
+            box=_process_box(box, shape), multimask_output=multimask_output,
+        )
+        return _process_outputs(mask, scores, None, shape, tile, return_all, return_local_mask)
+
     def box_and_points_to_tile(prompts, shape, tile_shape, halo):
         box, points, labels = prompts
         tile_id, tile, point_prompts = _points_to_tile((points, labels), shape, tile_shape, halo)
@@ -504,10 +945,4 @@ def segment_from_box_and_points(
         multimask_output=multimask_output
     )
 
-    if tile is not None:
-        mask = _tile_to_full_mask(mask, shape, tile)
-
-    if return_all:
-        return mask, scores, logits
-    else:
-        return mask
+    return _process_outputs(mask, scores, logits, shape, tile, return_all, return_local_mask)
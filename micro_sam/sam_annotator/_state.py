@@ -3,9 +3,10 @@ The singleton is implemented following the metaclass design described here:
 https://itnext.io/deciding-the-best-singleton-approach-in-python-65c61e90cdc4
 """
 
+import copy
 from functools import partial
 from dataclasses import dataclass, field
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import zarr
 import numpy as np
@@ -50,6 +51,12 @@ class AnnotatorState(metaclass=Singleton):
     embedding_path: Optional[str] = None
     data_signature: Optional[str] = None
     skip_recomputing_embeddings: Optional[bool] = None
+    # embedded_slices: The slices for which the embeddings are available while they are computed in the background.
+    # This is 'None' if the embeddings are not being computed.
+    embedded_slices: Optional[Set[int]] = None
+    # shared_predictor: The predictor that was last loaded from the shared models, see 'util.get_sam_model'.
+    # It is not cleared by 'reset_state', so that the model is only released when a different model is loaded.
+    shared_predictor: Optional[SamPredictor] = None
 
     # amg: needs to be initialized for the automatic segmentation functionality.
     # amg_state: for storing the instance segmentation state for the 3d segmentation tool.
@@ -102,6 +109,9 @@ class AnnotatorState(metaclass=Singleton):
         pbar_update=None,
         skip_load=True,
         use_cli=False,
+        slice_order=None,
+        slice_callback=None,
+        compute_on_demand=False,
     ):
         assert ndim in (2, 3)
 
@@ -114,8 +124,13 @@ class AnnotatorState(metaclass=Singleton):
             self.predictor, state = util.get_sam_model(
                 device=device, model_type=model_type,
                 checkpoint_path=checkpoint_path, return_state=True,
-                progress_bar_factory=None if use_cli else progress_bar_factory,
+                progress_bar_factory=None if use_cli else progress_bar_factory, shared=True,
             )
+            # Release the previous model from the shared models if the model type, checkpoint or device has changed,
+            # so that it does not stay in memory after the annotator has dropped it.
+            if self.shared_predictor is not None and self.shared_predictor is not self.predictor:
+                util._MODEL_REGISTRY.release(self.shared_predictor)
+            self.shared_predictor = self.predictor
             if prefer_decoder and "decoder_state" in state:
                 self.decoder = get_decoder(
                     image_encoder=self.predictor.model.image_encoder,
@@ -133,8 +148,12 @@ class AnnotatorState(metaclass=Singleton):
             self.embedding_path = None  # setting this to 'None' as we do not have embeddings cached.
 
         else:  # otherwise, compute the image embeddings.
+            # If the embeddings of individual slices are used while the others are computed, then the
+            # computation runs on a copy of the predictor, which shares the model but not the image features.
+            # We don't use the embedding cache, because the embeddings are kept in the state already,
+            # and the cache would keep the embeddings of previous images in memory.
             self.image_embeddings = util.precompute_image_embeddings(
-                predictor=self.predictor,
+                predictor=self.predictor if slice_callback is None else copy.copy(self.predictor),
                 input_=image_data,
                 save_path=save_path,
                 ndim=ndim,
@@ -143,6 +162,10 @@ class AnnotatorState(metaclass=Singleton):
                 verbose=True,
                 pbar_init=pbar_init,
                 pbar_update=pbar_update,
+                slice_order=slice_order,
+                slice_callback=slice_callback,
+                compute_on_demand=compute_on_demand,
+                use_cache=False,
             )
             self.embedding_path = save_path
 
@@ -260,4 +283,7 @@ class AnnotatorState(metaclass=Singleton):
         self.committed_lineages = None
         self.z_range = None
         self.data_signature = None
+        self.embedded_slices = None
+        # Release the features of the previous embeddings that are cached on the device.
+        util.clear_device_cache()
         # Note: we don't clear the widgets here, because they are fixed for a viewer session.
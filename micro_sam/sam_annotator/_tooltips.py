@@ -3,6 +3,7 @@
 
 tooltips = {
   "embedding": {
+    "cancel_button": "Cancel the embedding computation that is running in the background.",
     "custom_weights": "Select custom model weights. For example for a model you have finetuned",
     "device": "Select the computational device to use for processing.",
     "embeddings_save_path": "Select path to save or load the computed image embeddings.",
@@ -3,8 +3,8 @@
 
 import os
 import gc
+import threading
 import multiprocessing as mp
-import pickle
 from pathlib import Path
 from typing import Optional
 
@@ -35,6 +35,7 @@ from . import util as vutil
 from ._tooltips import get_tooltip
 from ._state import AnnotatorState
 from .. import instance_segmentation, util
+from ..precompute_state import _write_amg_state
 from ..multi_dimensional_segmentation import (
     segment_mask_in_volume, merge_instance_segmentation_3d, track_across_frames, PROJECTION_MODES, get_napari_track_data
 )
@@ -364,6 +365,17 @@ class PBarSignals(QObject):
     pbar_reset = Signal()
 
 
+# Signals for passing the result of the embedding computation from the background thread to the main thread.
+class EmbeddingSignals(QObject):
+    finished = Signal()
+    cancelled = Signal()
+    failed = Signal(object)
+
+
+class _EmbeddingCancelled(Exception):
+    """Raised in the background thread to stop the embedding computation."""
+
+
 class InfoDialog(QtWidgets.QDialog):
     def __init__(self, title, message):
         super().__init__()
@@ -621,9 +633,20 @@ def _commit_to_file(path, viewer, layer, seg, mask, bb, extra_attrs=None):
     if "data_signature" in f.attrs:
         saved_signature = f.attrs["data_signature"]
         current_signature = state.data_signature
-        if saved_signature != current_signature:  # Signatures disagree.
+        # Files from older versions store the signature in the legacy format (sha1 of the data).
+        # If the saved and the current signature have different formats, then we compute the signature
+        # of the image data in the format of the saved signature for the comparison.
+        is_legacy_signature = not saved_signature.startswith("xxh128:")
+        if is_legacy_signature != (not current_signature.startswith("xxh128:")):
+            compared_signature = util._compute_data_signature(
+                viewer.layers["image"].data, saved_signature=saved_signature
+            )
+        else:
+            compared_signature = current_signature
+
+        if saved_signature != compared_signature:  # Signatures disagree.
             msg = f"The commit_path {path} was already used for saving annotations for different image data:\n"
-            msg += f"The data signatures are different: {saved_signature} != {current_signature}.\n"
+            msg += f"The data signatures are different: {saved_signature} != {compared_signature}.\n"
             msg += "Press 'Ok' to remove the data already stored in that file and continue annotation.\n"
             msg += "Otherwise please select a different file path."
             skip_clear = _generate_message("info", msg)
@@ -632,6 +655,9 @@ def _commit_to_file(path, viewer, layer, seg, mask, bb, extra_attrs=None):
             else:
                 f = z5py.ZarrFile(path, "w")
                 _save_signature(f, current_signature)
+        # Upgrade a matching legacy signature, so that it does not need to be computed again for the next commit.
+        elif is_legacy_signature and current_signature.startswith("xxh128:"):
+            f.attrs["data_signature"] = current_signature
     # Otherwise (data signature not saved yet), write the current signature.
     else:
         _save_signature(f, state.data_signature)
@@ -916,11 +942,17 @@ def _generate_message(message_type: str, message: str) -> bool:
         raise ValueError(f"Invalid message type {message_type}")
 
 
-def _validate_embeddings(viewer: "napari.viewer.Viewer"):
+def _validate_embeddings(viewer: "napari.viewer.Viewer", i: Optional[int] = None):
     state = AnnotatorState()
     if state.image_embeddings is None:
         msg = "Image embeddings are not yet computed. Press 'Compute Embeddings' to compute them for your image."
         return _generate_message("error", msg)
+    # The embeddings are still being computed. Only the slices that are already computed can be segmented.
+    elif state.embedded_slices is not None and (i is None or i not in state.embedded_slices):
+        msg = "The image embeddings are still being computed." if i is None else\
+            f"The image embeddings for slice {i} are still being computed."
+        msg += " Please wait until they are available."
+        return _generate_message("error", msg)
     else:
         return False
 
@@ -1035,8 +1067,6 @@ def segment_slice(viewer: "napari.viewer.Viewer") -> None:
     Args:
         viewer: The napari viewer.
     """
-    if _validate_embeddings(viewer):
-        return None
     if _validate_layers(viewer):
         return None
 
@@ -1046,6 +1076,9 @@ def segment_slice(viewer: "napari.viewer.Viewer") -> None:
     position = viewer.layers["point_prompts"].world_to_data(position_world)
     z = int(position[0])
 
+    if _validate_embeddings(viewer, i=z):
+        return None
+
     point_prompts = vutil.point_layer_to_prompts(viewer.layers["point_prompts"], z)
     # this is a stop prompt, we do nothing
     if not point_prompts:
@@ -1076,8 +1109,6 @@ def segment_frame(viewer: "napari.viewer.Viewer") -> None:
     Args:
         viewer: The napari viewer.
     """
-    if _validate_embeddings(viewer):
-        return None
     if _validate_layers(viewer):
         return None
 
@@ -1086,6 +1117,9 @@ def segment_frame(viewer: "napari.viewer.Viewer") -> None:
     position = viewer.dims.point
     t = int(position[0])
 
+    if _validate_embeddings(viewer, i=t):
+        return None
+
     point_prompts = vutil.point_layer_to_prompts(viewer.layers["point_prompts"], i=t, track_id=state.current_track_id)
     # this is a stop prompt, we do nothing
     if not point_prompts:
@@ -1173,7 +1207,63 @@ class EmbeddingWidget(_WidgetBase):
         self.run_button.setToolTip(get_tooltip("embedding", "run_button"))
         self.layout().addWidget(self.run_button)
 
+        # The button to cancel the embedding computation, which runs in a background thread.
+        self.cancel_button = QtWidgets.QPushButton("Cancel Embeddings")
+        self.cancel_button.clicked.connect(self._cancel_embeddings)
+        self.cancel_button.setToolTip(get_tooltip("embedding", "cancel_button"))
+        self.cancel_button.setEnabled(False)
+        self.layout().addWidget(self.cancel_button)
+
+        self._embedding_thread = None
+        self._cancel_event = threading.Event()
+        self._embedding_signals = EmbeddingSignals()
+        self._embedding_signals.finished.connect(self._on_embeddings_finished)
+        self._embedding_signals.cancelled.connect(self._on_embeddings_cancelled)
+        self._embedding_signals.failed.connect(self._on_embeddings_failed)
+
+    def _is_computing(self):
+        return self._embedding_thread is not None and self._embedding_thread.is_alive()
+
+    def _cancel_embeddings(self):
+        if self._is_computing():
+            self._cancel_event.set()
+            self.cancel_button.setEnabled(False)
+            show_info("Cancelling the embedding computation.")
+
+    def _finish_embeddings(self):
+        self._embedding_thread = None
+        self.run_button.setEnabled(True)
+        self.cancel_button.setEnabled(False)
+        AnnotatorState().embedded_slices = None
+
+    def _on_embeddings_finished(self):
+        self._finish_embeddings()
+        self._update_model(AnnotatorState())
+
+    def _on_embeddings_cancelled(self):
+        self._finish_embeddings()
+        AnnotatorState().image_embeddings = None
+        show_info("The embedding computation was cancelled.")
+
+    def _on_embeddings_failed(self, error):
+        self._finish_embeddings()
+        AnnotatorState().image_embeddings = None
+        raise error
+
+    # Get the slice order for computing the embeddings, starting from the slice under the cursor.
+    def _get_slice_order(self, image, n_slices):
+        viewer = napari.current_viewer()
+        if viewer is None:
+            return None
+        z = int(np.round(image.world_to_data(viewer.dims.point)[0]))
+        z = min(max(z, 0), n_slices - 1)
+        return sorted(range(n_slices), key=lambda zz: (abs(zz - z), zz))
+
     def _initialize_image(self):
+        # Don't change the image while the embeddings are computed for it.
+        if self._is_computing():
+            return
+
         state = AnnotatorState()
         layer = self.image_selection.get_value()
 
@@ -1353,7 +1443,9 @@ class EmbeddingWidget(_WidgetBase):
                 # Validate image data signature.
                 if "data_signature" in f.attrs:
                     image = self.image_selection.get_value()
-                    img_signature = util._compute_data_signature(image.data)
+                    img_signature = util._compute_data_signature(
+                        image.data, saved_signature=f.attrs["data_signature"]
+                    )
                     if img_signature != f.attrs["data_signature"]:
                         msg = f"The embeddings don't match with the image: {img_signature} {f.attrs['data_signature']}"
                         return _generate_message("error", msg)
@@ -1399,6 +1491,10 @@ class EmbeddingWidget(_WidgetBase):
             return _generate_message(val_results["message_type"], val_results["message"])
 
     def __call__(self, skip_validate=False):
+        if self._is_computing():
+            show_info("The embeddings are already being computed.")
+            return
+
         self._validate_model_type_and_custom_weights()
 
         # Validate user inputs.
@@ -1438,33 +1534,71 @@ class EmbeddingWidget(_WidgetBase):
         # Set up progress bar and signals for using it within a threadworker.
         pbar, pbar_signals = _create_pbar_for_threadworker()
 
-        # @thread_worker()
+        # For volumetric data without tiling the slices can be segmented as soon as their embeddings are computed.
+        # We compute the slice under the cursor first, followed by its neighbors.
+        if ndim == 3 and tile_shape is None:
+            embedded_slices = set()
+            state.embedded_slices = embedded_slices
+            slice_order = self._get_slice_order(image, state.image_shape[0])
+
+            def slice_callback(z, image_embeddings):
+                # Check that the state was not reset in the meantime.
+                if state.embedded_slices is not embedded_slices:
+                    return
+                if state.image_embeddings is None:
+                    state.image_embeddings = image_embeddings
+                embedded_slices.add(z)
+
+        else:
+            slice_order, slice_callback = None, None
+
+        # We run the computation in a python thread rather than a napari thread worker,
+        # because the thread workers result in a massive slowdown in napari >= 0.5 (see above).
+        # Results are passed to the main thread via qt signals.
+        self._cancel_event.clear()
+
         def compute_image_embedding():
 
             def pbar_init(total, description):
                 pbar_signals.pbar_total.emit(total)
                 pbar_signals.pbar_description.emit(description)
 
+            # The computation is cancelled by raising an exception in the progress bar callback.
+            def pbar_update(update):
+                if self._cancel_event.is_set():
+                    raise _EmbeddingCancelled
+                pbar_signals.pbar_update.emit(update)
+
             # Whether to prefer decoder.
             # With 'amg', it is set to 'False', else it is 'True' for the default 'auto' and 'ais' mode.
             prefer_decoder = True
             if self.automatic_segmentation_mode == "amg":
                 prefer_decoder = False
 
-            state.initialize_predictor(
-                image_data, model_type=self.model_type, save_path=save_path, ndim=ndim,
-                device=self.device, checkpoint_path=self.custom_weights, tile_shape=tile_shape, halo=halo,
-                prefer_decoder=prefer_decoder, pbar_init=pbar_init,
-                pbar_update=lambda update: pbar_signals.pbar_update.emit(update),
-            )
+            try:
+                state.initialize_predictor(
+                    image_data, model_type=self.model_type, save_path=save_path, ndim=ndim,
+                    device=self.device, checkpoint_path=self.custom_weights, tile_shape=tile_shape, halo=halo,
+                    prefer_decoder=prefer_decoder, pbar_init=pbar_init, pbar_update=pbar_update,
+                    slice_order=slice_order, slice_callback=slice_callback,
+                )
+            except _EmbeddingCancelled:
+                pbar_signals.pbar_stop.emit()
+                self._embedding_signals.cancelled.emit()
+                return
+            except Exception as e:
+                pbar_signals.pbar_stop.emit()
+                self._embedding_signals.failed.emit(e)
+                return
+
             pbar_signals.pbar_stop.emit()
+            self._embedding_signals.finished.emit()
 
-        compute_image_embedding()
-        self._update_model(state)
-        # worker = compute_image_embedding()
-        # worker.returned.connect(self._update_model)
-        # worker.start()
-        # return worker
+        self.run_button.setEnabled(False)
+        self.cancel_button.setEnabled(True)
+        self._embedding_thread = threading.Thread(target=compute_image_embedding, daemon=True)
+        self._embedding_thread.start()
+        return self._embedding_thread
 
 
 #
@@ -1625,7 +1759,7 @@ class SegmentNDWidget(_WidgetBase):
                 seg, state.predictor, state.image_embeddings, slices,
                 stop_lower, stop_upper,
                 iou_threshold=self.iou_threshold, projection=self.projection,
-                box_extension=self.box_extension,
+                box_extension=self.box_extension, batched_propagation=True,
                 update_progress=lambda update: pbar_signals.pbar_update.emit(update),
             )
             pbar_signals.pbar_stop.emit()
@@ -1689,9 +1823,8 @@ def _handle_amg_state(state, i, pbar_init, pbar_update):
 
             cache_folder = state.amg_state.get("cache_folder", None)
             if cache_folder is not None:
-                cache_path = os.path.join(cache_folder, f"state-{i}.pkl")
-                with open(cache_path, "wb") as f:
-                    pickle.dump(amg_state_i, f)
+                cache_path = os.path.join(cache_folder, f"state-{i}.npz")
+                _write_amg_state(cache_path, amg_state_i)
 
             cache_path = state.amg_state.get("cache_path", None)
             if cache_path is not None:
@@ -2008,6 +2141,8 @@ class AutoSegmentWidget(_WidgetBase):
                 "pred_iou_thresh": self.pred_iou_thresh,
                 "stability_score_thresh": self.stability_score_thresh,
                 "box_nms_thresh": self.box_nms_thresh,
+                # Painting the segmentation from the run-length encoding is much faster than decoding the masks.
+                "output_mode": "uncompressed_rle",
             }
         if self.volumetric and self.apply_to_volume:
             worker = self._run_segmentation_3d(kwargs)
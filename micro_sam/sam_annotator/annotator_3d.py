@@ -60,6 +60,7 @@ def annotator_3d(
     checkpoint_path: Optional[str] = None,
     device: Optional[Union[str, torch.device]] = None,
     prefer_decoder: bool = True,
+    compute_embeddings_on_demand: bool = False,
 ) -> Optional["napari.viewer.Viewer"]:
     """Start the 3d annotation tool for a given image volume.
 
@@ -88,6 +89,9 @@ def annotator_3d(
         prefer_decoder: Whether to use decoder based instance segmentation if
             the model used has an additional decoder for instance segmentation.
             By default, set to 'True'.
+        compute_embeddings_on_demand: Whether to compute the embeddings of a slice only when it is segmented
+            for the first time, instead of computing the embeddings for all slices upfront.
+            This only has an effect if tiling is not used. By default, set to 'False'.
 
     Returns:
         The napari viewer, only returned if `return_viewer=True`.
@@ -100,7 +104,7 @@ def annotator_3d(
         image, model_type=model_type, save_path=embedding_path,
         halo=halo, tile_shape=tile_shape, ndim=3, precompute_amg_state=precompute_amg_state,
         checkpoint_path=checkpoint_path, device=device, prefer_decoder=prefer_decoder,
-        use_cli=True,
+        use_cli=True, compute_on_demand=compute_embeddings_on_demand,
     )
 
     if viewer is None:
@@ -134,6 +138,11 @@ def annotator_3d(
 def main():
     """@private"""
     parser = _initialize_parser(description="Run interactive segmentation for an image volume.")
+    parser.add_argument(
+        "--compute_embeddings_on_demand", action="store_true",
+        help="Whether to compute the embeddings of a slice only when it is segmented for the first time, "
+        "instead of computing the embeddings for all slices upfront."
+    )
     args = parser.parse_args()
     image = util.load_image_data(args.input, key=args.key)
 
@@ -148,4 +157,5 @@ def main():
         model_type=args.model_type, tile_shape=args.tile_shape, halo=args.halo,
         checkpoint_path=args.checkpoint, device=args.device,
         precompute_amg_state=args.precompute_amg_state, prefer_decoder=args.prefer_decoder,
+        compute_embeddings_on_demand=args.compute_embeddings_on_demand,
     )
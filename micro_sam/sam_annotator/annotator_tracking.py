@@ -297,6 +297,7 @@ def annotator_tracking(
     precompute_amg_state: bool = False,
     checkpoint_path: Optional[str] = None,
     device: Optional[Union[str, torch.device]] = None,
+    compute_embeddings_on_demand: bool = False,
 ) -> Optional["napari.viewer.Viewer"]:
     """Start the tracking annotation tool fora given timeseries.
 
@@ -318,6 +319,9 @@ def annotator_tracking(
         checkpoint_path: Path to a custom checkpoint from which to load the SAM model.
         device: The computational device to use for the SAM model.
             By default, automatically chooses the best available device.
+        compute_embeddings_on_demand: Whether to compute the embeddings of a frame only when it is segmented
+            for the first time, instead of computing the embeddings for all frames upfront.
+            This only has an effect if tiling is not used. By default, set to 'False'.
 
     Returns:
         The napari viewer, only returned if `return_viewer=True`.
@@ -330,6 +334,7 @@ def annotator_tracking(
         halo=halo, tile_shape=tile_shape, prefer_decoder=True,
         ndim=3, checkpoint_path=checkpoint_path, device=device,
         precompute_amg_state=precompute_amg_state, use_cli=True,
+        compute_on_demand=compute_embeddings_on_demand,
     )
     state.image_shape = image.shape[:-1] if image.ndim == 4 else image.shape
 
@@ -381,6 +386,11 @@ def main():
     #     help="The key for opening the tracking result. Same rules as for 'key' apply."
     # )
 
+    parser.add_argument(
+        "--compute_embeddings_on_demand", action="store_true",
+        help="Whether to compute the embeddings of a frame only when it is segmented for the first time, "
+        "instead of computing the embeddings for all frames upfront."
+    )
     args = parser.parse_args()
     image = util.load_image_data(args.input, key=args.key)
 
@@ -388,4 +398,5 @@ def main():
         image, embedding_path=args.embedding_path, model_type=args.model_type,
         tile_shape=args.tile_shape, halo=args.halo,
         checkpoint_path=args.checkpoint, device=args.device,
+        compute_embeddings_on_demand=args.compute_embeddings_on_demand,
     )
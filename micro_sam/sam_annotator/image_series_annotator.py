@@ -33,7 +33,7 @@ def _precompute(
 
     device = util.get_device(device)
     predictor, state = util.get_sam_model(
-        model_type=model_type, checkpoint_path=checkpoint_path, device=device, return_state=True
+        model_type=model_type, checkpoint_path=checkpoint_path, device=device, return_state=True, shared=True,
     )
     if prefer_decoder and "decoder_state" in state:
         decoder = get_decoder(predictor.model.image_encoder, state["decoder_state"], device)
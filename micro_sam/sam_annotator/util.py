@@ -1,5 +1,4 @@
 import os
-import pickle
 import warnings
 import argparse
 from glob import glob
@@ -15,6 +14,7 @@ from scipy.ndimage import shift
 from .. import prompt_based_segmentation, util
 from .. import _model_settings as model_settings
 from ..multi_dimensional_segmentation import _validate_projection
+from ..precompute_state import _read_amg_state
 
 # Green and Red
 LABEL_COLOR_CYCLE = ["#00FF00", "#FF0000"]
@@ -423,6 +423,45 @@ def _match_prompts(previous_segmentation, points, boxes, seg_ids):
     return batched_prompts
 
 
+def _predict_batched_prompts(
+    predictor, points, labels, boxes, negative_points, negative_labels, image_embeddings, i, shape
+):
+    """Predict one object per positive point and per box, which are combined with all negative points.
+
+    The predictions match the ones of 'segment_from_points' and 'segment_from_box(_and_points)' for the individual
+    prompts, but all point prompts and all box prompts are each predicted with batched calls to the decoder.
+    """
+    if image_embeddings is not None:
+        util.set_precomputed(predictor, image_embeddings, i)
+
+    have_negatives = len(negative_points) > 0
+    if have_negatives:
+        negative_points, negative_labels = np.concatenate(negative_points), np.concatenate(negative_labels)
+
+    predictions = []
+    if len(points) > 0:
+        points = np.stack([
+            np.concatenate([point, negative_points]) if have_negatives else point for point in points
+        ])
+        labels = np.stack([
+            np.concatenate([label, negative_labels]) if have_negatives else label for label in labels
+        ])
+        # As in 'segment_from_points', we use the best multimask output for a single positive point.
+        predictions.append(prompt_based_segmentation._predict_batched(
+            predictor, points=points[:, :, ::-1], labels=labels, use_best_multimask=not have_negatives,
+        ))
+
+    if len(boxes) > 0:
+        boxes = np.stack([prompt_based_segmentation._process_box(box, shape) for box in boxes])
+        predictions.append(prompt_based_segmentation._predict_batched(
+            predictor, boxes=boxes,
+            points=np.stack(len(boxes) * [negative_points[:, ::-1]]) if have_negatives else None,
+            labels=np.stack(len(boxes) * [negative_labels]) if have_negatives else None,
+        ))
+
+    return np.concatenate(predictions)
+
+
 def _batched_interactive_segmentation(predictor, points, labels, boxes, image_embeddings, i, previous_segmentation):
     prev_seg = previous_segmentation if i is None else previous_segmentation[i]
     seg = np.zeros(prev_seg.shape, dtype="uint32")
@@ -459,6 +498,16 @@ def _batched_interactive_segmentation(predictor, points, labels, boxes, image_em
     # else:
     #     batched_prompts = _match_prompts(prev_seg, batched_points, boxes, seg_ids)
 
+    # For embeddings without tiling we can predict all objects with batched calls to the decoder.
+    if image_embeddings is None or image_embeddings["input_size"] is not None:
+        predictions = _predict_batched_prompts(
+            predictor, batched_points, batched_labels, boxes, negative_points, negative_labels,
+            image_embeddings, i, seg.shape,
+        )
+        for seg_id, prediction in enumerate(predictions, 1):
+            seg[prediction] = seg_id
+        return seg
+
     for seg_id, prompt in batched_prompts.items():
         box, point, label = prompt
         if len(negative_points) > 0:
@@ -468,24 +517,65 @@ def _batched_interactive_segmentation(predictor, points, labels, boxes, image_em
                 point = np.concatenate([point] + negative_points)
                 label = np.concatenate([label] + negative_labels)
 
+        # We segment objects across the tiles that overlap with their prompts and only paste the prediction
+        # into the region of these tiles, to avoid allocating full size masks.
         if (box is not None) and (point is not None):
-            prediction = prompt_based_segmentation.segment_from_box_and_points(
-                predictor, box, point, label, image_embeddings=image_embeddings, i=i
-            ).squeeze()
+            prediction, bb = prompt_based_segmentation.segment_from_box_and_points(
+                predictor, box, point, label, image_embeddings=image_embeddings, i=i,
+                return_local_mask=True, cross_tile=True,
+            )
         elif (box is not None) and (point is None):
-            prediction = prompt_based_segmentation.segment_from_box(
-                predictor, box, image_embeddings=image_embeddings, i=i
-            ).squeeze()
+            prediction, bb = prompt_based_segmentation.segment_from_box(
+                predictor, box, image_embeddings=image_embeddings, i=i, return_local_mask=True, cross_tile=True,
+            )
         else:
-            prediction = prompt_based_segmentation.segment_from_points(
-                predictor, point, label, image_embeddings=image_embeddings, i=i
-            ).squeeze()
+            prediction, bb = prompt_based_segmentation.segment_from_points(
+                predictor, point, label, image_embeddings=image_embeddings, i=i,
+                return_local_mask=True, cross_tile=True,
+            )
 
-        seg[prediction] = seg_id
+        seg[bb][prediction[0]] = seg_id
 
     return seg
 
 
+def _predict_batched_boxes(predictor, boxes, masks, image_embeddings, i, shape, box_extension):
+    """Predict one object per box prompt, using the mask as additional prompt if it is given.
+
+    The predictions match the ones of 'segment_from_box' and 'segment_from_mask' for the individual prompts,
+    but the box prompts with and without masks are each predicted with batched calls to the decoder.
+    """
+    if image_embeddings is not None:
+        util.set_precomputed(predictor, image_embeddings, i)
+
+    predictions = [None] * len(boxes)
+    with_mask = [j for j, mask in enumerate(masks) if mask is not None]
+    without_mask = [j for j, mask in enumerate(masks) if mask is None]
+
+    if len(without_mask) > 0:
+        batch_predictions = prompt_based_segmentation._predict_batched(
+            predictor, boxes=np.stack([
+                prompt_based_segmentation._process_box(boxes[j], shape) for j in without_mask
+            ]),
+        )
+        for j, prediction in zip(without_mask, batch_predictions):
+            predictions[j] = prediction
+
+    if len(with_mask) > 0:
+        batch_predictions = prompt_based_segmentation._predict_batched(
+            predictor,
+            boxes=np.stack([
+                prompt_based_segmentation._process_box(boxes[j], masks[j].shape, box_extension=box_extension)
+                for j in with_mask
+            ]),
+            mask_inputs=[prompt_based_segmentation._compute_logits_from_mask(masks[j]) for j in with_mask],
+        )
+        for j, prediction in zip(with_mask, batch_predictions):
+            predictions[j] = prediction
+
+    return predictions
+
+
 def prompt_segmentation(
     predictor, points, labels, boxes, masks, shape, multiple_box_prompts,
     image_embeddings=None, i=None, box_extension=0, batched=None, previous_segmentation=None,
@@ -516,17 +606,18 @@ def prompt_segmentation(
         mask = masks[0]
         if mask is None:
             seg = prompt_based_segmentation.segment_from_box_and_points(
-                predictor, boxes[0], points, labels, image_embeddings=image_embeddings, i=i
+                predictor, boxes[0], points, labels, image_embeddings=image_embeddings, i=i, cross_tile=True,
             ).squeeze()
         else:
             seg = prompt_based_segmentation.segment_from_mask(
-                predictor, mask, box=boxes[0], points=points, labels=labels, image_embeddings=image_embeddings, i=i
+                predictor, mask, box=boxes[0], points=points, labels=labels, image_embeddings=image_embeddings, i=i,
+                cross_tile=True,
             ).squeeze()
 
     # Only point prompts were given.
     elif have_points and not have_boxes:
         seg = prompt_based_segmentation.segment_from_points(
-            predictor, points, labels, image_embeddings=image_embeddings, i=i
+            predictor, points, labels, image_embeddings=image_embeddings, i=i, cross_tile=True,
         ).squeeze()
 
     # Only box prompts were given.
@@ -538,18 +629,26 @@ def prompt_segmentation(
             print("You can only segment one object at a time in 3d.")
             return
 
-        # Batch this?
+        # For embeddings without tiling we predict all objects with batched calls to the decoder.
+        if image_embeddings is None or image_embeddings["input_size"] is not None:
+            predictions = _predict_batched_boxes(predictor, boxes, masks, image_embeddings, i, shape, box_extension)
+            for seg_id, prediction in enumerate(predictions, 1):
+                seg[prediction] = seg_id
+            return seg
+
+        # We segment objects across the tiles that overlap with their prompts and only paste the prediction
+        # into the region of these tiles, to avoid allocating full size masks.
         for seg_id, (box, mask) in enumerate(zip(boxes, masks), 1):
             if mask is None:
-                prediction = prompt_based_segmentation.segment_from_box(
-                    predictor, box, image_embeddings=image_embeddings, i=i
-                ).squeeze()
+                prediction, bb = prompt_based_segmentation.segment_from_box(
+                    predictor, box, image_embeddings=image_embeddings, i=i, return_local_mask=True, cross_tile=True,
+                )
             else:
-                prediction = prompt_based_segmentation.segment_from_mask(
+                prediction, bb = prompt_based_segmentation.segment_from_mask(
                     predictor, mask, box=box, image_embeddings=image_embeddings, i=i,
-                    box_extension=box_extension,
-                ).squeeze()
-            seg[prediction] = seg_id
+                    box_extension=box_extension, return_local_mask=True, cross_tile=True,
+                )
+            seg[bb][prediction[0]] = seg_id
 
     return seg
 
@@ -763,12 +862,11 @@ def _load_amg_state(embedding_path):
     os.makedirs(cache_folder, exist_ok=True)
     amg_state = {"cache_folder": cache_folder}
 
-    state_paths = glob(os.path.join(cache_folder, "*.pkl"))
+    # Load the legacy pickle states first, so that they are superseded by npz states for the same index.
+    state_paths = glob(os.path.join(cache_folder, "*.pkl")) + glob(os.path.join(cache_folder, "*.npz"))
     for path in state_paths:
-        with open(path, "rb") as f:
-            state = pickle.load(f)
         i = int(Path(path).stem.split("-")[-1])
-        amg_state[i] = state
+        amg_state[i] = _read_amg_state(path)
     return amg_state
 
 
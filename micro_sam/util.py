@@ -3,18 +3,25 @@ Helper functions for downloading Segment Anything models and predicting image em
 """
 
 import os
+import json
 import pickle
+import shutil
 import hashlib
 import warnings
+import weakref
+import threading
 from pathlib import Path
 from collections import OrderedDict
-from typing import Any, Dict, Iterable, Optional, Tuple, Union, Callable
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union, Callable
 
 import zarr
 import vigra
 import torch
 import pooch
 import xxhash
+import numcodecs
 import numpy as np
 import imageio.v3 as imageio
 from skimage.measure import regionprops
@@ -249,15 +256,35 @@ class _CustomUnpickler(pickle.Unpickler):
             return None
 
 
-def _compute_hash(path, chunk_size=8192):
+def _compute_hash(path, chunk_size=2**20):
+    # The hash is cached in a sidecar file next to the checkpoint, together with the size and modification time
+    # of the checkpoint. This avoids reading the full checkpoint again if it has not changed.
+    stat = os.stat(path)
+    sidecar_path = f"{path}.xxh128.json"
+    if os.path.exists(sidecar_path):
+        try:
+            with open(sidecar_path, "r") as f:
+                cached = json.load(f)
+            if cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+                return cached["hash"]
+        except (OSError, ValueError, KeyError):
+            pass
+
     hash_obj = xxhash.xxh128()
     with open(path, "rb") as f:
         chunk = f.read(chunk_size)
         while chunk:
             hash_obj.update(chunk)
             chunk = f.read(chunk_size)
-    hash_val = hash_obj.hexdigest()
-    return f"xxh128:{hash_val}"
+    hash_val = f"xxh128:{hash_obj.hexdigest()}"
+
+    # The sidecar is only a cache, so we don't fail if it cannot be written, e.g. for a read-only folder.
+    try:
+        with open(sidecar_path, "w") as f:
+            json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": hash_val}, f)
+    except OSError:
+        pass
+    return hash_val
 
 
 # Load the state from a checkpoint.
@@ -308,6 +335,100 @@ def _download_sam_model(model_type, progress_bar_factory=None):
     return checkpoint_path, model_hash, decoder_path
 
 
+#
+# Registry for loaded models
+#
+
+
+class _ModelRegistry:
+    """Registry for the models loaded with `get_sam_model(shared=True)`, addressed by model type, checkpoint,
+    device and model parameters.
+
+    The registry keeps the most recently used models together with their checkpoint state and
+    the instance segmentation decoders that were created for them.
+    """
+    def __init__(self, max_models=2):
+        self.max_models = max_models
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_key(self, model_type, device, checkpoint_path, peft_kwargs, flexible_load_checkpoint, model_kwargs):
+        if checkpoint_path is None:
+            checkpoint = None
+        else:
+            # We include size and modification time, so that a checkpoint is reloaded if it has changed.
+            stat = os.stat(checkpoint_path)
+            checkpoint = (os.path.realpath(checkpoint_path), stat.st_size, stat.st_mtime_ns)
+        return json.dumps(
+            [model_type, str(device), checkpoint, peft_kwargs, flexible_load_checkpoint, model_kwargs],
+            sort_keys=True, default=str,
+        )
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, entry):
+        if self.max_models == 0:
+            return
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_models:
+                self._entries.popitem(last=False)
+
+    def get_decoder(self, image_encoder, decoder_state, device, create_decoder):
+        with self._lock:
+            # Only the decoder for a shared model that is created from the decoder state of its checkpoint is shared.
+            # The decoders are stored in the entry of the model, so they are released together with the model.
+            entry = next((
+                entry for entry in self._entries.values()
+                if entry["sam"].image_encoder is image_encoder and entry["state"].get("decoder_state") is decoder_state
+            ), None)
+            if entry is None:
+                return create_decoder()
+            key = str(get_device(device))
+            if key not in entry["decoders"]:
+                entry["decoders"][key] = create_decoder()
+            return entry["decoders"][key]
+
+    def release(self, predictor):
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry["predictor"] is predictor]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_MODEL_REGISTRY = _ModelRegistry()
+
+
+def set_model_registry(max_models: int = 2) -> None:
+    """Configure the registry for the models loaded with `get_sam_model(shared=True)`.
+
+    The registry keeps the most recently used models in memory, so that loading the same model again,
+    e.g. for checking whether it has a segmentation decoder, returns the already loaded model instead of
+    reading its checkpoint again.
+
+    Args:
+        max_models: The maximal number of models kept in the registry.
+            Set to '0' to disable the registry. By default, set to '2'.
+    """
+    _MODEL_REGISTRY.max_models = max_models
+    _MODEL_REGISTRY.clear()
+
+
+def clear_model_registry() -> None:
+    """Clear the registry for the models loaded with `get_sam_model(shared=True)`.
+    """
+    _MODEL_REGISTRY.clear()
+
+
 def get_sam_model(
     model_type: str = _DEFAULT_MODEL,
     device: Optional[Union[str, torch.device]] = None,
@@ -317,6 +438,7 @@ def get_sam_model(
     peft_kwargs: Optional[Dict] = None,
     flexible_load_checkpoint: bool = False,
     progress_bar_factory: Optional[Callable] = None,
+    shared: bool = False,
     **model_kwargs,
 ) -> SamPredictor:
     r"""Get the Segment Anything Predictor.
@@ -355,6 +477,10 @@ def get_sam_model(
         flexible_load_checkpoint: Whether to adjust mismatching params while loading pretrained checkpoints.
             By default, set to 'False'.
         progress_bar_factory: A function to create a progress bar for the model download.
+        shared: Whether to return a shared model from the in-process model registry. If set to 'True',
+            the model is only loaded once for the same model type, checkpoint, device and model parameters,
+            and later calls return the same predictor, model and state. Shared models must not be modified,
+            e.g. by training them. See also `set_model_registry`. By default, set to 'False'.
         model_kwargs: Additional parameters necessary to initialize the Segment Anything model.
 
     Returns:
@@ -362,6 +488,31 @@ def get_sam_model(
     """
     device = get_device(device)
 
+    if shared:
+        key = _MODEL_REGISTRY.get_key(
+            model_type, device, checkpoint_path, peft_kwargs, flexible_load_checkpoint, model_kwargs
+        )
+        entry = _MODEL_REGISTRY.get(key)
+        if entry is None:
+            predictor, sam, state = get_sam_model(
+                model_type=model_type, device=device, checkpoint_path=checkpoint_path,
+                return_sam=True, return_state=True,
+                peft_kwargs=None if peft_kwargs is None else dict(peft_kwargs),
+                flexible_load_checkpoint=flexible_load_checkpoint, progress_bar_factory=progress_bar_factory,
+                **model_kwargs,
+            )
+            entry = {"predictor": predictor, "sam": sam, "state": state, "decoders": {}}
+            _MODEL_REGISTRY.put(key, entry)
+
+        predictor, sam, state = entry["predictor"], entry["sam"], entry["state"]
+        if return_sam and return_state:
+            return predictor, sam, state
+        if return_sam:
+            return predictor, sam
+        if return_state:
+            return predictor, state
+        return predictor
+
     # We support passing a local filepath to a checkpoint.
     # In this case we do not download any weights but just use the local weight file,
     # as it is, without copying it over anywhere or checking it's hashes.
@@ -594,6 +745,234 @@ def get_model_names() -> Iterable:
     return model_names
 
 
+class _OptimizedEncoderForward:
+    """Forward function of an image encoder that applies the inference optimizations of `optimize_image_encoder`.
+
+    It is set as the `forward` attribute of the encoder instance, so that all encoder calls use it.
+    The compiled function is not pickled, so that the model can still be passed to worker processes,
+    where the function is compiled again on the first call.
+    """
+    def __init__(self, encoder, use_compile, autocast_dtype, channels_last):
+        self.encoder = encoder
+        self.use_compile = use_compile
+        self.autocast_dtype = autocast_dtype
+        self.channels_last = channels_last
+        self._forward = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_forward"] = None
+        return state
+
+    def _get_forward(self):
+        if self._forward is None:
+            forward = type(self.encoder).forward.__get__(self.encoder)
+            self._forward = torch.compile(forward) if self.use_compile else forward
+        return self._forward
+
+    def __call__(self, x):
+        forward = self._get_forward()
+        with torch.inference_mode():
+            if self.channels_last:
+                x = x.contiguous(memory_format=torch.channels_last)
+            if self.autocast_dtype is None:
+                features = forward(x)
+            else:
+                with torch.autocast(x.device.type, dtype=getattr(torch, self.autocast_dtype)):
+                    features = forward(x).float()
+            features = features.contiguous()
+        # Clone the features outside of inference mode, so that they behave like normal tensors downstream.
+        return features.clone()
+
+
+class _OnnxEncoderForward:
+    """Forward function of an image encoder that runs an exported ONNX encoder with onnxruntime.
+
+    The inference session is not pickled, it is created again on the first call in worker processes.
+    """
+    def __init__(self, model_path, providers, n_threads):
+        self.model_path = model_path
+        self.model_hash = _compute_hash(model_path)
+        self.providers = providers
+        self.n_threads = n_threads
+        self._session = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_session"] = None
+        return state
+
+    def _get_session(self):
+        if self._session is None:
+            try:
+                import onnxruntime
+            except ImportError:
+                raise ImportError("The onnxruntime backend requires onnxruntime. Please install it.")
+            options = onnxruntime.SessionOptions()
+            if self.n_threads is not None:
+                options.intra_op_num_threads = self.n_threads
+            self._session = onnxruntime.InferenceSession(
+                str(self.model_path), sess_options=options, providers=self.providers,
+            )
+        return self._session
+
+    def __call__(self, x):
+        session = self._get_session()
+        input_name = session.get_inputs()[0].name
+        features = session.run(None, {input_name: x.detach().cpu().numpy().astype("float32")})[0]
+        return torch.from_numpy(features).to(x.device)
+
+
+_ENCODER_BACKENDS = ("torch", "onnxruntime")
+
+
+_DEFAULT_IMAGE_ENCODER_CONFIG = {"backend": "torch", "autocast_dtype": None, "channels_last": False, "compile": False}
+
+
+def _get_image_encoder_config(predictor):
+    # The configuration of the image encoder is part of the embedding signature,
+    # because the optimizations and the backend change the embeddings.
+    forward = predictor.model.image_encoder.__dict__.get("forward")
+    config = dict(_DEFAULT_IMAGE_ENCODER_CONFIG)
+    if isinstance(forward, _OptimizedEncoderForward):
+        config.update(
+            {"autocast_dtype": forward.autocast_dtype, "channels_last": forward.channels_last,
+             "compile": forward.use_compile}
+        )
+    elif isinstance(forward, _OnnxEncoderForward):
+        config.update({"backend": "onnxruntime", "onnx_hash": forward.model_hash})
+    return config
+
+
+def _reset_image_encoder(encoder):
+    if isinstance(encoder.__dict__.get("forward"), (_OptimizedEncoderForward, _OnnxEncoderForward)):
+        del encoder.forward
+    encoder.to(memory_format=torch.contiguous_format)
+
+
+def optimize_image_encoder(
+    predictor: SamPredictor,
+    use_compile: bool = False,
+    autocast_dtype: Optional[str] = None,
+    channels_last: bool = False,
+    warmup: bool = True,
+    check_accuracy: bool = True,
+    tolerance: float = 0.05,
+) -> Optional[float]:
+    """Optimize the image encoder of the predictor for inference.
+
+    The encoder is run in `torch.inference_mode` and can additionally be compiled with `torch.compile`,
+    run with autocast in reduced precision (e.g. 'bfloat16' on the CPU) and use the channels-last memory format.
+    The optimizations apply to all encoder calls, i.e. to `precompute_image_embeddings` and `predictor.set_image`.
+    They are opt-in, because reduced precision changes the embeddings slightly and compilation takes time up-front.
+    The optimizations are part of the embedding signature, so cached embeddings are only reused for the same
+    optimizations and a warning is raised when loading saved embeddings that were computed with other optimizations.
+    If the predictor was loaded with `get_sam_model(shared=True)` the optimizations apply to all its users.
+
+    Args:
+        predictor: The predictor, e.g. as returned by `get_sam_model`.
+        use_compile: Whether to compile the encoder with `torch.compile`. By default, set to 'False'.
+        autocast_dtype: The dtype for running the encoder with autocast, e.g. 'bfloat16'.
+            If 'None', the encoder runs in float32. By default, set to 'None'.
+        channels_last: Whether to use the channels-last memory format. By default, set to 'False'.
+        warmup: Whether to run the encoder once, so that compilation happens here and not in the first
+            interactive call. By default, set to 'True'.
+        check_accuracy: Whether to compare the embeddings of the optimized encoder to the float32 embeddings
+            for a random input. If the relative error exceeds `tolerance` the optimizations are reverted
+            and a warning is raised. By default, set to 'True'.
+        tolerance: The maximal relative error of the optimized embeddings. By default, set to '0.05'.
+
+    Returns:
+        The relative error of the optimized embeddings compared to the float32 embeddings,
+            if `check_accuracy` is set, 'None' otherwise.
+    """
+    if autocast_dtype is not None and not isinstance(getattr(torch, autocast_dtype, None), torch.dtype):
+        raise ValueError(f"Invalid autocast dtype: {autocast_dtype}.")
+
+    encoder = predictor.model.image_encoder
+    _reset_image_encoder(encoder)
+    if channels_last:
+        encoder.to(memory_format=torch.channels_last)
+    encoder.forward = _OptimizedEncoderForward(encoder, use_compile, autocast_dtype, channels_last)
+
+    if not (warmup or check_accuracy):
+        return None
+
+    generator = torch.Generator().manual_seed(0)
+    x = torch.randn(1, 3, encoder.img_size, encoder.img_size, generator=generator).to(predictor.device)
+    features = encoder(x)
+    if not check_accuracy:
+        return None
+
+    with torch.inference_mode():
+        expected = type(encoder).forward(encoder, x.contiguous())
+    error = ((features - expected).abs().mean() / expected.abs().mean()).item()
+    if error > tolerance:
+        _reset_image_encoder(encoder)
+        warnings.warn(
+            f"The optimized image encoder has a relative error of {error} compared to float32, which is above the "
+            f"tolerance of {tolerance}. The optimizations were reverted."
+        )
+    return error
+
+
+def set_image_encoder_backend(
+    predictor: SamPredictor,
+    backend: str = "torch",
+    model_path: Optional[Union[str, os.PathLike]] = None,
+    providers: Optional[List[str]] = None,
+    n_threads: Optional[int] = None,
+) -> None:
+    """Set the backend for running the image encoder of the predictor.
+
+    The 'onnxruntime' backend runs an image encoder that was exported with
+    `micro_sam.bioimageio.bioengine_export.export_onnx_image_encoder`. It is used for all encoder calls,
+    i.e. in `precompute_image_embeddings`, `batched_inference` and `predictor.set_image`.
+    The prompt encoder and mask decoder still run in PyTorch.
+    The exported encoder must have been exported from the same model as the predictor.
+    The backend is part of the embedding signature, so cached embeddings are only reused for the same backend.
+    To use the backend in the annotators, load the predictor with `get_sam_model(shared=True)`
+    for the same model and device as the annotator and set the backend before starting it.
+
+    Args:
+        predictor: The predictor, e.g. as returned by `get_sam_model`.
+        backend: The backend, either 'torch' or 'onnxruntime'. 'torch' resets the encoder to the default
+            PyTorch implementation. By default, set to 'torch'.
+        model_path: The path to the exported ONNX image encoder. Required for the 'onnxruntime' backend.
+        providers: The onnxruntime execution providers. By default, uses the CPU execution provider.
+        n_threads: The number of threads for onnxruntime. By default, onnxruntime chooses it.
+    """
+    if backend not in _ENCODER_BACKENDS:
+        raise ValueError(f"Invalid encoder backend: {backend}. Choose one of {_ENCODER_BACKENDS}.")
+
+    encoder = predictor.model.image_encoder
+    _reset_image_encoder(encoder)
+    if backend == "torch":
+        return
+
+    if model_path is None:
+        raise ValueError("The 'onnxruntime' backend requires the path to the exported encoder.")
+    providers = ["CPUExecutionProvider"] if providers is None else providers
+    forward = _OnnxEncoderForward(model_path, providers, n_threads)
+    # Create the session here, so that a missing dependency or invalid model is reported right away.
+    session = forward._get_session()
+
+    # Check that the encoder was exported from the same model, using the model hash stored in its metadata.
+    metadata = session.get_modelmeta().custom_metadata_map
+    model_hash = getattr(predictor, "_hash", None)
+    if "micro_sam_model_hash" not in metadata:
+        warnings.warn(
+            f"The onnx image encoder {model_path} does not store the hash of the model it was exported from. "
+            "Cannot check that it matches the predictor's model."
+        )
+    elif model_hash is not None and metadata["micro_sam_model_hash"] != model_hash:
+        raise ValueError(
+            f"The onnx image encoder {model_path} was exported from a different model than the predictor's model: "
+            f"{metadata['micro_sam_model_hash']} != {model_hash}."
+        )
+    encoder.forward = forward
+
+
 #
 # Functionality for precomputing image embeddings.
 #
@@ -650,18 +1029,116 @@ def _compute_embeddings_batched(predictor, batched_images):
     return features, original_sizes, input_sizes
 
 
+# The dtypes and compressors that are supported for storing the embeddings.
+_STORAGE_DTYPES = ("float32", "float16", "bfloat16", "int8")
+_COMPRESSIONS = ("gzip", "lz4", "zstd")
+
+
+class _EmbeddingCodec(numcodecs.abc.Codec):
+    """Codec for storing the float32 embeddings with a reduced precision.
+
+    Supports 'float16', 'bfloat16' and 'int8'. For 'int8' the embeddings are quantized per channel,
+    the scale and offset for each channel are stored in the header of each encoded chunk.
+    The chunks are always decoded to float32, so that reading the embeddings is transparent.
+    The embeddings are expected to have the channel axis in the third to last position.
+    """
+    codec_id = "micro_sam_embedding"
+
+    def __init__(self, dtype):
+        if dtype not in _STORAGE_DTYPES[1:]:
+            raise ValueError(f"Invalid dtype {dtype} for embedding codec, expect one of {_STORAGE_DTYPES[1:]}.")
+        self.dtype = dtype
+
+    def encode(self, buf):
+        data = np.asarray(buf, dtype="float32")
+
+        # We return typed arrays for float16 and bfloat16, so that the byte shuffle of the compressor is effective.
+        if self.dtype == "float16":
+            return data.astype("float16")
+
+        if self.dtype == "bfloat16":
+            # Round to the nearest bfloat16 value (ties to even) and keep the upper 16 bits.
+            bits = np.ascontiguousarray(data).view("uint32").astype("uint64")
+            bits = (bits + 0x7FFF + ((bits >> 16) & 1)) >> 16
+            return bits.astype("uint16")
+
+        # Per-channel int8 quantization: each row of the data with flattened spatial axes is one channel.
+        data = data.reshape(-1, data.shape[-2] * data.shape[-1]) if data.ndim >= 3 else data.reshape(1, -1)
+        min_, max_ = data.min(axis=1, keepdims=True), data.max(axis=1, keepdims=True)
+        offset = (max_ + min_) / 2
+        scale = (max_ - min_) / 254
+        scale[scale == 0] = 1.0
+        quantized = np.clip(np.round((data - offset) / scale), -127, 127).astype("int8")
+        header = np.array([data.shape[0]], dtype="uint32").tobytes()
+        return header + scale.astype("float32").tobytes() + offset.astype("float32").tobytes() + quantized.tobytes()
+
+    def decode(self, buf, out=None):
+        buf = numcodecs.compat.ensure_contiguous_ndarray(buf).view("uint8")
+
+        if self.dtype == "float16":
+            data = buf.view("float16").astype("float32")
+        elif self.dtype == "bfloat16":
+            data = (buf.view("uint16").astype("uint32") << 16).view("float32")
+        else:
+            n_rows = int(buf[:4].view("uint32")[0])
+            scale = buf[4:4 + 4 * n_rows].view("float32")[:, None]
+            offset = buf[4 + 4 * n_rows:4 + 8 * n_rows].view("float32")[:, None]
+            quantized = buf[4 + 8 * n_rows:].view("int8").reshape(n_rows, -1)
+            data = (quantized.astype("float32") * scale + offset).ravel()
+
+        return numcodecs.compat.ndarray_copy(data, out)
+
+    def get_config(self):
+        return {"id": self.codec_id, "dtype": self.dtype}
+
+
+numcodecs.register_codec(_EmbeddingCodec)
+
+
+def _get_storage_kwargs(storage_dtype="float32", compression="gzip"):
+    if storage_dtype not in _STORAGE_DTYPES:
+        raise ValueError(f"Invalid storage_dtype {storage_dtype}, expect one of {_STORAGE_DTYPES}.")
+    if compression not in _COMPRESSIONS:
+        raise ValueError(f"Invalid compression {compression}, expect one of {_COMPRESSIONS}.")
+
+    zarr_major_version = int(zarr.__version__.split(".")[0])
+    if zarr_major_version == 2:
+        if compression == "gzip":
+            storage_kwargs = {"compression": "gzip"}
+        else:
+            storage_kwargs = {"compressor": numcodecs.Blosc(cname=compression, shuffle=numcodecs.Blosc.SHUFFLE)}
+        if storage_dtype != "float32":
+            storage_kwargs["filters"] = [_EmbeddingCodec(storage_dtype)]
+
+    elif zarr_major_version == 3:
+        if storage_dtype != "float32":
+            raise RuntimeError(f"Storing embeddings as {storage_dtype} is only supported for zarr v2.")
+        if compression == "gzip":
+            storage_kwargs = {"compressors": [zarr.codecs.GzipCodec()]}
+        else:
+            storage_kwargs = {
+                "compressors": [zarr.codecs.BloscCodec(cname=compression, shuffle=zarr.codecs.BloscShuffle.shuffle)]
+            }
+
+    else:
+        raise RuntimeError(f"Unsupported zarr version: {zarr_major_version}")
+
+    return storage_kwargs
+
+
 # Wrapper of zarr.create dataset to support zarr v2 and zarr v3.
-def _create_dataset_with_data(group, name, data, chunks=None):
+def _create_dataset_with_data(group, name, data, chunks=None, storage_dtype="float32", compression="gzip"):
     zarr_major_version = int(zarr.__version__.split(".")[0])
     if chunks is None:
         chunks = data.shape
+    storage_kwargs = _get_storage_kwargs(storage_dtype, compression)
     if zarr_major_version == 2:
         ds = group.create_dataset(
-            name, data=data, shape=data.shape, compression="gzip", chunks=chunks
+            name, data=data, shape=data.shape, chunks=chunks, **storage_kwargs
         )
     elif zarr_major_version == 3:
         ds = group.create_array(
-            name, shape=data.shape, compressors=[zarr.codecs.GzipCodec()], chunks=chunks, dtype=data.dtype,
+            name, shape=data.shape, chunks=chunks, dtype=data.dtype, **storage_kwargs
         )
         ds[:] = data
     else:
@@ -669,22 +1146,77 @@ def _create_dataset_with_data(group, name, data, chunks=None):
     return ds
 
 
-def _create_dataset_without_data(group, name, shape, dtype, chunks):
+def _create_dataset_without_data(group, name, shape, dtype, chunks, storage_dtype="float32", compression="gzip"):
     zarr_major_version = int(zarr.__version__.split(".")[0])
+    storage_kwargs = _get_storage_kwargs(storage_dtype, compression)
     if zarr_major_version == 2:
         ds = group.create_dataset(
-            name, shape=shape, dtype=dtype, compression="gzip", chunks=chunks
+            name, shape=shape, dtype=dtype, chunks=chunks, **storage_kwargs
         )
     elif zarr_major_version == 3:
         ds = group.create_array(
-            name, shape=shape, compressors=[zarr.codecs.GzipCodec()], chunks=chunks, dtype=dtype
+            name, shape=shape, chunks=chunks, dtype=dtype, **storage_kwargs
         )
     else:
         raise RuntimeError(f"Unsupported zarr version: {zarr_major_version}")
     return ds
 
 
-def _compute_tiled_features_2d(predictor, input_, tile_shape, halo, f, pbar_init, pbar_update, batch_size):
+def _run_batches(predictor, n_batches, load_batch, write_batch, pipelined):
+    """Run the embedding computation for all batches.
+
+    Each batch is processed in three stages: 'load_batch' loads and prepares the input images,
+    the image encoder computes the embeddings and 'write_batch' stores them.
+    If 'pipelined' is True the loading of the next batch and the writing of the previous batch
+    run in background threads, so that the image encoder does not wait for data I/O or compression.
+
+    Returns the original size and input size of the last batch that was computed.
+    """
+    sizes = {"original_size": None, "input_size": None}
+
+    def encode(batch):
+        keys, batched_images = batch
+        # All images of this batch may have been skipped, e.g. when resuming from partial features.
+        if len(batched_images) == 0:
+            return None
+        batched_embeddings, original_sizes, input_sizes = _compute_embeddings_batched(predictor, batched_images)
+        sizes["original_size"], sizes["input_size"] = original_sizes[-1], input_sizes[-1]
+        return keys, batched_embeddings.cpu().numpy(), original_sizes, input_sizes
+
+    def write(result):
+        if result is not None:
+            write_batch(*result)
+
+    if not pipelined:
+        for batch_id in range(n_batches):
+            write(encode(load_batch(batch_id)))
+        return sizes["original_size"], sizes["input_size"]
+
+    # We use a single thread for loading and a single thread for writing, so that batches
+    # are loaded and written in order. At most one batch is prefetched and at most one batch
+    # is waiting to be written (double buffering), which bounds the memory overhead.
+    with ThreadPoolExecutor(max_workers=1) as loader, ThreadPoolExecutor(max_workers=1) as writer:
+        next_batch = loader.submit(load_batch, 0) if n_batches > 0 else None
+        pending_write = None
+        for batch_id in range(n_batches):
+            batch = next_batch.result()
+            if batch_id + 1 < n_batches:
+                next_batch = loader.submit(load_batch, batch_id + 1)
+            result = encode(batch)
+            # Wait for the previous write to finish. This also raises errors that occurred during writing.
+            if pending_write is not None:
+                pending_write.result()
+            pending_write = writer.submit(write, result)
+        if pending_write is not None:
+            pending_write.result()
+
+    return sizes["original_size"], sizes["input_size"]
+
+
+def _compute_tiled_features_2d(
+    predictor, input_, tile_shape, halo, f, pbar_init, pbar_update, batch_size, pipelined=False, storage=None
+):
+    storage = {} if storage is None else storage
     tiling = blocking([0, 0], input_.shape[:2], tile_shape)
     n_tiles = tiling.numberOfBlocks
 
@@ -694,35 +1226,53 @@ def _compute_tiled_features_2d(predictor, input_, tile_shape, halo, f, pbar_init
     features.attrs["halo"] = halo
 
     pbar_init(n_tiles, "Compute Image Embeddings 2D tiled")
+    # The manifest of the tiles that are already computed, for resuming an interrupted computation.
+    manifest = _CompletionManifest(f, n_tiles, input_, predictor, tile_shape, halo)
 
-    n_batches = int(np.ceil(n_tiles / batch_size))
-    for batch_id in range(n_batches):
+    def load_batch(batch_id):
         tile_start = batch_id * batch_size
         tile_stop = min(tile_start + batch_size, n_tiles)
 
-        batched_images = []
+        batched_images, batched_tile_ids = [], []
         for tile_id in range(tile_start, tile_stop):
+            if manifest.is_done(tile_id):
+                continue
             tile = tiling.getBlockWithHalo(tile_id, list(halo))
             outer_tile = tuple(slice(beg, end) for beg, end in zip(tile.outerBlock.begin, tile.outerBlock.end))
             tile_input = _to_image(input_[outer_tile])
             batched_images.append(tile_input)
-
-        batched_embeddings, original_sizes, input_sizes = _compute_embeddings_batched(predictor, batched_images)
-        for i, tile_id in enumerate(range(tile_start, tile_stop)):
-            tile_embeddings, original_size, input_size = batched_embeddings[i], original_sizes[i], input_sizes[i]
-            # Unsqueeze the channel axis of the tile embeddings.
-            tile_embeddings = tile_embeddings.unsqueeze(0)
-            ds = _create_dataset_with_data(features, str(tile_id), data=tile_embeddings.cpu().numpy())
-            ds.attrs["original_size"] = original_size
-            ds.attrs["input_size"] = input_size
+            batched_tile_ids.append(tile_id)
+        return batched_tile_ids, batched_images
+
+    def write_batch(tile_ids, batched_embeddings, original_sizes, input_sizes):
+        for i, tile_id in enumerate(tile_ids):
+            # Keep the channel axis of the tile embeddings.
+            tile_embeddings = batched_embeddings[i:i+1]
+            # The dataset may already exist if a previous computation was interrupted while writing this tile.
+            if str(tile_id) in features:
+                ds = features[str(tile_id)]
+                ds[:] = tile_embeddings
+            else:
+                ds = _create_dataset_with_data(features, str(tile_id), data=tile_embeddings, **storage)
+            ds.attrs["original_size"] = original_sizes[i]
+            ds.attrs["input_size"] = input_sizes[i]
             pbar_update(1)
+        manifest.set_done(tile_ids)
+
+    n_batches = int(np.ceil(n_tiles / batch_size))
+    _run_batches(predictor, n_batches, load_batch, write_batch, pipelined)
 
-    _write_embedding_signature(f, input_, predictor, tile_shape, halo, input_size=None, original_size=None)
+    _write_embedding_signature(
+        f, input_, predictor, tile_shape, halo, input_size=None, original_size=None, storage=storage
+    )
     return features
 
 
-def _compute_tiled_features_3d(predictor, input_, tile_shape, halo, f, pbar_init, pbar_update, batch_size):
+def _compute_tiled_features_3d(
+    predictor, input_, tile_shape, halo, f, pbar_init, pbar_update, batch_size, pipelined=False, storage=None
+):
     assert input_.ndim == 3
+    storage = {} if storage is None else storage
 
     shape = input_.shape[1:]
     tiling = blocking([0, 0], shape, tile_shape)
@@ -736,45 +1286,58 @@ def _compute_tiled_features_3d(predictor, input_, tile_shape, halo, f, pbar_init
     n_slices = input_.shape[0]
     pbar_init(n_tiles * n_slices, "Compute Image Embeddings 3D tiled")
 
-    # We batch across the z axis.
-    n_batches = int(np.ceil(n_slices / batch_size))
+    # We batch across the z axis, separately for each tile.
+    n_batches_per_tile = int(np.ceil(n_slices / batch_size))
+    n_batches = n_tiles * n_batches_per_tile
+    # The manifest of the tiles and slices that are already computed, for resuming an interrupted computation.
+    manifest = _CompletionManifest(f, n_tiles * n_slices, input_, predictor, tile_shape, halo)
 
-    for tile_id in range(n_tiles):
+    def load_batch(batch_id):
+        tile_id, z_batch_id = divmod(batch_id, n_batches_per_tile)
         tile = tiling.getBlockWithHalo(tile_id, list(halo))
         outer_tile = tuple(slice(beg, end) for beg, end in zip(tile.outerBlock.begin, tile.outerBlock.end))
 
-        ds = None
-        for batch_id in range(n_batches):
-            z_start = batch_id * batch_size
-            z_stop = min(z_start + batch_size, n_slices)
-
-            batched_images = []
-            for z in range(z_start, z_stop):
-                tile_input = _to_image(input_[z][outer_tile])
-                batched_images.append(tile_input)
-
-            batched_embeddings, original_sizes, input_sizes = _compute_embeddings_batched(predictor, batched_images)
-            for i, z in enumerate(range(z_start, z_stop)):
-                tile_embeddings = batched_embeddings[i].unsqueeze(0)
-                if ds is None:
-                    shape = (n_slices,) + tile_embeddings.shape
-                    chunks = (1,) + tile_embeddings.shape
-                    ds = _create_dataset_without_data(
-                        features, str(tile_id), shape=shape, dtype="float32", chunks=chunks
-                    )
-
-                ds[z] = tile_embeddings.cpu().numpy()
-                pbar_update(1)
+        z_start = z_batch_id * batch_size
+        z_stop = min(z_start + batch_size, n_slices)
+
+        batched_images, batched_keys = [], []
+        for z in range(z_start, z_stop):
+            if manifest.is_done(tile_id * n_slices + z):
+                continue
+            tile_input = _to_image(input_[z][outer_tile])
+            batched_images.append(tile_input)
+            batched_keys.append((tile_id, z))
+        return batched_keys, batched_images
+
+    def write_batch(keys, batched_embeddings, original_sizes, input_sizes):
+        for i, (tile_id, z) in enumerate(keys):
+            tile_embeddings = batched_embeddings[i:i+1]
+            ds_name = str(tile_id)
+            if ds_name in features:
+                ds = features[ds_name]
+            else:
+                shape = (n_slices,) + tile_embeddings.shape
+                chunks = (1,) + tile_embeddings.shape
+                ds = _create_dataset_without_data(
+                    features, ds_name, shape=shape, dtype="float32", chunks=chunks, **storage
+                )
+            ds[z] = tile_embeddings
+            pbar_update(1)
 
         ds.attrs["original_size"] = original_sizes[-1]
         ds.attrs["input_size"] = input_sizes[-1]
+        manifest.set_done([tile_id * n_slices + z for tile_id, z in keys])
 
-    _write_embedding_signature(f, input_, predictor, tile_shape, halo, input_size=None, original_size=None)
+    _run_batches(predictor, n_batches, load_batch, write_batch, pipelined)
+
+    _write_embedding_signature(
+        f, input_, predictor, tile_shape, halo, input_size=None, original_size=None, storage=storage
+    )
 
     return features
 
 
-def _compute_2d(input_, predictor, f, save_path, pbar_init, pbar_update):
+def _compute_2d(input_, predictor, f, save_path, pbar_init, pbar_update, storage=None):
     # Check if the embeddings are already cached.
     if save_path is not None and "input_size" in f.attrs:
         # In this case we load the embeddings.
@@ -796,16 +1359,20 @@ def _compute_2d(input_, predictor, f, save_path, pbar_init, pbar_update):
 
     # Save the embeddings if we have a save_path.
     if save_path is not None:
-        _create_dataset_with_data(f, "features", data=features)
+        storage = {} if storage is None else storage
+        _create_dataset_with_data(f, "features", data=features, **storage)
         _write_embedding_signature(
-            f, input_, predictor, tile_shape=None, halo=None, input_size=input_size, original_size=original_size,
+            f, input_, predictor, tile_shape=None, halo=None,
+            input_size=input_size, original_size=original_size, storage=storage,
         )
 
     image_embeddings = {"features": features, "input_size": input_size, "original_size": original_size}
     return image_embeddings
 
 
-def _compute_tiled_2d(input_, predictor, tile_shape, halo, f, pbar_init, pbar_update, batch_size):
+def _compute_tiled_2d(
+    input_, predictor, tile_shape, halo, f, pbar_init, pbar_update, batch_size, pipelined=False, storage=None
+):
     # Check if the features are already computed.
     if "input_size" in f.attrs:
         features = f["features"]
@@ -815,12 +1382,112 @@ def _compute_tiled_2d(input_, predictor, tile_shape, halo, f, pbar_init, pbar_up
 
     # Otherwise compute them. Note: saving happens automatically because we
     # always write the features to zarr. If no save path is given we use an in-memory zarr.
-    features = _compute_tiled_features_2d(predictor, input_, tile_shape, halo, f, pbar_init, pbar_update, batch_size)
+    features = _compute_tiled_features_2d(
+        predictor, input_, tile_shape, halo, f, pbar_init, pbar_update, batch_size, pipelined, storage
+    )
     image_embeddings = {"features": features, "input_size": None, "original_size": None}
     return image_embeddings
 
 
-def _compute_3d(input_, predictor, f, save_path, lazy_loading, pbar_init, pbar_update, batch_size):
+def _get_slice_order(slice_order, n_slices):
+    """Get the order in which the slices are computed.
+
+    The slices in 'slice_order' come first, all other slices follow in ascending order.
+    """
+    if slice_order is None:
+        return list(range(n_slices))
+    order = [int(z) for z in dict.fromkeys(slice_order)]
+    if any(z < 0 or z >= n_slices for z in order):
+        raise ValueError(f"Invalid slice order {slice_order} for {n_slices} slices.")
+    prioritized = set(order)
+    return order + [z for z in range(n_slices) if z not in prioritized]
+
+
+class _CompletionManifest:
+    """Manifest of the slices or tiles whose embeddings are completely written to a zarr container.
+
+    The manifest is a boolean dataset with one entry per slice, per tile, or per tile and slice for tiled volumes.
+    An entry is only set after the embeddings were written, and zarr writes each chunk atomically via a temporary file,
+    so that an interrupted computation can be resumed without reading the embeddings.
+    The manifest stores the signature of the data, model and tiling and is reset if it does not match.
+    """
+    name = "completed"
+    chunk_size = 4096
+
+    def __init__(self, f, n_entries, input_, predictor, tile_shape, halo, legacy_done=None):
+        signature = _get_embedding_signature(input_, predictor, tile_shape, halo)
+        signature.pop("micro_sam_version")
+        signature = json.dumps(signature, sort_keys=True)
+
+        exists = self.name in f
+        if exists and f[self.name].shape == (n_entries,) and f[self.name].attrs.get("signature") == signature:
+            self._ds = f[self.name]
+            self._done = self._ds[:]
+            return
+
+        # Partial embeddings computed with older versions don't have a manifest,
+        # in this case the entries that are already computed can be derived via 'legacy_done'.
+        if exists:
+            del f[self.name]
+        self._done = legacy_done() if (legacy_done is not None and not exists) else np.zeros(n_entries, dtype="bool")
+        self._ds = _create_dataset_without_data(
+            f, self.name, shape=(n_entries,), dtype="bool", chunks=(min(max(n_entries, 1), self.chunk_size),)
+        )
+        self._ds.attrs["signature"] = signature
+        if self._done.any():
+            self._ds[:] = self._done
+
+    def is_done(self, index):
+        return bool(self._done[index])
+
+    def set_done(self, indices):
+        indices = np.asarray(indices, dtype="int64")
+        if indices.size == 0:
+            return
+        self._done[indices] = True
+        # Only the chunks of the manifest that contain the updated entries are written.
+        for chunk_id in np.unique(indices // self.chunk_size):
+            start = chunk_id * self.chunk_size
+            stop = min(start + self.chunk_size, len(self._done))
+            self._ds[start:stop] = self._done[start:stop]
+
+
+def _require_features_3d(input_, predictor, f, save_path, storage):
+    """Get the array for the features of a volume and the manifest of the slices that are already computed.
+
+    The manifest is None if the features are not saved.
+    """
+    storage = {} if storage is None else storage
+    embed_shape = (1, 256, 64, 64)
+    n_slices = input_.shape[0]
+    shape = (n_slices,) + embed_shape
+
+    # If we don't have a save path we write the features into a pre-allocated array, so that the embeddings
+    # of each slice can be used (e.g. via 'slice_callback') while the other slices are computed.
+    if save_path is None:
+        return np.zeros(shape, dtype="float32"), None
+
+    chunks = (1,) + embed_shape
+    if "features" in f:
+        features = f["features"]
+        if features.shape != shape or features.chunks != chunks:
+            raise RuntimeError("Invalid partial features")
+
+        # For partial features without a manifest the slices that are not computed yet are zero.
+        def legacy_done():
+            return np.array([np.count_nonzero(features[z]) != 0 for z in range(n_slices)], dtype="bool")
+
+        manifest = _CompletionManifest(f, n_slices, input_, predictor, None, None, legacy_done=legacy_done)
+        return features, manifest
+
+    features = _create_dataset_without_data(f, "features", shape=shape, chunks=chunks, dtype="float32", **storage)
+    return features, _CompletionManifest(f, n_slices, input_, predictor, None, None)
+
+
+def _compute_3d(
+    input_, predictor, f, save_path, lazy_loading, pbar_init, pbar_update, batch_size, pipelined=False, storage=None,
+    slice_order=None, slice_callback=None,
+):
     # Check if the embeddings are already fully cached.
     if save_path is not None and "input_size" in f.attrs:
         # In this case we load the embeddings.
@@ -830,68 +1497,181 @@ def _compute_3d(input_, predictor, f, save_path, lazy_loading, pbar_init, pbar_u
         return image_embeddings
 
     # Otherwise we have to compute the embeddings.
-
-    # First check if we have a save path or not and set things up accordingly.
-    if save_path is None:
-        features = []
-        save_features = False
-        partial_features = False
-    else:
-        save_features = True
-        embed_shape = (1, 256, 64, 64)
-        shape = (input_.shape[0],) + embed_shape
-        chunks = (1,) + embed_shape
-        if "features" in f:
-            partial_features = True
-            features = f["features"]
-            if features.shape != shape or features.chunks != chunks:
-                raise RuntimeError("Invalid partial features")
-        else:
-            partial_features = False
-            features = _create_dataset_without_data(f, "features", shape=shape, chunks=chunks, dtype="float32")
+    save_features = save_path is not None
+    features, manifest = _require_features_3d(input_, predictor, f, save_path, storage)
 
     # Initialize the pbar and batches.
     n_slices = input_.shape[0]
     pbar_init(n_slices, "Compute Image Embeddings 3D")
+    order = _get_slice_order(slice_order, n_slices)
     n_batches = int(np.ceil(n_slices / batch_size))
 
-    for batch_id in range(n_batches):
-        z_start = batch_id * batch_size
-        z_stop = min(z_start + batch_size, n_slices)
+    # The (partial) embeddings that are passed to the slice callback.
+    if slice_callback is not None:
+        expected_original_size = tuple(input_.shape[1:3])
+        partial_embeddings = {
+            "features": features,
+            "input_size": predictor.transform.get_preprocess_shape(
+                *expected_original_size, predictor.transform.target_length
+            ),
+            "original_size": expected_original_size,
+        }
+
+    def load_batch(batch_id):
+        batch_slices = order[batch_id * batch_size:(batch_id + 1) * batch_size]
 
         batched_images, batched_z = [], []
-        for z in range(z_start, z_stop):
-            # Skip feature computation in case of partial features in non-zero slice.
-            if partial_features and np.count_nonzero(features[z]) != 0:
+        for z in batch_slices:
+            # Skip feature computation for slices that were already computed, when resuming from partial features.
+            if manifest is not None and manifest.is_done(z):
+                if slice_callback is not None:
+                    slice_callback(z, partial_embeddings)
                 continue
             tile_input = _to_image(input_[z])
             batched_images.append(tile_input)
             batched_z.append(z)
+        return batched_z, batched_images
 
-        batched_embeddings, original_sizes, input_sizes = _compute_embeddings_batched(predictor, batched_images)
-
-        for z, embedding in zip(batched_z, batched_embeddings):
-            embedding = embedding.unsqueeze(0)
-            if save_features:
-                features[z] = embedding.cpu().numpy()
-            else:
-                features.append(embedding.unsqueeze(0))
+    def write_batch(batched_z, batched_embeddings, original_sizes, input_sizes):
+        for i, z in enumerate(batched_z):
+            features[z] = batched_embeddings[i:i+1]
+            if slice_callback is not None:
+                slice_callback(z, partial_embeddings)
             pbar_update(1)
+        if manifest is not None:
+            manifest.set_done(batched_z)
+
+    original_size, input_size = _run_batches(predictor, n_batches, load_batch, write_batch, pipelined)
+    # All slices were already computed, e.g. when resuming from partial features.
+    # In this case we derive the sizes from the input shape.
+    if input_size is None:
+        original_size = tuple(input_.shape[1:3])
+        input_size = predictor.transform.get_preprocess_shape(*original_size, predictor.transform.target_length)
 
     if save_features:
         _write_embedding_signature(
             f, input_, predictor, tile_shape=None, halo=None,
-            input_size=input_sizes[-1], original_size=original_sizes[-1],
+            input_size=input_size, original_size=original_size, storage=storage,
         )
-    else:
-        # Concatenate across the z axis.
-        features = torch.cat(features).cpu().numpy()
 
-    image_embeddings = {"features": features, "input_size": input_sizes[-1], "original_size": original_sizes[-1]}
+    image_embeddings = {"features": features, "input_size": input_size, "original_size": original_size}
     return image_embeddings
 
 
-def _compute_tiled_3d(input_, predictor, tile_shape, halo, f, pbar_init, pbar_update, batch_size):
+class _OnDemandFeatures:
+    """Features of a volume that are computed on demand.
+
+    The features of a slice are computed when they are accessed for the first time, together with the features of
+    the 'prefetch' slices above and below it. They are written to the underlying array, which is a zarr dataset
+    if the embeddings are saved. The slices that are already computed are given by the completion manifest
+    of the saved features. Once all slices are computed the embedding signature is written,
+    so that the embeddings are loaded as a whole when opening them again.
+    """
+    def __init__(self, input_, predictor, features, manifest, f, save_path, prefetch, batch_size, storage):
+        self._input = input_
+        self._predictor = predictor
+        self._features = features
+        self._f = f
+        self._save_path = save_path
+        self._prefetch = prefetch
+        self._batch_size = batch_size
+        self._storage = storage
+
+        self.shape = features.shape
+        self.ndim = len(self.shape)
+        self.dtype = np.dtype("float32")
+
+        self._manifest = manifest
+        n_slices = self.shape[0]
+        self._computed = np.zeros(n_slices, dtype="bool")
+        if manifest is not None:
+            self._computed[:] = [manifest.is_done(z) for z in range(n_slices)]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _is_computed(self, z):
+        return self._computed[z]
+
+    def compute(self, slices: Iterable[int]) -> None:
+        """Compute the features for the given slices, if they are not computed yet.
+
+        Args:
+            slices: The slice indices.
+        """
+        with self._lock:
+            missing = [z for z in dict.fromkeys(slices) if not self._is_computed(z)]
+            if len(missing) == 0:
+                return
+
+            for start in range(0, len(missing), self._batch_size):
+                batch = missing[start:start + self._batch_size]
+                batched_images = [_to_image(self._input[z]) for z in batch]
+                batched_embeddings, original_sizes, input_sizes = _compute_embeddings_batched(
+                    self._predictor, batched_images
+                )
+                batched_embeddings = batched_embeddings.cpu().numpy()
+                for i, z in enumerate(batch):
+                    self._features[z] = batched_embeddings[i:i+1]
+                    self._computed[z] = True
+                if self._manifest is not None:
+                    self._manifest.set_done(batch)
+
+            if self._save_path is not None and self._computed.all():
+                _write_embedding_signature(
+                    self._f, self._input, self._predictor, tile_shape=None, halo=None,
+                    input_size=input_sizes[-1], original_size=original_sizes[-1], storage=self._storage,
+                )
+
+    def __getitem__(self, index):
+        n_slices = self.shape[0]
+        z_index = index[0] if isinstance(index, tuple) else index
+        if isinstance(z_index, (int, np.integer)):
+            z = int(z_index) % n_slices
+            # The requested slice is computed first, followed by the prefetched slices.
+            slices = [z] + [
+                zz for zz in range(max(z - self._prefetch, 0), min(z + self._prefetch + 1, n_slices)) if zz != z
+            ]
+        else:
+            slices = np.arange(n_slices)[z_index].tolist()
+        self.compute(slices)
+        return self._features[index]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self[:], dtype=dtype)
+
+
+def _compute_3d_on_demand(input_, predictor, f, save_path, lazy_loading, prefetch, batch_size, storage=None):
+    # Check if the embeddings are already fully cached.
+    if save_path is not None and "input_size" in f.attrs:
+        features = f["features"] if lazy_loading else f["features"][:]
+        original_size, input_size = f.attrs["original_size"], f.attrs["input_size"]
+        return {"features": features, "input_size": input_size, "original_size": original_size}
+
+    # The signature is only written once all slices are computed. We store the data signature already now,
+    # to make sure that the partial features are only completed for the same data.
+    if save_path is not None:
+        data_signature = _compute_data_signature(input_)
+        if f.attrs.get("data_signature", data_signature) != data_signature:
+            raise RuntimeError(
+                f"Embeddings file {save_path} is invalid due to mismatch in data_signature: "
+                f"{f.attrs['data_signature']} != {data_signature}. Please recompute embeddings in a new file."
+            )
+        f.attrs["data_signature"] = data_signature
+
+    features, manifest = _require_features_3d(input_, predictor, f, save_path, storage)
+    features = _OnDemandFeatures(input_, predictor, features, manifest, f, save_path, prefetch, batch_size, storage)
+
+    # The sizes are the same for all slices, so we can derive them from the input shape.
+    original_size = tuple(input_.shape[1:3])
+    input_size = predictor.transform.get_preprocess_shape(*original_size, predictor.transform.target_length)
+    return {"features": features, "input_size": input_size, "original_size": original_size}
+
+
+def _compute_tiled_3d(
+    input_, predictor, tile_shape, halo, f, pbar_init, pbar_update, batch_size, pipelined=False, storage=None
+):
     # Check if the features are already computed.
     if "input_size" in f.attrs:
         features = f["features"]
@@ -901,14 +1681,240 @@ def _compute_tiled_3d(input_, predictor, tile_shape, halo, f, pbar_init, pbar_up
 
     # Otherwise compute them. Note: saving happens automatically because we
     # always write the features to zarr. If no save path is given we use an in-memory zarr.
-    features = _compute_tiled_features_3d(predictor, input_, tile_shape, halo, f, pbar_init, pbar_update, batch_size)
+    features = _compute_tiled_features_3d(
+        predictor, input_, tile_shape, halo, f, pbar_init, pbar_update, batch_size, pipelined, storage
+    )
     image_embeddings = {"features": features, "input_size": None, "original_size": None}
     return image_embeddings
 
 
-def _compute_data_signature(input_):
-    data_signature = hashlib.sha1(np.asarray(input_).tobytes()).hexdigest()
-    return data_signature
+#
+# Computation of the embeddings with several worker processes
+#
+
+
+# The predictor (and decoder) of an embedding worker process, see '_get_embedding_workers'.
+_WORKER = {}
+
+
+def _init_embedding_worker(model, attributes, device_queue, n_threads, decoder=None):
+    device = device_queue.get()
+    if device == "cpu":
+        torch.set_num_threads(n_threads)
+    predictor = SamPredictor(model.to(device))
+    for name, value in attributes.items():
+        setattr(predictor, name, value)
+    _WORKER["predictor"] = predictor
+    _WORKER["decoder"] = None if decoder is None else decoder.to(device)
+
+
+def _get_embedding_workers(predictor, devices, decoder=None):
+    """Get a process pool with one worker per device, each holding a copy of the predictor (and decoder).
+
+    The workers are started with 'spawn', which is required for CUDA, and the model weights are passed to them
+    via shared memory, so that the workers don't load the model checkpoint again.
+    """
+    ctx = torch.multiprocessing.get_context("spawn")
+    device_queue = ctx.Queue()
+    for device in devices:
+        device_queue.put(str(device))
+    # The workers on the CPU share the available cores.
+    n_cpu_workers = sum(str(device) == "cpu" for device in devices)
+    n_threads = max(1, (os.cpu_count() or 1) // max(n_cpu_workers, 1))
+    attributes = {
+        name: getattr(predictor, name)
+        for name in ("model_type", "model_name", "checkpoint_path", "_hash") if hasattr(predictor, name)
+    }
+    return futures.ProcessPoolExecutor(
+        len(devices), mp_context=ctx, initializer=_init_embedding_worker,
+        initargs=(predictor.model, attributes, device_queue, n_threads, decoder),
+    )
+
+
+def _compute_embeddings_in_worker(save_path, keys, images):
+    predictor = _WORKER["predictor"]
+    batched_embeddings, original_sizes, input_sizes = _compute_embeddings_batched(
+        predictor, [_to_image(image) for image in images]
+    )
+    batched_embeddings = batched_embeddings.cpu().numpy()
+
+    # Each worker writes to different chunks of the datasets, which were created in the main process.
+    f = zarr.open(save_path, mode="a")
+    for i, (name, z) in enumerate(keys):
+        if z is None:
+            f[name][:] = batched_embeddings[i:i+1]
+        else:
+            f[name][z] = batched_embeddings[i:i+1]
+    return keys, original_sizes, input_sizes
+
+
+def _compute_sharded(
+    input_, predictor, f, save_path, devices, ndim, tile_shape, halo, pbar_init, pbar_update, batch_size,
+    storage=None, slice_order=None, slice_callback=None,
+):
+    """Compute the embeddings for the slices or tiles of the input with one worker process per device.
+
+    The main process creates the datasets, the workers write the embeddings of their batches to it,
+    and the main process writes the attributes and the completion manifest for each finished batch
+    and the embedding signature once all batches are done.
+    """
+    if save_path is None:
+        raise ValueError("Computing the embeddings with several devices requires a 'save_path'.")
+    storage = {} if storage is None else storage
+    embed_shape = (1, 256, 64, 64)
+    expected_original_size, partial_embeddings = None, None
+
+    if tile_shape is None:
+        features, manifest = _require_features_3d(input_, predictor, f, save_path, storage)
+        n_slices = input_.shape[0]
+        pbar_init(n_slices, "Compute Image Embeddings 3D")
+        expected_original_size = tuple(input_.shape[1:3])
+        partial_embeddings = {
+            "features": features,
+            "input_size": predictor.transform.get_preprocess_shape(
+                *expected_original_size, predictor.transform.target_length
+            ),
+            "original_size": expected_original_size,
+        }
+
+        keys, manifest_ids = [], {}
+        for z in _get_slice_order(slice_order, n_slices):
+            # Skip feature computation for slices that were already computed, when resuming from partial features.
+            if manifest.is_done(z):
+                if slice_callback is not None:
+                    slice_callback(z, partial_embeddings)
+                continue
+            keys.append(("features", z))
+            manifest_ids[keys[-1]] = z
+
+        def load_image(key):
+            return input_[key[1]]
+
+    else:
+        shape = input_.shape[:2] if ndim == 2 else input_.shape[1:]
+        tiling = blocking([0, 0], shape, tile_shape)
+        n_tiles = tiling.numberOfBlocks
+
+        features = f.require_group("features")
+        features.attrs["shape"] = shape
+        features.attrs["tile_shape"] = tile_shape
+        features.attrs["halo"] = halo
+
+        if ndim == 2:
+            pbar_init(n_tiles, "Compute Image Embeddings 2D tiled")
+            ds_shape, ds_chunks, slices = embed_shape, embed_shape, [None]
+        else:
+            n_slices = input_.shape[0]
+            pbar_init(n_tiles * n_slices, "Compute Image Embeddings 3D tiled")
+            ds_shape, ds_chunks, slices = (n_slices,) + embed_shape, (1,) + embed_shape, range(n_slices)
+
+        for tile_id in range(n_tiles):
+            if str(tile_id) not in features:
+                _create_dataset_without_data(
+                    features, str(tile_id), shape=ds_shape, dtype="float32", chunks=ds_chunks, **storage
+                )
+
+        # Skip the tiles (and slices) that were already computed, when resuming an interrupted computation.
+        manifest = _CompletionManifest(f, n_tiles * len(slices), input_, predictor, tile_shape, halo)
+        keys, manifest_ids = [], {}
+        for tile_id in range(n_tiles):
+            for slice_id, z in enumerate(slices):
+                manifest_id = tile_id * len(slices) + slice_id
+                if not manifest.is_done(manifest_id):
+                    keys.append((f"features/{tile_id}", z))
+                    manifest_ids[keys[-1]] = manifest_id
+
+        def load_image(key):
+            tile_id = int(key[0].split("/")[-1])
+            tile = tiling.getBlockWithHalo(tile_id, list(halo))
+            outer_tile = tuple(slice(beg, end) for beg, end in zip(tile.outerBlock.begin, tile.outerBlock.end))
+            return input_[outer_tile] if key[1] is None else input_[key[1]][outer_tile]
+
+    sizes = {}
+
+    def handle_result(task):
+        task_keys, original_sizes, input_sizes = task.result()
+        for key, original_size, input_size in zip(task_keys, original_sizes, input_sizes):
+            key = tuple(key)
+            sizes[key[0]] = (original_size, input_size)
+            if tile_shape is None:
+                if slice_callback is not None:
+                    slice_callback(key[1], partial_embeddings)
+            else:
+                f[key[0]].attrs["original_size"] = original_size
+                f[key[0]].attrs["input_size"] = input_size
+            pbar_update(1)
+        manifest.set_done([manifest_ids[tuple(key)] for key in task_keys])
+
+    n_workers = len(devices)
+    with _get_embedding_workers(predictor, devices) as workers:
+        pending = set()
+        for start in range(0, len(keys), batch_size):
+            batch_keys = keys[start:start + batch_size]
+            pending.add(workers.submit(
+                _compute_embeddings_in_worker, save_path, batch_keys, [load_image(key) for key in batch_keys]
+            ))
+            # Limit the number of pending batches to bound the memory used by the loaded images.
+            if len(pending) >= 2 * n_workers:
+                done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for task in done:
+                    handle_result(task)
+        for task in futures.as_completed(pending):
+            handle_result(task)
+
+    if tile_shape is None:
+        # All slices may already have been computed, e.g. when resuming from partial features.
+        if "features" in sizes:
+            original_size, input_size = sizes["features"]
+        else:
+            original_size, input_size = partial_embeddings["original_size"], partial_embeddings["input_size"]
+    else:
+        original_size, input_size = None, None
+
+    _write_embedding_signature(
+        f, input_, predictor, tile_shape, halo, input_size=input_size, original_size=original_size, storage=storage
+    )
+    return {"features": features, "input_size": input_size, "original_size": original_size}
+
+
+# The (approximate) number of bytes that are read at once for computing the data signature.
+_SIGNATURE_BLOCK_SIZE = 2 ** 27
+
+
+def _compute_data_signature(input_, saved_signature=None):
+    """Compute the signature of the image data.
+
+    The signature is the xxh128 hash of the data bytes in C-order, which is computed by streaming over
+    blocks of the data along the first axis. For chunked data (e.g. zarr, n5 or hdf5) the blocks are aligned
+    with the chunks, so that each chunk is only read once and the data is never loaded into memory completely.
+    The signature does not depend on how the data is stored, it is the same for a numpy array and for the
+    same data loaded lazily from a file.
+
+    If a saved signature in the legacy format (the sha1 of the full data) is given, then the signature
+    is computed in the legacy format, so that it can be compared to embeddings computed with older versions.
+    """
+    if saved_signature is not None and not saved_signature.startswith("xxh128:"):
+        return hashlib.sha1(np.asarray(input_).tobytes()).hexdigest()
+
+    hash_obj = xxhash.xxh128()
+    # Data that is in memory and contiguous can be hashed directly, without any copy.
+    if isinstance(input_, np.ndarray) and input_.flags.c_contiguous:
+        hash_obj.update(input_.data)
+        return f"xxh128:{hash_obj.hexdigest()}"
+
+    shape = input_.shape
+    # Determine the number of elements along the first axis that are read per block.
+    bytes_per_row = int(np.prod(shape[1:], dtype="int64")) * np.dtype(input_.dtype).itemsize
+    block_len = max(1, _SIGNATURE_BLOCK_SIZE // max(bytes_per_row, 1))
+    chunks = getattr(input_, "chunks", None)
+    if chunks is not None and len(chunks) == len(shape) and isinstance(chunks[0], int):
+        block_len = max(1, block_len // chunks[0]) * chunks[0]
+
+    # Streaming the data block-wise results in the same hash as hashing the full data at once.
+    for start in range(0, shape[0], block_len):
+        block = np.ascontiguousarray(input_[start:min(start + block_len, shape[0])])
+        hash_obj.update(block.data)
+    return f"xxh128:{hash_obj.hexdigest()}"
 
 
 # Create all metadata that is stored along with the embeddings.
@@ -924,6 +1930,7 @@ def _get_embedding_signature(input_, predictor, tile_shape, halo, data_signature
         "model_name": predictor.model_name,
         "micro_sam_version": __version__,
         "model_hash": getattr(predictor, "_hash", None),
+        "image_encoder": _get_image_encoder_config(predictor),
     }
     return signature
 
@@ -931,9 +1938,12 @@ def _get_embedding_signature(input_, predictor, tile_shape, halo, data_signature
 # Note: the input size and orginal size are different if embeddings are tiled or not.
 # That's why we do not include them in the main signature that is being checked
 # (_get_embedding_signature), but just add it for serialization here.
-def _write_embedding_signature(f, input_, predictor, tile_shape, halo, input_size, original_size):
+# The same holds for the storage format: the embeddings are decoded to float32 when they are read,
+# so embeddings stored with a different format are still valid.
+def _write_embedding_signature(f, input_, predictor, tile_shape, halo, input_size, original_size, storage=None):
     signature = _get_embedding_signature(input_, predictor, tile_shape, halo)
     signature.update({"input_size": input_size, "original_size": original_size})
+    signature.update({"storage_dtype": "float32", "compression": "gzip", **({} if storage is None else storage)})
     for key, val in signature.items():
         f.attrs[key] = val
 
@@ -944,8 +1954,22 @@ def _check_saved_embeddings(input_, predictor, f, save_path, tile_shape, halo):
     if "input_size" not in f.attrs:
         return
 
-    signature = _get_embedding_signature(input_, predictor, tile_shape, halo)
+    # Embeddings computed with older versions store the data signature in a legacy format,
+    # we compute the signature in the same format to compare it.
+    data_signature = _compute_data_signature(input_, saved_signature=f.attrs.get("data_signature"))
+    signature = _get_embedding_signature(input_, predictor, tile_shape, halo, data_signature=data_signature)
     for key, val in signature.items():
+        # The embeddings computed with a different image encoder configuration only differ slightly,
+        # so we only raise a warning. Embeddings computed with older versions use the default configuration.
+        if key == "image_encoder":
+            saved_val = f.attrs.get(key, _DEFAULT_IMAGE_ENCODER_CONFIG)
+            if saved_val != val:
+                warnings.warn(
+                    f"The embeddings in {save_path} were computed with a different image encoder configuration: "
+                    f"{saved_val} != {val}. Please recompute them if model predictions don't look as expected."
+                )
+            continue
+
         # Check whether the key is missing from the attrs or if the value is not matching.
         if key not in f.attrs or f.attrs[key] != val:
             # These keys were recently added, so we don't want to fail yet if they don't
@@ -1001,6 +2025,134 @@ def handle_pbar(verbose, pbar_init, pbar_update):
     return pbar, pbar_init, pbar_update, pbar_close
 
 
+#
+# Cache for image embeddings
+#
+
+
+def _get_nbytes(features):
+    if isinstance(features, (np.ndarray, torch.Tensor)) or hasattr(features, "nbytes"):
+        return int(features.nbytes)
+    # Tiled embeddings are stored in a group with one dataset per tile.
+    return sum(_get_nbytes(ds) for _, ds in features.items())
+
+
+class _EmbeddingCache:
+    """Cache for image embeddings that are computed without a save path, addressed by their signature.
+
+    The cache consists of an in-memory tier, which keeps the most recently used embeddings up to a total size,
+    and an optional on-disk tier in the micro_sam cache directory.
+    """
+    def __init__(self, max_memory=2**30, use_disk=False, max_disk=None):
+        self.max_memory = max_memory
+        self.use_disk = use_disk
+        self.max_disk = max_disk
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def cache_dir(self):
+        return os.path.join(microsam_cachedir(), "embeddings")
+
+    def get_key(self, input_, predictor, ndim, tile_shape, halo, storage):
+        # We can only identify the model if the hash of its weights is known.
+        if getattr(predictor, "_hash", None) is None:
+            return None
+        signature = _get_embedding_signature(input_, predictor, tile_shape, halo)
+        signature.pop("micro_sam_version")
+        # The storage format is part of the key, because lossy formats change the embeddings read from disk.
+        signature.update({"ndim": ndim, **storage})
+        return xxhash.xxh128(json.dumps(signature, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            embeddings, _ = self._entries[key]
+        return dict(embeddings)
+
+    def put(self, key, embeddings):
+        nbytes = _get_nbytes(embeddings["features"])
+        if nbytes > self.max_memory:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._nbytes -= self._entries[key][1]
+            self._entries[key] = (dict(embeddings), nbytes)
+            self._entries.move_to_end(key)
+            self._nbytes += nbytes
+            while self._nbytes > self.max_memory:
+                _, (_, size) = self._entries.popitem(last=False)
+                self._nbytes -= size
+
+    def get_disk_path(self, key):
+        path = os.path.join(self.cache_dir, f"{key}.zarr")
+        # Update the modification time, which is used to evict the least recently used embeddings.
+        if os.path.exists(path):
+            os.utime(path)
+        return path
+
+    def evict_disk(self):
+        if self.max_disk is None or not os.path.exists(self.cache_dir):
+            return
+
+        def get_size(path):
+            return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+        paths = sorted(Path(self.cache_dir).glob("*.zarr"), key=lambda path: path.stat().st_mtime)
+        sizes = [get_size(path) for path in paths]
+        total_size = sum(sizes)
+        # Always keep the most recently used embeddings.
+        for path, size in zip(paths[:-1], sizes[:-1]):
+            if total_size <= self.max_disk:
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+        if disk and os.path.exists(self.cache_dir):
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+_EMBEDDING_CACHE = _EmbeddingCache()
+
+
+def set_embedding_cache(max_memory: int = 2**30, use_disk: bool = False, max_disk: Optional[int] = None) -> None:
+    """Configure the cache for image embeddings.
+
+    The embeddings computed by `precompute_image_embeddings` without a save path are cached, so that they are
+    not recomputed for the same image data, model and tiling parameters. The cache keeps the most recently
+    used embeddings in memory and can additionally store them on disk, in the micro_sam cache directory.
+    Embeddings are only cached for models with a known hash, e.g. models loaded via `get_sam_model`.
+    The model is identified by this hash, so the cache must be cleared if the model weights are changed in-place.
+
+    Args:
+        max_memory: The maximal size of the embeddings kept in memory, in bytes.
+            Set to '0' to disable the in-memory cache. By default, set to 1 GB.
+        use_disk: Whether to also cache the embeddings on disk. By default, set to 'False'.
+        max_disk: The maximal size of the embeddings cached on disk, in bytes.
+            By default, set to 'None', i.e. the size of the on-disk cache is not limited.
+    """
+    _EMBEDDING_CACHE.max_memory = max_memory
+    _EMBEDDING_CACHE.use_disk = use_disk
+    _EMBEDDING_CACHE.max_disk = max_disk
+    _EMBEDDING_CACHE.clear()
+
+
+def clear_embedding_cache(disk: bool = False) -> None:
+    """Clear the cache for image embeddings.
+
+    Args:
+        disk: Whether to also remove the embeddings cached on disk. By default, set to 'False'.
+    """
+    _EMBEDDING_CACHE.clear(disk=disk)
+
+
 def precompute_image_embeddings(
     predictor: SamPredictor,
     input_: np.ndarray,
@@ -1013,10 +2165,21 @@ def precompute_image_embeddings(
     batch_size: int = 1,
     pbar_init: Optional[callable] = None,
     pbar_update: Optional[callable] = None,
+    pipelined: bool = False,
+    storage_dtype: str = "float32",
+    compression: str = "gzip",
+    use_cache: bool = True,
+    slice_order: Optional[Iterable[int]] = None,
+    slice_callback: Optional[Callable[[int, ImageEmbeddings], None]] = None,
+    compute_on_demand: bool = False,
+    prefetch: int = 0,
+    devices: Optional[List[Union[str, torch.device]]] = None,
 ) -> ImageEmbeddings:
     """Compute the image embeddings (output of the encoder) for the input.
 
     If 'save_path' is given the embeddings will be loaded/saved in a zarr container.
+    Otherwise, the embeddings are cached so that they are not recomputed for the same input and model,
+    see `set_embedding_cache` for details.
 
     Args:
         predictor: The Segment Anything predictor.
@@ -1036,11 +2199,73 @@ def precompute_image_embeddings(
             Can be used together with pbar_update to handle napari progress bar in other thread.
             To enables using this function within a threadworker.
         pbar_update: Callback to update an external progress bar.
+        pipelined: Whether to load and preprocess the next batch and to write the computed embeddings
+            in background threads, so that the image encoder does not wait for data I/O or compression.
+            This only has an effect if the input is 3 dimensional or if tiling is used. By default, set to 'False'.
+        storage_dtype: The data type for storing the embeddings. One of 'float32', 'float16', 'bfloat16' or 'int8'.
+            For 'int8' the embeddings are quantized per channel. The embeddings are always decoded to float32
+            when they are read. Reduced precision is only supported for zarr v2. By default, set to 'float32'.
+        compression: The compression for storing the embeddings. One of 'gzip', 'lz4' or 'zstd'.
+            'lz4' and 'zstd' use the Blosc meta-compressor, which is significantly faster than 'gzip'.
+            By default, set to 'gzip'.
+        use_cache: Whether to use the embedding cache if no 'save_path' is given. The cache keeps up to 1 GB
+            of embeddings in memory by default, in addition to the returned embeddings, and the input is hashed
+            for each call to find its cache entry. See `set_embedding_cache` for configuring or disabling it.
+            By default, set to 'True'.
+        slice_order: The slices that are computed first, for example the slice that is currently viewed.
+            The remaining slices are computed afterwards in ascending order. This only has an effect if the input
+            is 3 dimensional and if tiling is not used. By default, set to 'None', i.e. slices are computed in order.
+        slice_callback: Callback that is called once the embeddings of a slice are available. Must accept
+            the slice index and the (partially computed) image embeddings, which can already be used to
+            segment this slice. This only has an effect if the input is 3 dimensional and if tiling is not used.
+            By default, set to 'None'.
+        compute_on_demand: Whether to compute the embeddings of a slice only when they are accessed for the first
+            time, e.g. in `set_precomputed`, instead of computing the embeddings for all slices upfront.
+            The computed embeddings are written to the zarr container if 'save_path' is given.
+            This only has an effect if the input is 3 dimensional and if tiling is not used.
+            By default, set to 'False'.
+        prefetch: The number of slices above and below a slice whose embeddings are computed together with it
+            if 'compute_on_demand' is set. By default, set to '0'.
+        devices: The devices for computing the embeddings in parallel, with one worker process per device.
+            The same device can be given several times, e.g. ['cpu', 'cpu'] for two worker processes on the CPU.
+            The slices or tiles are split across the workers, which write the embeddings to the zarr container
+            at 'save_path'. This requires 'save_path' and only has an effect if the input is 3 dimensional
+            or if tiling is used. By default, set to 'None', i.e. the embeddings are computed with the predictor.
 
     Returns:
         The image embeddings.
     """
     ndim = input_.ndim if ndim is None else ndim
+    # Validate the storage parameters before any computation is run.
+    _get_storage_kwargs(storage_dtype, compression)
+    storage = {"storage_dtype": storage_dtype, "compression": compression}
+
+    # Look up the embeddings in the cache or compute and cache them.
+    # Embeddings that are computed on demand are not cached, because they are not complete.
+    on_demand = compute_on_demand and ndim == 3 and tile_shape is None
+    cache = _EMBEDDING_CACHE
+    if save_path is None and use_cache and not on_demand and (cache.max_memory > 0 or cache.use_disk):
+        cache_key = cache.get_key(input_, predictor, ndim, tile_shape, halo, storage)
+    else:
+        cache_key = None
+
+    if cache_key is not None:
+        embeddings = cache.get(cache_key)
+        if embeddings is None:
+            embeddings = precompute_image_embeddings(
+                predictor, input_, save_path=cache.get_disk_path(cache_key) if cache.use_disk else None,
+                ndim=ndim, tile_shape=tile_shape, halo=halo, verbose=verbose,
+                batch_size=batch_size, pbar_init=pbar_init, pbar_update=pbar_update, pipelined=pipelined,
+                storage_dtype=storage_dtype, compression=compression, use_cache=False,
+                slice_order=slice_order, slice_callback=slice_callback, devices=devices,
+            )
+            cache.put(cache_key, embeddings)
+            if cache.use_disk:
+                cache.evict_disk()
+        # Set the embeddings in the predictor, as it is done when computing them.
+        elif ndim == 2 and tile_shape is None:
+            set_precomputed(predictor, embeddings)
+        return embeddings
 
     # Handle the embedding save_path.
     # We don't have a save path, open in memory zarr file to hold tiled embeddings.
@@ -1058,16 +2283,33 @@ def precompute_image_embeddings(
     else:
         f = zarr.open(save_path, mode="a")
 
+    if on_demand:
+        return _compute_3d_on_demand(input_, predictor, f, save_path, lazy_loading, prefetch, batch_size, storage)
+
     _, pbar_init, pbar_update, pbar_close = handle_pbar(verbose, pbar_init, pbar_update)
 
-    if ndim == 2 and tile_shape is None:
-        embeddings = _compute_2d(input_, predictor, f, save_path, pbar_init, pbar_update)
+    # Only the computation for several slices or tiles is split across devices.
+    use_devices = devices is not None and (ndim == 3 or (ndim == 2 and tile_shape is not None))
+    if use_devices and "input_size" not in f.attrs:
+        embeddings = _compute_sharded(
+            input_, predictor, f, save_path, devices, ndim, tile_shape, halo, pbar_init, pbar_update, batch_size,
+            storage, slice_order=slice_order, slice_callback=slice_callback,
+        )
+    elif ndim == 2 and tile_shape is None:
+        embeddings = _compute_2d(input_, predictor, f, save_path, pbar_init, pbar_update, storage)
     elif ndim == 2 and tile_shape is not None:
-        embeddings = _compute_tiled_2d(input_, predictor, tile_shape, halo, f, pbar_init, pbar_update, batch_size)
+        embeddings = _compute_tiled_2d(
+            input_, predictor, tile_shape, halo, f, pbar_init, pbar_update, batch_size, pipelined, storage
+        )
     elif ndim == 3 and tile_shape is None:
-        embeddings = _compute_3d(input_, predictor, f, save_path, lazy_loading, pbar_init, pbar_update, batch_size)
+        embeddings = _compute_3d(
+            input_, predictor, f, save_path, lazy_loading, pbar_init, pbar_update, batch_size, pipelined, storage,
+            slice_order=slice_order, slice_callback=slice_callback,
+        )
     elif ndim == 3 and tile_shape is not None:
-        embeddings = _compute_tiled_3d(input_, predictor, tile_shape, halo, f, pbar_init, pbar_update, batch_size)
+        embeddings = _compute_tiled_3d(
+            input_, predictor, tile_shape, halo, f, pbar_init, pbar_update, batch_size, pipelined, storage
+        )
     else:
         raise ValueError(f"Invalid dimesionality {input_.ndim}, expect 2 or 3 dim data.")
 
@@ -1075,6 +2317,92 @@ def precompute_image_embeddings(
     return embeddings
 
 
+class _DeviceCache:
+    """Cache for the features that are set in the predictor, keyed by the features array, slice and tile.
+
+    The most recently used features are kept on the device of the predictor up to a total size,
+    so that repeated prompts for the same image, slice or tile don't have to read them and copy them to the device.
+    The features array is tracked via a weak reference: the entries for it are removed once it is deleted,
+    and an entry is only used if the features array it was created for still exists.
+    """
+    def __init__(self, max_memory=2**28):
+        self.max_memory = max_memory
+        self._entries = OrderedDict()
+        self._refs = {}
+        self._size = 0
+        # We need a re-entrant lock, because the weak reference callback may be triggered while the lock is held.
+        self._lock = threading.RLock()
+
+    def _remove(self, features_id):
+        with self._lock:
+            self._refs.pop(features_id, None)
+            for key in [key for key in self._entries if key[0] == features_id]:
+                self._size -= self._entries.pop(key)[1]
+
+    def get(self, features, key):
+        with self._lock:
+            ref = self._refs.get(id(features))
+            if ref is None or ref() is not features or (id(features),) + key not in self._entries:
+                return None
+            key = (id(features),) + key
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, features, key, tensor):
+        nbytes = tensor.element_size() * tensor.nelement()
+        if nbytes > self.max_memory:
+            return
+        features_id = id(features)
+        with self._lock:
+            ref = self._refs.get(features_id)
+            # A different features array with the same id was cached before, its entries are outdated.
+            if ref is not None and ref() is not features:
+                self._remove(features_id)
+                ref = None
+            if ref is None:
+                self._refs[features_id] = weakref.ref(features, lambda _: self._remove(features_id))
+
+            key = (features_id,) + key
+            if key in self._entries:
+                self._size -= self._entries.pop(key)[1]
+            self._entries[key] = (tensor, nbytes)
+            self._size += nbytes
+            while self._size > self.max_memory:
+                _, (_, size) = self._entries.popitem(last=False)
+                self._size -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._refs.clear()
+            self._size = 0
+
+
+_DEVICE_CACHE = _DeviceCache()
+
+
+def set_device_cache(max_memory: int = 2**28) -> None:
+    """Configure the cache for the features that are set in the predictor by `set_precomputed`.
+
+    The cache keeps the features of the most recently used images, slices and tiles on the device,
+    so that they are not read and copied to the device again for each prompt.
+    The features are identified by the features array of the image embeddings, the slice and the tile.
+    If the features array is changed in-place, then the cache must be cleared with `clear_device_cache`.
+
+    Args:
+        max_memory: The maximal size of the cached features, in bytes.
+            Set to '0' to disable the cache. By default, set to 256 MB.
+    """
+    _DEVICE_CACHE.max_memory = max_memory
+    _DEVICE_CACHE.clear()
+
+
+def clear_device_cache() -> None:
+    """Clear the cache for the features that are set in the predictor by `set_precomputed`.
+    """
+    _DEVICE_CACHE.clear()
+
+
 def set_precomputed(
     predictor: SamPredictor, image_embeddings: ImageEmbeddings, i: Optional[int] = None, tile_id: Optional[int] = None,
 ) -> SamPredictor:
@@ -1090,15 +2418,39 @@ def set_precomputed(
     Returns:
         The predictor with set features.
     """
+    # The features that were set before are cached on the device, see 'set_device_cache' for details.
+    # We don't cache features that are already on the device, e.g. in-memory features on the cpu.
+    device = predictor.device
+    features = image_embeddings["features"]
+    on_device = (torch.is_tensor(features) and features.device == torch.device(device)) or\
+        (isinstance(features, np.ndarray) and torch.device(device).type == "cpu")
+    use_cache = _DEVICE_CACHE.max_memory > 0 and not on_device
+    cache_key = (i, tile_id, str(device))
+    cached_features = _DEVICE_CACHE.get(features, cache_key) if use_cache else None
+
     if tile_id is not None:
-        tile_features = image_embeddings["features"][str(tile_id)]
-        tile_image_embeddings = {
+        tile_features = features[str(tile_id)]
+        image_embeddings = {
             "features": tile_features,
             "input_size": tile_features.attrs["input_size"],
             "original_size": tile_features.attrs["original_size"]
         }
-        return set_precomputed(predictor, tile_image_embeddings, i=i)
 
+    if cached_features is None:
+        _set_features(predictor, image_embeddings, i)
+        if use_cache:
+            _DEVICE_CACHE.put(features, cache_key, predictor.features)
+    else:
+        predictor.features = cached_features
+
+    predictor.original_size = image_embeddings["original_size"]
+    predictor.input_size = image_embeddings["input_size"]
+    predictor.is_image_set = True
+
+    return predictor
+
+
+def _set_features(predictor, image_embeddings, i):
     device = predictor.device
     features = image_embeddings["features"]
     assert features.ndim in (4, 5), f"{features.ndim}"
@@ -1114,12 +2466,6 @@ def set_precomputed(
         predictor.features = features[i].to(device) if torch.is_tensor(features) else \
             torch.from_numpy(features[i]).to(device)
 
-    predictor.original_size = image_embeddings["original_size"]
-    predictor.input_size = image_embeddings["input_size"]
-    predictor.is_image_set = True
-
-    return predictor
-
 
 #
 # Misc functionality
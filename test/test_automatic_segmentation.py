@@ -1,6 +1,7 @@
 import unittest
 
 import numpy as np
+from elf.evaluation.matching import matching
 from skimage.draw import disk
 from skimage.measure import label as connected_components
 
@@ -149,6 +150,12 @@ class TestAutomaticSegmentation(unittest.TestCase):
         )
         self.assertEqual(labels.shape, instances.shape)
 
+        # Check that the segmentation with parallel post-processing and batched decoder prediction matches.
+        instances_parallel = automatic_instance_segmentation(
+            predictor=predictor, segmenter=segmenter, input_path=volume, ndim=3, n_workers=2, decoder_batch_size=2,
+        )
+        self.assertGreater(matching(instances_parallel, instances, threshold=0.75)["segmentation_accuracy"], 0.99)
+
     def test_tiled_instance_segmentation_with_decoder_3d(self):
         from micro_sam.automatic_segmentation import automatic_instance_segmentation, get_predictor_and_segmenter
 
@@ -0,0 +1,53 @@
+import os
+import unittest
+
+from shutil import rmtree
+
+import numpy as np
+
+import micro_sam.util as util
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+
+@unittest.skipIf(onnxruntime is None, "Needs onnxruntime")
+class TestBioengineExport(unittest.TestCase):
+    tmp_folder = "tmp"
+    model_type = "vit_t" if util.VIT_T_SUPPORT else "vit_b"
+
+    def setUp(self):
+        os.makedirs(self.tmp_folder, exist_ok=True)
+
+    def tearDown(self):
+        rmtree(self.tmp_folder, ignore_errors=True)
+
+    def test_export_onnx_image_encoder(self):
+        from micro_sam.bioimageio.bioengine_export import export_onnx_image_encoder
+
+        export_path = os.path.join(self.tmp_folder, "image_encoder.onnx")
+        export_onnx_image_encoder(self.model_type, export_path)
+        self.assertTrue(os.path.exists(export_path))
+
+        # Check that the embeddings computed with onnxruntime match the embeddings computed with pytorch.
+        predictor = util.get_sam_model(model_type=self.model_type, device="cpu")
+        image = np.random.randint(0, 255, size=(256, 256), dtype="uint8")
+        expected = util.precompute_image_embeddings(predictor, image, verbose=False)["features"]
+
+        util.set_image_encoder_backend(predictor, "onnxruntime", model_path=export_path)
+        embeddings = util.precompute_image_embeddings(predictor, image, verbose=False)["features"]
+        self.assertTrue(np.allclose(embeddings, expected, atol=1e-4))
+
+        util.set_image_encoder_backend(predictor, "torch")
+        self.assertNotIn("forward", predictor.model.image_encoder.__dict__)
+
+        # Check that the encoder cannot be used for a different model.
+        predictor._hash = "xxh128:different-model"
+        with self.assertRaises(ValueError):
+            util.set_image_encoder_backend(predictor, "onnxruntime", model_path=export_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,8 +1,12 @@
+import json
+import os
+import tempfile
 import unittest
 
 import micro_sam.util as util
 import numpy as np
 from micro_sam.instance_segmentation import get_predictor_and_decoder
+from micro_sam.precompute_state import _read_amg_state, _write_amg_state
 
 from elf.evaluation.matching import matching
 from skimage.draw import disk
@@ -86,6 +90,36 @@ class TestInstanceSegmentation(unittest.TestCase):
         predicted3 = mask_data_to_segmentation(predicted3, with_background=True)
         self.assertTrue(np.array_equal(predicted, predicted3))
 
+        # check that the segmentation from the run-length encoded masks is the same
+        masks = amg.generate(output_mode="uncompressed_rle", min_mask_region_area=100)
+        self.assertTrue(all(isinstance(ann["segmentation"]["counts"], list) for ann in masks))
+        json.dumps(masks)
+        predicted4 = amg.generate(output_mode="uncompressed_rle")
+        predicted4 = mask_data_to_segmentation(predicted4, with_background=True)
+        self.assertTrue(np.array_equal(predicted, predicted4))
+
+        # check that writing and reading the state to / from file works
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            save_path = os.path.join(tmp_dir, "amg_state.npz")
+            _write_amg_state(save_path, state)
+            amg = AutomaticMaskGenerator(predictor, points_per_side=10, points_per_batch=16)
+            amg.set_state(_read_amg_state(save_path))
+        predicted5 = amg.generate()
+        predicted5 = mask_data_to_segmentation(predicted5, with_background=True)
+        self.assertTrue(np.array_equal(predicted, predicted5))
+
+        # check that regenerating with the cached removal of small regions gives the same result
+        predicted6 = amg.generate(min_mask_region_area=100)
+        predicted6 = mask_data_to_segmentation(predicted6, with_background=True)
+        predicted7 = amg.generate(pred_iou_thresh=0.8, min_mask_region_area=100)
+        predicted7 = mask_data_to_segmentation(predicted7, with_background=True)
+        amg = AutomaticMaskGenerator(predictor, points_per_side=10, points_per_batch=16)
+        amg.set_state(state)
+        predicted8 = amg.generate(pred_iou_thresh=0.8, min_mask_region_area=100)
+        predicted8 = mask_data_to_segmentation(predicted8, with_background=True)
+        self.assertTrue(np.array_equal(predicted7, predicted8))
+        self.assertGreater(matching(predicted6, mask, threshold=0.75)["segmentation_accuracy"], 0.99)
+
     def test_tiled_automatic_mask_generator(self):
         from micro_sam.instance_segmentation import TiledAutomaticMaskGenerator, mask_data_to_segmentation
 
@@ -121,6 +155,13 @@ class TestInstanceSegmentation(unittest.TestCase):
         predicted3 = mask_data_to_segmentation(predicted3, with_background=True)
         self.assertTrue(np.array_equal(predicted, predicted3))
 
+        # Check that decoding the prompts of several tiles together works.
+        amg = TiledAutomaticMaskGenerator(predictor, points_per_side=8)
+        amg.initialize(image, image_embeddings=image_embeddings, verbose=False, tile_batch_size=2)
+        predicted4 = amg.generate(pred_iou_thresh=pred_iou_thresh)
+        predicted4 = mask_data_to_segmentation(predicted4, with_background=True)
+        self.assertGreater(matching(predicted4, predicted, threshold=0.75)["segmentation_accuracy"], 0.99)
+
     def test_instance_segmentation_with_decoder(self):
         from micro_sam.instance_segmentation import InstanceSegmentationWithDecoder, mask_data_to_segmentation
 
@@ -152,6 +193,102 @@ class TestInstanceSegmentation(unittest.TestCase):
         predicted3 = mask_data_to_segmentation(predicted3, with_background=True)
         self.assertTrue(np.array_equal(predicted, predicted3))
 
+        # check that regenerating with the cached smoothed outputs works after changing the smoothing
+        amg.generate(distance_smoothing=2.0, **generate_kwargs)
+        predicted4 = amg.generate(**generate_kwargs)
+        predicted4 = mask_data_to_segmentation(predicted4, with_background=True)
+        self.assertTrue(np.array_equal(predicted, predicted4))
+
+    def test_grid_search_iteration(self):
+        from micro_sam.evaluation.instance_segmentation import _grid_search_iteration
+        from micro_sam.instance_segmentation import InstanceSegmentationWithDecoder
+
+        mask, image = self.mask, self.image
+        predictor, decoder, image_embeddings = self._get_model(image, self.model_type_ais, with_decoder=True)
+        amg = InstanceSegmentationWithDecoder(predictor, decoder)
+        amg.initialize(image, image_embeddings=image_embeddings, verbose=False)
+
+        # The combinations include a parameter with the value 'None', which is read back from csv as NaN.
+        combinations = [
+            {"center_distance_threshold": threshold, "n_threads": n_threads}
+            for threshold in (0.4, 0.5) for n_threads in (None, 1)
+        ]
+        fixed_generate_kwargs = dict(foreground_threshold=0.8, min_size=100)
+        expected = _grid_search_iteration(amg, combinations, mask, "image", fixed_generate_kwargs, result_path=None)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # Check that evaluating in worker processes gives the same result.
+            result_path = os.path.join(tmp_dir, "result.csv")
+            result = _grid_search_iteration(
+                amg, combinations, mask, "image", fixed_generate_kwargs, result_path=result_path, n_workers=2
+            )
+            self.assertTrue(np.allclose(expected["mSA"].values, result["mSA"].values))
+            self.assertTrue(os.path.exists(result_path))
+            self.assertFalse(os.path.exists(f"{result_path}.partial"))
+
+            # Check that an interrupted grid search is resumed from the partial results.
+            # We change the scores in the partial results to check that they are not recomputed.
+            partial = result.iloc[:2].copy()
+            partial["mSA"] = -1.0
+            partial.insert(0, "combination_id", [0, 1])
+            partial.to_csv(f"{result_path}.partial", index=False)
+            os.remove(result_path)
+            resumed = _grid_search_iteration(
+                amg, combinations, mask, "image", fixed_generate_kwargs, result_path=result_path
+            )
+            self.assertEqual(len(resumed), len(combinations))
+            self.assertTrue(np.allclose(resumed["mSA"].values[:2], -1.0))
+            self.assertTrue(np.allclose(resumed["mSA"].values[2:], expected["mSA"].values[2:]))
+
+    def test_instance_segmentation_tuning(self):
+        import imageio.v3 as imageio
+        import pandas as pd
+        from micro_sam.evaluation.instance_segmentation import run_instance_segmentation_tuning
+        from micro_sam.instance_segmentation import InstanceSegmentationWithDecoder
+
+        predictor, decoder = get_predictor_and_decoder(model_type=self.model_type_ais)
+        segmenter = InstanceSegmentationWithDecoder(predictor, decoder)
+
+        grid_search_values = {
+            "center_distance_threshold": [0.3, 0.4, 0.5, 0.6, 0.7],
+            "boundary_distance_threshold": [0.3, 0.4, 0.5, 0.6, 0.7],
+        }
+        n_combinations = 25
+        fixed_generate_kwargs = dict(foreground_threshold=0.8, min_size=100)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            image_paths, gt_paths = [], []
+            for i, shape in enumerate([(256, 256), (256, 320), (320, 256)]):
+                mask, image = self._get_input(shape)
+                image_paths.append(os.path.join(tmp_dir, f"image-{i}.tif"))
+                gt_paths.append(os.path.join(tmp_dir, f"gt-{i}.tif"))
+                imageio.imwrite(image_paths[-1], image)
+                imageio.imwrite(gt_paths[-1], mask)
+
+            result_dir = os.path.join(tmp_dir, "results")
+            tuning_kwargs = dict(
+                fixed_generate_kwargs=fixed_generate_kwargs, n_candidates=3, reduction_factor=2
+            )
+            best_kwargs, best_score = run_instance_segmentation_tuning(
+                segmenter, grid_search_values, image_paths, gt_paths, result_dir, None, **tuning_kwargs
+            )
+
+            # Check that the best parameters are a point of the grid and that not all of the grid was evaluated.
+            for name, values in grid_search_values.items():
+                self.assertIn(best_kwargs[name], values)
+            result_path = os.path.join(result_dir, "tuning_results.csv")
+            results = pd.read_csv(result_path)
+            n_evaluated = len(results.drop_duplicates(list(grid_search_values.keys())))
+            self.assertLess(n_evaluated, n_combinations)
+
+            # Check that running the tuning again resumes from the saved results, without any new evaluations.
+            best_kwargs2, best_score2 = run_instance_segmentation_tuning(
+                segmenter, grid_search_values, image_paths, gt_paths, result_dir, None, **tuning_kwargs
+            )
+            self.assertEqual(best_kwargs, best_kwargs2)
+            self.assertAlmostEqual(best_score, best_score2)
+            self.assertEqual(len(pd.read_csv(result_path)), len(results))
+
     def test_tiled_instance_segmentation_with_decoder(self):
         from micro_sam.instance_segmentation import TiledInstanceSegmentationWithDecoder, mask_data_to_segmentation
 
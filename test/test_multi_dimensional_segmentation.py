@@ -2,6 +2,7 @@ import unittest
 
 import numpy as np
 from skimage.data import binary_blobs
+from skimage.draw import disk
 from skimage.measure import label
 
 try:
@@ -36,6 +37,34 @@ class TestMultiDimensionalSegmentation(unittest.TestCase):
         for z in range(1, n_slices):
             self.assertTrue(np.array_equal(ids0, np.unique(merged_seg[z])))
 
+    def test_merge_instance_segmentation_3d_blockwise(self):
+        import zarr
+        from micro_sam.multi_dimensional_segmentation import merge_instance_segmentation_3d
+
+        n_slices = 6
+        data = np.stack(n_slices * binary_blobs(512))
+        seg = label(data)
+
+        stacked_seg = []
+        offset = 0
+        for _ in range(n_slices):
+            stack_seg = seg.copy()
+            stack_seg[stack_seg != 0] += offset
+            offset = stack_seg.max()
+            stacked_seg.append(stack_seg)
+        stacked_seg = np.stack(stacked_seg).astype("uint32")
+
+        merged_seg = merge_instance_segmentation_3d(stacked_seg, min_z_extent=2)
+
+        chunks = (2, 128, 128)
+        input_ = zarr.array(stacked_seg, chunks=chunks)
+        out = zarr.zeros(stacked_seg.shape, chunks=chunks, dtype="uint64")
+        merge_instance_segmentation_3d(input_, min_z_extent=2, block_shape=(2, 256, 256), n_threads=4, out=out)
+        self.assertTrue(np.array_equal(merged_seg, out[:]))
+
+        with self.assertRaises(ValueError):
+            merge_instance_segmentation_3d(input_, gap_closing=1, block_shape=(2, 256, 256), out=out)
+
     def test_merge_instance_segmentation_3d_with_closing(self):
         from micro_sam.multi_dimensional_segmentation import merge_instance_segmentation_3d
 
@@ -65,6 +94,34 @@ class TestMultiDimensionalSegmentation(unittest.TestCase):
         for z in range(1, n_slices):
             self.assertTrue(np.array_equal(ids0, np.unique(merged_seg[z])))
 
+    def test_segment_mask_in_volume_batched_propagation(self):
+        import micro_sam.util as util
+        from micro_sam.multi_dimensional_segmentation import segment_mask_in_volume
+
+        shape = (8, 256, 256)
+        mask = np.zeros(shape[1:], dtype="uint8")
+        mask[disk((128, 128), radius=32, shape=shape[1:])] = 1
+        volume = np.stack(shape[0] * [mask * 255])
+
+        model_type = "vit_t" if util.VIT_T_SUPPORT else "vit_b"
+        predictor = util.get_sam_model(model_type=model_type)
+        image_embeddings = util.precompute_image_embeddings(predictor, volume, ndim=3)
+
+        segmented_slices = np.array([1, 5])
+        segmentation = np.zeros(shape, dtype="uint8")
+        segmentation[segmented_slices] = mask
+
+        expected, expected_range = segment_mask_in_volume(
+            segmentation.copy(), predictor, image_embeddings, segmented_slices,
+            stop_lower=False, stop_upper=False, iou_threshold=0.8, projection="mask",
+        )
+        result, result_range = segment_mask_in_volume(
+            segmentation.copy(), predictor, image_embeddings, segmented_slices,
+            stop_lower=False, stop_upper=False, iou_threshold=0.8, projection="mask", batched_propagation=True,
+        )
+        self.assertEqual(expected_range, result_range)
+        self.assertGreater(util.compute_iou(expected, result), 0.99)
+
     @unittest.skipIf(Trackastra is None, "Requires trackastra")
     def test_track_across_frames(self):
         from micro_sam.multi_dimensional_segmentation import track_across_frames, get_napari_track_data
@@ -224,6 +224,54 @@ class TestPromptBasedSegmentation(unittest.TestCase):
         predicted = segment_from_box(self.predictor_tiled, box, image_embeddings=self.tiled_embeddings)
         self.assertGreater(util.compute_iou(self.mask_tiled, predicted), 0.9)
 
+        # Check that the mask for the tile matches the mask for the full image.
+        predicted_local, bb = segment_from_box(
+            self.predictor_tiled, box, image_embeddings=self.tiled_embeddings, return_local_mask=True
+        )
+        self.assertLess(predicted_local.size, predicted.size)
+        self.assertTrue(np.array_equal(predicted[(slice(None),) + bb], predicted_local))
+        self.assertEqual(predicted_local.sum(), predicted.sum())
+
+    def test_segment_across_tiles(self):
+        from micro_sam.prompt_based_segmentation import segment_from_box, segment_from_mask, segment_from_points
+
+        # The object is in the center of the image, so it spans all four tiles.
+        box = np.array([440, 440, 580, 580])
+        predicted = segment_from_box(
+            self.predictor_tiled, box, image_embeddings=self.tiled_embeddings, cross_tile=True
+        )
+        self.assertEqual(predicted.shape[1:], self.mask_tiled.shape)
+        self.assertGreater(util.compute_iou(self.mask_tiled, predicted), 0.9)
+
+        points, labels = np.array([[512, 512]]), np.array([1])
+        predicted, bb = segment_from_points(
+            self.predictor_tiled, points, labels, image_embeddings=self.tiled_embeddings,
+            cross_tile=True, return_local_mask=True,
+        )
+        self.assertGreater(util.compute_iou(self.mask_tiled[bb], predicted), 0.9)
+
+        predicted = segment_from_mask(
+            self.predictor_tiled, self.mask_tiled, image_embeddings=self.tiled_embeddings, cross_tile=True
+        )
+        self.assertGreater(util.compute_iou(self.mask_tiled, predicted), 0.9)
+
+    def test_segment_across_tiles_from_point(self):
+        from micro_sam.prompt_based_segmentation import segment_from_points
+
+        # The object extends from the first tile far into the second tile, beyond the halo.
+        mask = np.zeros((1024, 1024), dtype="uint8")
+        mask[300:460, 200:800] = 1
+        predictor, image_embeddings = self._get_model(
+            mask * 255, self.model_type, tile_shape=(512, 512), halo=(96, 96)
+        )
+
+        # The point is in the first tile, outside of the halo of the second tile.
+        points, labels = np.array([[380, 300]]), np.array([1])
+        predicted = segment_from_points(
+            predictor, points, labels, image_embeddings=image_embeddings, cross_tile=True
+        )
+        self.assertGreater(util.compute_iou(mask, predicted), 0.9)
+
     #
     # Tests for 'segment_from_box_and_points':
     # normal test, non square inputs, tiled
@@ -276,6 +324,23 @@ class TestPromptBasedSegmentation(unittest.TestCase):
         )
         self.assertGreater(util.compute_iou(self.mask_tiled, predicted), 0.9)
 
+    #
+    # Test for the batched prediction of several prompts.
+    #
+
+    def test_predict_batched(self):
+        from micro_sam.prompt_based_segmentation import _predict_batched, _process_box, segment_from_box
+
+        boxes = [np.array([106, 106, 150, 150]), np.array([100, 100, 160, 160]), np.array([90, 110, 140, 170])]
+        expected = [segment_from_box(self.predictor, box).squeeze() for box in boxes]
+
+        predicted = _predict_batched(
+            self.predictor, boxes=np.stack([_process_box(box, self.mask.shape) for box in boxes]), batch_size=2
+        )
+        self.assertEqual(predicted.shape, (len(boxes),) + self.mask.shape)
+        for pred, exp in zip(predicted, expected):
+            self.assertTrue(np.array_equal(pred, exp))
+
 
 if __name__ == "__main__":
     unittest.main()
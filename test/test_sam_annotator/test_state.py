@@ -17,6 +17,12 @@ class TestState(unittest.TestCase):
         state.image_shape = image.shape
         self.assertTrue(state.initialized_for_interactive_segmentation())
 
+        # Check that the shared model is reused when the embeddings are computed again after a reset.
+        predictor = state.predictor
+        state.reset_state()
+        state.initialize_predictor(image, self.model_type, ndim=2)
+        self.assertIs(state.predictor, predictor)
+
     def test_state_for_tracking(self):
         from micro_sam.sam_annotator._state import AnnotatorState
 
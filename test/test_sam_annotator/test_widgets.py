@@ -36,12 +36,9 @@ def test_embedding_widget(make_napari_viewer, tmp_path):
     my_widget.device = "cpu"
     my_widget.embeddings_save_path = tmp_path
 
-    # Run image embedding widget.
-    my_widget(skip_validate=True)
-
-    # Previous version when we used a thread-worker
-    # worker = my_widget(skip_validate=True)
-    # worker.await_workers()  # blocks until thread worker is finished the embedding
+    # Run image embedding widget. The embeddings are computed in a background thread.
+    thread = my_widget(skip_validate=True)
+    thread.join()  # blocks until the embedding computation is finished
 
     # Check in-memory state for predictor and embeddings.
     assert isinstance(AnnotatorState().predictor, (SamPredictor, MobileSamPredictor))
@@ -65,3 +62,39 @@ def test_embedding_widget(make_napari_viewer, tmp_path):
 
     # Close the viewer at the end of the test.
     viewer.close()
+
+
+@pytest.mark.gui
+@pytest.mark.skipif(platform.system() == "Windows", reason="Gui test is not working on windows.")
+def test_commit_to_file_with_legacy_signature(make_napari_viewer_proxy, tmp_path):
+    """Test that committing to a file with a data signature from an older version keeps the committed objects."""
+    import hashlib
+    from skimage.data import binary_blobs
+    from micro_sam.sam_annotator import annotator_2d
+    from micro_sam.sam_annotator._widgets import _commit_to_file
+
+    image = binary_blobs(256).astype("uint8")
+    viewer = annotator_2d(image, model_type="vit_t", viewer=make_napari_viewer_proxy(), return_viewer=True)
+
+    # Create a commit file with an object and the legacy (sha1) data signature.
+    commit_path = str(tmp_path / "commit.zarr")
+    committed = np.zeros(image.shape, dtype="uint32")
+    committed[:16, :16] = 1
+    f = zarr.open(commit_path, mode="a")
+    f.create_dataset("committed_objects", data=committed, chunks=image.shape)
+    f.attrs["data_signature"] = hashlib.sha1(np.asarray(image).tobytes()).hexdigest()
+
+    # Commit another object to the file.
+    seg = np.zeros(image.shape, dtype="uint32")
+    seg[-16:, -16:] = 2
+    mask = seg != 0
+    _commit_to_file(commit_path, viewer, "auto_segmentation", seg, mask, np.s_[:, :])
+
+    # Check that the previously committed object was kept and that the signature was upgraded.
+    f = zarr.open(commit_path, mode="r")
+    result = f["committed_objects"][:]
+    assert (result[:16, :16] == 1).all()
+    assert (result[-16:, -16:] == 2).all()
+    assert f.attrs["data_signature"] == _compute_data_signature(image)
+
+    viewer.close()
@@ -63,6 +63,53 @@ class TestUtil(unittest.TestCase):
         predictor = get_sam_model(model_type=model_type)
         check_predictor(predictor)
 
+    def test_get_shared_sam_model(self):
+        from micro_sam.util import clear_model_registry, get_sam_model, _compute_hash, _MODEL_REGISTRY
+
+        # Check that shared models are only loaded once.
+        predictor1, state1 = get_sam_model(model_type=self.model_type, return_state=True, shared=True)
+        predictor2 = get_sam_model(model_type=self.model_type, shared=True)
+        self.assertIs(predictor1, predictor2)
+        self.assertIsNot(predictor1, get_sam_model(model_type=self.model_type))
+
+        clear_model_registry()
+        self.assertIsNot(predictor1, get_sam_model(model_type=self.model_type, shared=True))
+
+        # Check that a released model is loaded again.
+        predictor3 = get_sam_model(model_type=self.model_type, shared=True)
+        _MODEL_REGISTRY.release(predictor3)
+        self.assertIsNot(predictor3, get_sam_model(model_type=self.model_type, shared=True))
+
+        # Check that the hash of a checkpoint is cached in a sidecar file.
+        checkpoint_path = os.path.join(self.tmp_folder, "checkpoint.pt")
+        torch.save(state1, checkpoint_path)
+        model_hash = _compute_hash(checkpoint_path)
+        self.assertTrue(os.path.exists(f"{checkpoint_path}.xxh128.json"))
+        self.assertEqual(model_hash, _compute_hash(checkpoint_path))
+        os.remove(f"{checkpoint_path}.xxh128.json")
+        self.assertEqual(model_hash, _compute_hash(checkpoint_path, chunk_size=8192))
+        clear_model_registry()
+
+    def test_optimize_image_encoder(self):
+        from micro_sam.util import get_sam_model, optimize_image_encoder, precompute_image_embeddings
+
+        predictor = get_sam_model(model_type=self.model_type)
+        image = np.random.randint(0, 255, size=(256, 256), dtype="uint8")
+        predictor.set_image(np.stack([image] * 3, axis=-1))
+        expected = predictor.get_image_embedding()
+        cached = precompute_image_embeddings(predictor, image, verbose=False)["features"]
+
+        error = optimize_image_encoder(predictor, autocast_dtype="bfloat16", channels_last=True)
+        self.assertLess(error, 0.05)
+        predictor.set_image(np.stack([image] * 3, axis=-1))
+        embeddings = predictor.get_image_embedding()
+        self.assertEqual(embeddings.dtype, torch.float32)
+        self.assertLess(((embeddings - expected).abs().mean() / expected.abs().mean()).item(), 0.05)
+
+        # Check that the embeddings of the optimized encoder are not taken from the embedding cache.
+        optimized = precompute_image_embeddings(predictor, image, verbose=False)["features"]
+        self.assertFalse(np.array_equal(optimized, cached))
+
     def test_compute_iou(self):
         from micro_sam.util import compute_iou
 
@@ -220,6 +267,224 @@ class TestUtil(unittest.TestCase):
             for tile_id in range(4):
                 self._check_predictor_initialization(predictor, embeddings, i=i, tile_id=tile_id)
 
+    def test_precompute_image_embeddings_pipelined(self):
+        from micro_sam.util import precompute_image_embeddings
+
+        # Load model and create test data.
+        predictor = get_sam_model(model_type=self.model_type)
+        tile_shape, halo = (256, 256), (16, 16)
+        input_ = np.random.rand(3, 512, 512).astype("float32")
+
+        # Check that the pipelined computation gives the same result as the sequential one.
+        for kwargs in ({}, {"tile_shape": tile_shape, "halo": halo}):
+            embeddings = precompute_image_embeddings(predictor, input_, ndim=3, batch_size=2, **kwargs)
+            embeddings_pipelined = precompute_image_embeddings(
+                predictor, input_, ndim=3, batch_size=2, pipelined=True, use_cache=False, **kwargs
+            )
+            if kwargs:
+                for tile_id in range(4):
+                    self.assertTrue(np.allclose(
+                        embeddings["features"][str(tile_id)][:], embeddings_pipelined["features"][str(tile_id)][:]
+                    ))
+            else:
+                self.assertTrue(np.allclose(embeddings["features"], embeddings_pipelined["features"]))
+                self.assertEqual(embeddings["input_size"], embeddings_pipelined["input_size"])
+
+        # Check that the pipelined computation with a save path works.
+        save_path = os.path.join(self.tmp_folder, "emebd.zarr")
+        embeddings = precompute_image_embeddings(predictor, input_, save_path=save_path, pipelined=True)
+        for i in range(input_.shape[0]):
+            self._check_predictor_initialization(predictor, embeddings, i=i)
+
+    def test_precompute_image_embeddings_on_demand(self):
+        from micro_sam.util import precompute_image_embeddings
+
+        # Load model and create test data.
+        predictor = get_sam_model(model_type=self.model_type)
+        input_ = np.random.rand(4, 512, 512).astype("float32")
+        expected = precompute_image_embeddings(predictor, input_, ndim=3, use_cache=False)
+
+        # Check that only the slice that is accessed (and its prefetched neighbor) is computed.
+        save_path = os.path.join(self.tmp_folder, "emebd.zarr")
+        embeddings = precompute_image_embeddings(
+            predictor, input_, save_path=save_path, ndim=3, compute_on_demand=True, prefetch=1
+        )
+        set_precomputed(predictor, embeddings, i=0)
+        f = zarr.open(save_path, mode="r")
+        self.assertEqual([np.count_nonzero(f["features"][z]) > 0 for z in range(4)], [True, True, False, False])
+        self.assertEqual(f["completed"][:].tolist(), [True, True, False, False])
+        self.assertNotIn("input_size", f.attrs)
+
+        # Check that the embeddings match the embeddings computed upfront
+        # and that the signature is written once all slices are computed.
+        for i in range(input_.shape[0]):
+            self._check_predictor_initialization(predictor, embeddings, i=i)
+            self.assertTrue(np.allclose(embeddings["features"][i], expected["features"][i], atol=1e-5))
+        self.assertIn("input_size", zarr.open(save_path, mode="r").attrs)
+
+    def test_precompute_image_embeddings_resume_tiled(self):
+        from micro_sam.util import precompute_image_embeddings
+
+        # Load model and create test data.
+        predictor = get_sam_model(model_type=self.model_type)
+        tile_shape, halo = (256, 256), (16, 16)
+        input_ = np.random.rand(512, 512).astype("float32")
+
+        save_path = os.path.join(self.tmp_folder, "emebd.zarr")
+        expected = precompute_image_embeddings(predictor, input_, save_path=save_path, tile_shape=tile_shape, halo=halo)
+        expected = {tile_id: expected["features"][tile_id][:] for tile_id in expected["features"].keys()}
+
+        # Simulate an interrupted computation, in which only the first tile was completed.
+        f = zarr.open(save_path, mode="a")
+        self.assertTrue(f["completed"][:].all())
+        del f.attrs["input_size"]
+        for tile_id in range(1, 4):
+            del f["features"][str(tile_id)]
+        completed = f["completed"][:]
+        completed[1:] = False
+        f["completed"][:] = completed
+
+        # Check that resuming the computation gives the same result.
+        embeddings = precompute_image_embeddings(
+            predictor, input_, save_path=save_path, tile_shape=tile_shape, halo=halo
+        )
+        self.assertIn("input_size", zarr.open(save_path, mode="r").attrs)
+        for tile_id, tile_features in expected.items():
+            self.assertTrue(np.allclose(embeddings["features"][tile_id][:], tile_features, atol=1e-5))
+            self._check_predictor_initialization(predictor, embeddings, tile_id=int(tile_id))
+
+    def test_precompute_image_embeddings_storage(self):
+        from micro_sam.util import precompute_image_embeddings
+
+        # Load model and create test data.
+        predictor = get_sam_model(model_type=self.model_type)
+        input_ = np.random.rand(2, 512, 512).astype("float32")
+        expected = precompute_image_embeddings(predictor, input_, ndim=3)["features"]
+
+        # Check that the embeddings stored with reduced precision are close to the float32 embeddings.
+        for storage_dtype, compression in [("float16", "lz4"), ("bfloat16", "zstd"), ("int8", "gzip")]:
+            save_path = os.path.join(self.tmp_folder, f"embed-{storage_dtype}.zarr")
+            precompute_image_embeddings(
+                predictor, input_, save_path=save_path, storage_dtype=storage_dtype, compression=compression
+            )
+            f = zarr.open(save_path, mode="r")
+            self.assertEqual(f.attrs["storage_dtype"], storage_dtype)
+            self.assertEqual(f.attrs["compression"], compression)
+
+            # Load the embeddings from file and check them.
+            embeddings = precompute_image_embeddings(predictor, input_, save_path=save_path, lazy_loading=True)
+            for i in range(input_.shape[0]):
+                self._check_predictor_initialization(predictor, embeddings, i=i)
+                features = embeddings["features"][i]
+                self.assertEqual(features.dtype, np.dtype("float32"))
+                max_error = np.abs(features - expected[i]).max() / np.abs(expected[i]).max()
+                self.assertLess(max_error, 0.01)
+
+    def test_precompute_image_embeddings_with_devices(self):
+        from micro_sam.util import precompute_image_embeddings
+
+        # Load model and create test data.
+        predictor = get_sam_model(model_type=self.model_type, device="cpu")
+        input_ = np.random.rand(3, 256, 256).astype("float32")
+        tile_shape, halo = (128, 128), (16, 16)
+
+        # Check that computing the embeddings with two worker processes on the CPU gives the same result,
+        # for the slices of a volume and for the tiles of an image.
+        for name, data, kwargs in [("3d", input_, {}), ("tiled", input_[0], dict(tile_shape=tile_shape, halo=halo))]:
+            expected_path = os.path.join(self.tmp_folder, f"expected-{name}.zarr")
+            precompute_image_embeddings(predictor, data, save_path=expected_path, **kwargs)
+            save_path = os.path.join(self.tmp_folder, f"embed-{name}.zarr")
+            precompute_image_embeddings(predictor, data, save_path=save_path, devices=["cpu", "cpu"], **kwargs)
+
+            expected, result = zarr.open(expected_path, mode="r"), zarr.open(save_path, mode="r")
+            self.assertEqual(dict(expected.attrs), dict(result.attrs))
+            if name == "3d":
+                self.assertTrue(np.allclose(expected["features"][:], result["features"][:], atol=1e-4))
+            else:
+                for tile_id in expected["features"].keys():
+                    self.assertTrue(np.allclose(
+                        expected["features"][tile_id][:], result["features"][tile_id][:], atol=1e-4
+                    ))
+                    self.assertEqual(dict(expected["features"][tile_id].attrs), dict(result["features"][tile_id].attrs))
+
+    def test_embedding_cache(self):
+        from micro_sam.util import precompute_image_embeddings, set_embedding_cache, clear_embedding_cache
+
+        predictor = get_sam_model(model_type=self.model_type)
+        input_ = np.random.rand(512, 512).astype("float32")
+
+        # Check that the embeddings are taken from the in-memory cache.
+        embeddings = precompute_image_embeddings(predictor, input_)
+        self.assertIs(embeddings["features"], precompute_image_embeddings(predictor, input_)["features"])
+        embeddings_uncached = precompute_image_embeddings(predictor, input_, use_cache=False)
+        self.assertIsNot(embeddings["features"], embeddings_uncached["features"])
+        self._check_predictor_initialization(predictor, embeddings)
+
+        # Check that the embeddings are taken from the on-disk cache.
+        os.environ["MICROSAM_CACHEDIR"], cache_dir = self.tmp_folder, os.environ.get("MICROSAM_CACHEDIR")
+        try:
+            set_embedding_cache(max_memory=0, use_disk=True)
+            embeddings = precompute_image_embeddings(predictor, input_)
+            self.assertEqual(len(os.listdir(os.path.join(self.tmp_folder, "embeddings"))), 1)
+            embeddings_cached = precompute_image_embeddings(predictor, input_)
+            self.assertTrue(np.allclose(embeddings["features"], embeddings_cached["features"]))
+            clear_embedding_cache(disk=True)
+            self.assertFalse(os.path.exists(os.path.join(self.tmp_folder, "embeddings")))
+        finally:
+            set_embedding_cache()
+            if cache_dir is None:
+                os.environ.pop("MICROSAM_CACHEDIR")
+            else:
+                os.environ["MICROSAM_CACHEDIR"] = cache_dir
+
+    def test_device_cache(self):
+        from micro_sam.util import precompute_image_embeddings, set_device_cache, clear_device_cache
+
+        predictor = get_sam_model(model_type=self.model_type)
+        input_ = np.random.rand(3, 512, 512).astype("float32")
+        save_path = os.path.join(self.tmp_folder, "emebd.zarr")
+        embeddings = precompute_image_embeddings(predictor, input_, save_path=save_path, ndim=3, lazy_loading=True)
+
+        # Check that the features are taken from the cache when the same slice is set again.
+        set_precomputed(predictor, embeddings, i=1)
+        features = predictor.features
+        set_precomputed(predictor, embeddings, i=0)
+        set_precomputed(predictor, embeddings, i=1)
+        self.assertIs(predictor.features, features)
+        self.assertTrue(np.allclose(features.cpu().numpy(), embeddings["features"][1]))
+
+        # Check that the features are not taken from the cache after clearing it.
+        clear_device_cache()
+        set_precomputed(predictor, embeddings, i=1)
+        self.assertIsNot(predictor.features, features)
+
+        # Check that the features are not cached if the cache is disabled.
+        try:
+            set_device_cache(max_memory=0)
+            set_precomputed(predictor, embeddings, i=1)
+            features = predictor.features
+            set_precomputed(predictor, embeddings, i=1)
+            self.assertIsNot(predictor.features, features)
+        finally:
+            set_device_cache()
+
+    def test_compute_data_signature(self):
+        from micro_sam.util import _compute_data_signature
+
+        data = np.random.rand(16, 64, 64).astype("float32")
+        signature = _compute_data_signature(data)
+        self.assertTrue(signature.startswith("xxh128:"))
+
+        # The signature must be the same for data loaded lazily from a chunked file.
+        save_path = os.path.join(self.tmp_folder, "data.zarr")
+        ds = zarr.open(save_path, mode="w", shape=data.shape, chunks=(3, 32, 32), dtype=data.dtype)
+        ds[:] = data
+        self.assertEqual(signature, _compute_data_signature(ds))
+
+        # And it must change if the data changes.
+        data[0, 0, 0] += 1
+        self.assertNotEqual(signature, _compute_data_signature(data))
+
     def test_segmentation_to_one_hot(self):
         from micro_sam.util import segmentation_to_one_hot
 